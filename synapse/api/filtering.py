@@ -55,6 +55,9 @@ ROOM_FILTER_SCHEMA = {
         "state": {"$ref": "#/definitions/room_event_filter"},
         "timeline": {"$ref": "#/definitions/room_event_filter"},
         "account_data": {"$ref": "#/definitions/room_event_filter"},
+        # Only send this many of the most recently active joined rooms in an
+        # initial sync, with the rest following in subsequent syncs.
+        "org.matrix.initial_sync_room_limit": {"type": "integer", "minimum": 1},
     },
 }
 
@@ -191,6 +194,9 @@ class FilterCollection(object):
         self._account_data = Filter(filter_json.get("account_data", {}))
 
         self.include_leave = filter_json.get("room", {}).get("include_leave", False)
+        self.initial_sync_room_limit = filter_json.get("room", {}).get(
+            "org.matrix.initial_sync_room_limit", None
+        )
         self.event_fields = filter_json.get("event_fields", [])
         self.event_format = filter_json.get("event_format", "client")
 
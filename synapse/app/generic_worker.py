@@ -109,6 +109,7 @@ from synapse.storage.data_stores.main.monthly_active_users import (
 )
 from synapse.storage.data_stores.main.presence import UserPresenceState
 from synapse.storage.data_stores.main.user_directory import UserDirectoryStore
+from synapse.storage.database import LoggingTransaction
 from synapse.types import ReadReceipt
 from synapse.util.async_helpers import Linearizer
 from synapse.util.httpresourcetree import create_resource_tree
@@ -427,11 +428,27 @@ class GenericWorkerSlavedStore(
         self.federation_out_pos_startup = self._get_federation_out_pos(db_conn)
 
     def _get_federation_out_pos(self, db_conn):
-        sql = "SELECT stream_id FROM federation_stream_position WHERE type = ?"
+        # Make sure this instance has a position before reading it, as it won't
+        # if it has just been added to the federation sender instances.
+        if self._need_to_reset_federation_stream_positions:
+            txn = LoggingTransaction(
+                db_conn.cursor(),
+                name="_reset_federation_positions_txn",
+                database_engine=self.database_engine,
+            )
+            self._reset_federation_positions_txn(txn)
+            txn.close()
+            db_conn.commit()
+            self._need_to_reset_federation_stream_positions = False
+
+        sql = (
+            "SELECT stream_id FROM federation_stream_position"
+            " WHERE type = ? AND instance_name = ?"
+        )
         sql = self.database_engine.convert_param_style(sql)
 
         txn = db_conn.cursor()
-        txn.execute(sql, ("federation",))
+        txn.execute(sql, ("federation", self._federation_instance_name))
         rows = txn.fetchall()
         txn.close()
 
@@ -731,6 +748,7 @@ class FederationSenderHandler(object):
     def __init__(self, hs: GenericWorkerServer, replication_client):
         self.store = hs.get_datastore()
         self._is_mine_id = hs.is_mine_id
+        self._instance_name = hs.config.federation_sender_instance_name
         self.federation_sender = hs.get_federation_sender()
         self.replication_client = replication_client
 
@@ -819,7 +837,7 @@ class FederationSenderHandler(object):
                     # We ACK this token over replication so that the master can drop
                     # its in memory queues
                     self.replication_client.send_federation_ack(
-                        self.federation_position
+                        self._instance_name, self.federation_position
                     )
                     self._last_ack = self.federation_position
         except Exception:
@@ -906,6 +924,18 @@ def start(config_options):
             )
             sys.exit(1)
 
+        federation_sender_instances = config.federation_shard_config.instances
+        if (
+            federation_sender_instances
+            and config.worker_name not in federation_sender_instances
+        ):
+            sys.stderr.write(
+                "\nThe worker_name of each federation sender must be listed in"
+                "\nfederation_sender_instances in the main config"
+                "\n"
+            )
+            sys.exit(1)
+
         # Force the pushers to start since they will be disabled in the main config
         config.send_federation = True
     else:
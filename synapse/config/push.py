@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from ._base import Config
+from ._base import Config, ConfigError
 
 
 class PushConfig(Config):
@@ -24,6 +24,26 @@ class PushConfig(Config):
         push_config = config.get("push", {})
         self.push_include_content = push_config.get("include_content", True)
 
+        self.push_deferred_evaluation_room_size = push_config.get(
+            "deferred_evaluation_room_size"
+        )
+        if self.push_deferred_evaluation_room_size is not None:
+            if not config.get("start_pushers", True):
+                # The pushers need to be told when the deferred push actions
+                # have been calculated, which only happens on the main process.
+                raise ConfigError(
+                    "push.deferred_evaluation_room_size requires the pushers to be "
+                    "run on the main process"
+                )
+
+        self.push_gateway_max_concurrent_requests = push_config.get(
+            "gateway_max_concurrent_requests", 10
+        )
+
+        self.push_gateway_metrics_hosts = set(
+            push_config.get("gateway_metrics_hosts") or []
+        )
+
         # There was a a 'redact_content' setting but mistakenly read from the
         # 'email'section'. Check for the flag in the 'push' section, and log,
         # but do not honour it to avoid nasty surprises when people upgrade.
@@ -60,4 +80,34 @@ class PushConfig(Config):
         #
         #push:
         #  include_content: true
+
+        # Working out who to notify about a message is done before the message
+        # is persisted, which slows down sending messages into big rooms.
+        # Set this to calculate the push actions for messages in rooms with at
+        # least this many members after they have been persisted instead.
+        # Notifications for those messages then lag slightly behind the
+        # messages themselves. This requires the pushers to be run on the main
+        # process.
+        #
+        # Defaults to unset, i.e. always calculating the push actions first.
+        #
+        #push:
+        #  deferred_evaluation_room_size: 1000
+
+        # The maximum number of requests to make to each push gateway at a
+        # time. Further notifications for the gateway are queued up, and
+        # identical ones for different devices are sent together. Defaults
+        # to 10.
+        #
+        #push:
+        #  gateway_max_concurrent_requests: 10
+
+        # The hosts of the push gateways to report request metrics for
+        # separately. Requests to any other gateway are reported together
+        # under the "other" label, as clients can choose any URL for their
+        # pushers. Defaults to none.
+        #
+        #push:
+        #  gateway_metrics_hosts:
+        #    - push.example.com
         """
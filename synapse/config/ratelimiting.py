@@ -28,6 +28,7 @@ class FederationRateLimitConfig(object):
         "sleep_delay": 500,
         "reject_limit": 50,
         "concurrent": 3,
+        "global_concurrent": 100,
     }
 
     def __init__(self, **kwargs):
@@ -151,6 +152,11 @@ class RatelimitConfig(Config):
         #     allowed from a single server
         #   - concurrent: number of federation requests to concurrently process
         #     from a single server
+        #   - global_concurrent: number of federation requests to concurrently
+        #     process in total. Once this many are in progress, further requests
+        #     are queued and servers take turns to have theirs processed, with
+        #     expensive requests (such as for the state of a room) counting for
+        #     more than cheap ones.
         #
         # The defaults are as shown below.
         #
@@ -160,6 +166,7 @@ class RatelimitConfig(Config):
         #  sleep_delay: 500
         #  reject_limit: 50
         #  concurrent: 3
+        #  global_concurrent: 100
 
         # Target outgoing federation transaction frequency for sending read-receipts,
         # per-room.
@@ -233,6 +233,32 @@ class ServerConfig(Config):
                 "Invalid range(s) provided in federation_ip_range_blacklist: %s" % e
             )
 
+        # How long to spend processing the PDUs in an incoming federation
+        # transaction before responding to it.
+        self.federation_transaction_time_budget = self.parse_duration(
+            config.get("federation_transaction_time_budget", "30s")
+        )
+
+        # The maximum total size of the encoded responses to federation state
+        # and backfill requests to keep cached.
+        self.federation_response_cache_size = self.parse_size(
+            config.get("federation_response_cache_size", "100M")
+        )
+
+        pool_config = config.get("federation_connection_pool") or {}
+        self.federation_max_connections_per_destination = pool_config.get(
+            "max_connections_per_destination", 5
+        )
+        self.federation_connection_idle_timeout = self.parse_duration(
+            pool_config.get("idle_timeout", "2m")
+        )
+        self.federation_max_idle_connections = pool_config.get(
+            "max_idle_connections", 1000
+        )
+        self.federation_prewarm_destinations = pool_config.get(
+            "prewarm_destinations", 10
+        )
+
         if self.public_baseurl is not None:
             if self.public_baseurl[-1] != "/":
                 self.public_baseurl += "/"
@@ -716,6 +742,49 @@ class ServerConfig(Config):
           - 'fe80::/64'
           - 'fc00::/7'
 
+        # The maximum amount of time to spend processing the PDUs in an incoming
+        # federation transaction before responding to the sending server. The
+        # rooms which haven't been processed by then carry on being processed
+        # in the background, so a single slow room doesn't cause the sending
+        # server to time out its request and retry the whole transaction.
+        #
+        # Defaults to '30s'.
+        #
+        #federation_transaction_time_budget: 15s
+
+        # The maximum total size of the responses to federation /state,
+        # /state_ids and /backfill requests to keep cached. Remote servers
+        # often make the same requests at once, e.g. when a busy room's server
+        # restarts, so we keep the encoded responses for a while.
+        #
+        # Defaults to '100M'.
+        #
+        #federation_response_cache_size: 50M
+
+        # Settings for the connections kept open to other servers between
+        # federation requests:
+        #
+        #  max_connections_per_destination: the most idle connections to keep
+        #      to any one server. We keep as many as the server has recently
+        #      had requests in flight at once, up to this limit. Defaults to 5.
+        #
+        #  idle_timeout: how long to keep idle connections open for. Defaults
+        #      to '2m'.
+        #
+        #  max_idle_connections: the most idle connections to keep in total.
+        #      Connections to the servers we talked to least recently are
+        #      closed first. Defaults to 1000.
+        #
+        #  prewarm_destinations: open a connection in advance to this many of
+        #      the servers we have been sending the most requests to, when
+        #      they have none idle. Defaults to 10.
+        #
+        #federation_connection_pool:
+        #  max_connections_per_destination: 10
+        #  idle_timeout: 5m
+        #  max_idle_connections: 500
+        #  prewarm_destinations: 20
+
         # List of ports that Synapse should listen on, their purpose and their
         # configuration.
         #
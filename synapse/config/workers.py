@@ -13,7 +13,40 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from ._base import Config
+from hashlib import sha256
+from typing import List
+
+import attr
+
+from ._base import Config, ConfigError
+
+
+@attr.s
+class ShardedWorkerHandlingConfig(object):
+    """Algorithm for choosing which instance is responsible for handling some
+    sharded work, e.g. sending federation to a destination.
+
+    Attributes:
+        instances: The names of the instances sharing the work. If empty, the
+            work isn't sharded and is all handled by one instance.
+    """
+
+    instances = attr.ib(type=List[str])
+
+    def should_handle(self, instance_name: str, key: str) -> bool:
+        """Whether the given instance is responsible for handling the given key.
+        """
+        if not self.instances:
+            return True
+
+        if instance_name not in self.instances:
+            return False
+
+        # We shard by hashing the key, rather than using Python's `hash`, so
+        # that all the instances agree on the shard for a given key.
+        key_hash = sha256(key.encode("utf8")).digest()
+        index = int.from_bytes(key_hash[:4], byteorder="little") % len(self.instances)
+        return self.instances[index] == instance_name
 
 
 class WorkerConfig(Config):
@@ -48,6 +81,36 @@ class WorkerConfig(Config):
 
         self.worker_main_http_uri = config.get("worker_main_http_uri", None)
 
+        # The names of the federation sender workers to shard outbound
+        # federation across, by destination. Each must have a unique
+        # `worker_name`.
+        federation_sender_instances = config.get("federation_sender_instances") or []
+        if not isinstance(federation_sender_instances, list) or not all(
+            isinstance(name, str) for name in federation_sender_instances
+        ):
+            raise ConfigError("federation_sender_instances must be a list of names")
+        if len(set(federation_sender_instances)) != len(federation_sender_instances):
+            raise ConfigError("federation_sender_instances must not contain duplicates")
+        self.federation_shard_config = ShardedWorkerHandlingConfig(
+            federation_sender_instances
+        )
+        if (
+            federation_sender_instances
+            and self.worker_app is None
+            and config.get("send_federation", True)
+        ):
+            raise ConfigError(
+                "send_federation must be disabled when federation_sender_instances "
+                "is set"
+            )
+
+        # The name to track this process' position in the streams it sends
+        # federation for under.
+        if federation_sender_instances:
+            self.federation_sender_instance_name = self.worker_name
+        else:
+            self.federation_sender_instance_name = "master"
+
         # This option is really only here to support `--manhole` command line
         # argument.
         manhole = config.get("worker_manhole")
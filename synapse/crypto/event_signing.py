@@ -27,7 +27,7 @@ from unpaddedbase64 import decode_base64, encode_base64
 
 from synapse.api.errors import Codes, SynapseError
 from synapse.api.room_versions import RoomVersion
-from synapse.events.utils import prune_event, prune_event_dict
+from synapse.events.utils import prune_event_dict
 from synapse.types import JsonDict
 
 logger = logging.getLogger(__name__)
@@ -80,6 +80,14 @@ def compute_content_hash(event_dict, hash_algorithm):
         tuple[str, bytes]: A tuple of the name of hash and the hash as raw
         bytes.
     """
+    hashed = hash_algorithm(encode_content_hash_json(event_dict))
+    return hashed.name, hashed.digest()
+
+
+def encode_content_hash_json(event_dict: JsonDict) -> bytes:
+    """Encode the parts of an unredacted event which are covered by its
+    content hash as canonical JSON.
+    """
     event_dict = dict(event_dict)
     event_dict.pop("age_ts", None)
     event_dict.pop("unsigned", None)
@@ -88,10 +96,7 @@ def compute_content_hash(event_dict, hash_algorithm):
     event_dict.pop("outlier", None)
     event_dict.pop("destinations", None)
 
-    event_json_bytes = encode_canonical_json(event_dict)
-
-    hashed = hash_algorithm(event_json_bytes)
-    return hashed.name, hashed.digest()
+    return encode_canonical_json(event_dict)
 
 
 def compute_event_reference_hash(event, hash_algorithm=hashlib.sha256):
@@ -107,16 +112,26 @@ def compute_event_reference_hash(event, hash_algorithm=hashlib.sha256):
         tuple[str, bytes]: A tuple of the name of hash and the hash as raw
         bytes.
     """
-    tmp_event = prune_event(event)
-    event_dict = tmp_event.get_pdu_json()
-    event_dict.pop("signatures", None)
-    event_dict.pop("age_ts", None)
-    event_dict.pop("unsigned", None)
-    event_json_bytes = encode_canonical_json(event_dict)
-    hashed = hash_algorithm(event_json_bytes)
+    hashed = hash_algorithm(
+        encode_redacted_event_json(event.room_version, event.get_dict())
+    )
     return hashed.name, hashed.digest()
 
 
+def encode_redacted_event_json(
+    room_version: RoomVersion, event_dict: JsonDict
+) -> bytes:
+    """Redact an event and encode it as canonical JSON, without its signatures
+    or unsigned data. This is the JSON covered by the event's reference hash
+    and signatures.
+    """
+    redacted_dict = prune_event_dict(room_version, event_dict)
+    redacted_dict.pop("signatures", None)
+    redacted_dict.pop("age_ts", None)
+    redacted_dict.pop("unsigned", None)
+    return encode_canonical_json(redacted_dict)
+
+
 def compute_event_signature(
     room_version: RoomVersion,
     event_dict: JsonDict,
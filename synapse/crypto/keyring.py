@@ -16,6 +16,7 @@
 
 import logging
 from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 
 import six
 from six.moves import urllib
@@ -45,18 +46,35 @@ from synapse.api.errors import (
 from synapse.logging.context import (
     LoggingContext,
     PreserveLoggingContext,
+    defer_to_thread,
     make_deferred_yieldable,
     preserve_fn,
     run_in_background,
 )
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage.keys import FetchKeyResult
 from synapse.util import unwrapFirstError
 from synapse.util.async_helpers import yieldable_gather_results
+from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.metrics import Measure
 from synapse.util.retryutils import NotRetryingDestination
 
 logger = logging.getLogger(__name__)
 
+# How long we keep the verify keys we have fetched in memory for.
+VERIFY_KEY_CACHE_EXPIRY_MS = 60 * 60 * 1000
+
+# The maximum number of verify keys we keep in memory.
+VERIFY_KEY_CACHE_MAX_ENTRIES = 10000
+
+# The maximum number of signatures to check in one go in a background thread.
+VERIFY_BATCH_SIZE = 100
+
+# We only check signatures in background threads if there are at least this
+# many to check at once, as otherwise handing them over costs more than it
+# saves.
+MIN_THREADED_VERIFICATIONS = 10
+
 
 @attr.s(slots=True, cmp=False)
 class VerifyJsonRequest(object):
@@ -74,6 +92,10 @@ class VerifyJsonRequest(object):
         minimum_valid_until_ts (int): time at which we require the signing key to
             be valid. (0 implies we don't care)
 
+        signed_json_bytes (bytes|None): The canonical JSON encoding of the
+            object without its signatures and unsigned data, if we already
+            have it. If set, json_object is only used for its signatures.
+
         key_ready (Deferred[str, str, nacl.signing.VerifyKey]):
             A deferred (server_name, key_id, verify_key) tuple that resolves when
             a verify key has been fetched. The deferreds' callbacks are run with no
@@ -87,6 +109,7 @@ class VerifyJsonRequest(object):
     json_object = attr.ib()
     minimum_valid_until_ts = attr.ib()
     request_name = attr.ib()
+    signed_json_bytes = attr.ib(default=None)
     key_ids = attr.ib(init=False)
     key_ready = attr.ib(default=attr.Factory(defer.Deferred))
 
@@ -110,6 +133,22 @@ class Keyring(object):
             )
         self._key_fetchers = key_fetchers
 
+        self._reactor = hs.get_reactor()
+
+        # map from (server_name, key_id) to the FetchKeyResult we last fetched
+        # for the key.
+        self._verify_key_cache = ExpiringCache(
+            cache_name="verify_key_cache",
+            clock=self.clock,
+            max_len=VERIFY_KEY_CACHE_MAX_ENTRIES,
+            expiry_ms=VERIFY_KEY_CACHE_EXPIRY_MS,
+        )
+
+        # The signature checks waiting to be done, as a list of
+        # (server_name, key_id, verify_key, VerifyJsonRequest, Deferred) tuples.
+        # The Deferreds resolve with the error if the signature is invalid.
+        self._pending_verifications = []
+
         # map from server name to Deferred. Has an entry for each server with
         # an ongoing key download; the Deferred completes once the download
         # completes.
@@ -167,6 +206,39 @@ class Keyring(object):
             for server_name, json_object, validity_time, request_name in server_and_json
         )
 
+    def verify_events_for_server(self, server_and_events):
+        """Bulk verifies signatures of events, bulk fetching keys as necessary.
+
+        This is the same as verify_json_objects_for_server on the redacted
+        events, except that it takes the encoding of each redacted event, so
+        that the caller can check several signatures on an event without
+        encoding it again each time.
+
+        Args:
+            server_and_events (iterable[Tuple[str, EventBase, bytes, int]]):
+                Iterable of (server_name, event, redacted_json_bytes,
+                validity_time) tuples, where redacted_json_bytes is the
+                result of `encode_redacted_event_json` for the event.
+
+        Returns:
+            List<Deferred[None]>: for each input tuple, a deferred indicating
+                success or failure to verify the event's signature for the
+                given server_name. The deferreds run their callbacks in the
+                sentinel logcontext.
+        """
+        return self._verify_objects(
+            VerifyJsonRequest(
+                server_name,
+                {"signatures": event.signatures},
+                validity_time,
+                event.event_id,
+                signed_json_bytes=redacted_json_bytes,
+            )
+            for server_name, event, redacted_json_bytes, validity_time in (
+                server_and_events
+            )
+        )
+
     def _verify_objects(self, verify_requests):
         """Does the work of verify_json_[objects_]for_server
 
@@ -183,7 +255,7 @@ class Keyring(object):
         """
         # a list of VerifyJsonRequests which are awaiting a key lookup
         key_lookups = []
-        handle = preserve_fn(_handle_key_deferred)
+        handle = preserve_fn(self._handle_key_deferred)
 
         def process(verify_request):
             """Process an entry in the request list
@@ -208,8 +280,14 @@ class Keyring(object):
                 verify_request.minimum_valid_until_ts,
             )
 
-            # add the key request to the queue, but don't start it off yet.
-            key_lookups.append(verify_request)
+            cached_key = self._get_cached_verify_key(verify_request)
+            if cached_key:
+                # there are no callbacks on key_ready yet, so we don't need to
+                # worry about logcontexts.
+                verify_request.key_ready.callback(cached_key)
+            else:
+                # add the key request to the queue, but don't start it off yet.
+                key_lookups.append(verify_request)
 
             # now run _handle_key_deferred, which will wait for the key request
             # to complete and then do the verification.
@@ -331,6 +409,17 @@ class Keyring(object):
         @defer.inlineCallbacks
         def do_iterations():
             with Measure(self.clock, "get_server_verify_keys"):
+                # we may have fetched the keys while waiting for previous
+                # lookups to complete.
+                completed = []
+                for verify_request in remaining_requests:
+                    cached_key = self._get_cached_verify_key(verify_request)
+                    if cached_key:
+                        with PreserveLoggingContext():
+                            verify_request.key_ready.callback(cached_key)
+                        completed.append(verify_request)
+                remaining_requests.difference_update(completed)
+
                 for f in self._key_fetchers:
                     if not remaining_requests:
                         return
@@ -394,6 +483,11 @@ class Keyring(object):
 
         results = yield fetcher.get_keys(missing_keys)
 
+        for server_name, result_keys in results.items():
+            for key_id, fetch_key_result in result_keys.items():
+                if fetch_key_result:
+                    self._cache_verify_key(server_name, key_id, fetch_key_result)
+
         completed = []
         for verify_request in remaining_requests:
             server_name = verify_request.server_name
@@ -423,6 +517,171 @@ class Keyring(object):
 
         remaining_requests.difference_update(completed)
 
+    def _get_cached_verify_key(self, verify_request):
+        """Looks for a verify key we have fetched recently which satisfies a
+        verify request.
+
+        Args:
+            verify_request (VerifyJsonRequest)
+
+        Returns:
+            tuple[str, str, nacl.signing.VerifyKey]|None: the
+                (server_name, key_id, verify_key) to resolve key_ready with, if
+                we have a suitable key.
+        """
+        server_name = verify_request.server_name
+        for key_id in verify_request.key_ids:
+            fetch_key_result = self._verify_key_cache.get((server_name, key_id))
+            if not fetch_key_result:
+                continue
+
+            if fetch_key_result.valid_until_ts < verify_request.minimum_valid_until_ts:
+                continue
+
+            return server_name, key_id, fetch_key_result.verify_key
+
+        return None
+
+    def _cache_verify_key(self, server_name, key_id, fetch_key_result):
+        """Remembers a verify key we have fetched, unless we already know of
+        the key with a later validity.
+        """
+        cached = self._verify_key_cache.get((server_name, key_id))
+        if cached and cached.valid_until_ts > fetch_key_result.valid_until_ts:
+            return
+
+        self._verify_key_cache[(server_name, key_id)] = fetch_key_result
+
+    @defer.inlineCallbacks
+    def _handle_key_deferred(self, verify_request):
+        """Waits for the key to become available, and then performs a verification
+
+        Args:
+            verify_request (VerifyJsonRequest):
+
+        Returns:
+            Deferred[None]
+
+        Raises:
+            SynapseError if there was a problem performing the verification
+        """
+        server_name = verify_request.server_name
+        with PreserveLoggingContext():
+            _, key_id, verify_key = yield verify_request.key_ready
+
+        with PreserveLoggingContext():
+            error = yield self._verify_signature(
+                server_name, key_id, verify_key, verify_request
+            )
+
+        if isinstance(error, SignatureVerifyException):
+            logger.debug(
+                "Error verifying signature for %s:%s:%s with key %s: %s",
+                server_name,
+                verify_key.alg,
+                verify_key.version,
+                encode_verify_key_base64(verify_key),
+                str(error),
+            )
+            raise SynapseError(
+                401,
+                "Invalid signature for server %s with key %s:%s: %s"
+                % (server_name, verify_key.alg, verify_key.version, str(error)),
+                Codes.UNAUTHORIZED,
+            )
+        elif error:
+            raise error
+
+    def _verify_signature(self, server_name, key_id, verify_key, verify_request):
+        """Queues up a check of the signature on the object in a verify request.
+
+        The check is done along with any others queued up in the same reactor
+        tick, so that we can check them in batches.
+
+        Args:
+            server_name (str): the server which should have signed the object
+            key_id (str): the ID of the key to check the signature with
+            verify_key (nacl.signing.VerifyKey): the key
+            verify_request (VerifyJsonRequest): the request to check
+
+        Returns:
+            Deferred[Exception|None]: resolves with the error if the signature
+                could not be verified. Runs its callbacks in the sentinel
+                logcontext.
+        """
+        d = defer.Deferred()
+
+        if not self._pending_verifications:
+            self.clock.call_later(
+                0,
+                run_as_background_process,
+                "verify_signatures",
+                self._verify_pending_signatures,
+            )
+
+        self._pending_verifications.append(
+            (server_name, key_id, verify_key, verify_request, d)
+        )
+
+        return d
+
+    async def _verify_pending_signatures(self):
+        """Checks the signatures queued up by `_verify_signature`.
+
+        The checks are grouped by key and split into batches. If there are
+        enough of them, the batches are checked in parallel in the reactor's
+        threadpool rather than on the reactor thread.
+        """
+        pending = self._pending_verifications
+        self._pending_verifications = []
+
+        by_key = {}  # type: Dict[Tuple[str, str], list]
+        for server_name, key_id, verify_key, verify_request, d in pending:
+            by_key.setdefault((server_name, key_id), []).append(
+                (server_name, verify_key, verify_request, d)
+            )
+
+        batches = []
+        for checks in by_key.values():
+            for i in range(0, len(checks), VERIFY_BATCH_SIZE):
+                batches.append(checks[i : i + VERIFY_BATCH_SIZE])
+
+        use_threads = len(pending) >= MIN_THREADED_VERIFICATIONS
+
+        async def verify_batch(batch):
+            to_check = [
+                (
+                    server_name,
+                    verify_key,
+                    verify_request.json_object,
+                    verify_request.signed_json_bytes,
+                )
+                for server_name, verify_key, verify_request, _ in batch
+            ]
+            try:
+                if use_threads:
+                    errors = await defer_to_thread(
+                        self._reactor, _verify_signatures, to_check
+                    )
+                else:
+                    errors = _verify_signatures(to_check)
+            except Exception as e:
+                # we don't expect to get here, as _verify_signatures catches
+                # any errors for each check.
+                logger.exception("Error checking signatures")
+                errors = [e] * len(batch)
+
+            with PreserveLoggingContext():
+                for (_, _, _, d), error in zip(batch, errors):
+                    d.callback(error)
+
+        await make_deferred_yieldable(
+            defer.gatherResults(
+                [run_in_background(verify_batch, batch) for batch in batches],
+                consumeErrors=True,
+            ).addErrback(unwrapFirstError)
+        )
+
 
 class KeyFetcher(object):
     def get_keys(self, keys_to_fetch):
@@ -840,39 +1099,69 @@ class ServerKeyFetcher(BaseV2KeyFetcher):
         return keys
 
 
-@defer.inlineCallbacks
-def _handle_key_deferred(verify_request):
-    """Waits for the key to become available, and then performs a verification
+def _verify_signatures(to_check):
+    """Checks the signatures on a batch of JSON objects.
+
+    This may be run in a background thread, so shouldn't touch anything but
+    its arguments.
 
     Args:
-        verify_request (VerifyJsonRequest):
+        to_check (list[tuple[str, nacl.signing.VerifyKey, dict, bytes|None]]):
+            the (server_name, verify_key, json_object, signed_json_bytes) to
+            check. See VerifyJsonRequest.
 
     Returns:
-        Deferred[None]
+        list[Exception|None]: for each check, the error if the signature could
+            not be verified.
+    """
+    errors = []  # type: List[Optional[Exception]]
+    for server_name, verify_key, json_object, signed_json_bytes in to_check:
+        try:
+            if signed_json_bytes is None:
+                verify_signed_json(json_object, server_name, verify_key)
+            else:
+                _verify_signed_json_bytes(
+                    json_object, signed_json_bytes, server_name, verify_key
+                )
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+    return errors
+
+
+def _verify_signed_json_bytes(json_object, signed_json_bytes, server_name, verify_key):
+    """Checks a signature on a JSON object whose canonical encoding we already
+    have. Behaves like `signedjson.sign.verify_signed_json`.
+
+    Args:
+        json_object (dict): the object, or at least its signatures.
+        signed_json_bytes (bytes): the canonical JSON encoding of the object,
+            without its signatures or unsigned data.
+        server_name (str): the name of the signature to check.
+        verify_key (nacl.signing.VerifyKey): the key to check the signature with.
 
     Raises:
-        SynapseError if there was a problem performing the verification
+        SignatureVerifyException: if the signature isn't valid
     """
-    server_name = verify_request.server_name
-    with PreserveLoggingContext():
-        _, key_id, verify_key = yield verify_request.key_ready
+    key_id = "%s:%s" % (verify_key.alg, verify_key.version)
 
-    json_object = verify_request.json_object
+    try:
+        signature_b64 = json_object["signatures"][server_name][key_id]
+    except KeyError:
+        raise SignatureVerifyException(
+            "Missing signature for %s, %s" % (server_name, key_id)
+        )
 
     try:
-        verify_signed_json(json_object, server_name, verify_key)
-    except SignatureVerifyException as e:
-        logger.debug(
-            "Error verifying signature for %s:%s:%s with key %s: %s",
-            server_name,
-            verify_key.alg,
-            verify_key.version,
-            encode_verify_key_base64(verify_key),
-            str(e),
+        signature = decode_base64(signature_b64)
+    except Exception:
+        raise SignatureVerifyException(
+            "Invalid signature base64 for %s, %s" % (server_name, key_id)
         )
-        raise SynapseError(
-            401,
-            "Invalid signature for server %s with key %s:%s: %s"
-            % (server_name, verify_key.alg, verify_key.version, str(e)),
-            Codes.UNAUTHORIZED,
+
+    try:
+        verify_key.verify(signed_json_bytes, signature)
+    except Exception as e:
+        raise SignatureVerifyException(
+            "Unable to verify signature for %s: %s %s" % (server_name, type(e), e)
         )
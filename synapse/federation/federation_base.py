@@ -30,7 +30,10 @@ from synapse.api.room_versions import (
     EventFormatVersions,
     RoomVersion,
 )
-from synapse.crypto.event_signing import check_event_content_hash
+from synapse.crypto.event_signing import (
+    check_event_content_hash,
+    encode_redacted_event_json,
+)
 from synapse.crypto.keyring import Keyring
 from synapse.events import EventBase, make_event_from_dict
 from synapse.events.utils import prune_event
@@ -139,7 +142,7 @@ class FederationBase(object):
 
 class PduToCheckSig(
     namedtuple(
-        "PduToCheckSig", ["pdu", "redacted_pdu_json", "sender_domain", "deferreds"]
+        "PduToCheckSig", ["pdu", "redacted_json_bytes", "sender_domain", "deferreds"]
     )
 ):
     pass
@@ -178,13 +181,16 @@ def _check_sigs_on_pdus(
     #
     # (b) for V1 and V2 rooms, the server which created the event_id
     #
-    # let's start by getting the domain for each pdu, and flattening the event back
-    # to JSON.
+    # let's start by getting the domain for each pdu, and encoding the redacted
+    # event that the signatures cover. We only keep the encoding until the
+    # checks are done.
 
     pdus_to_check = [
         PduToCheckSig(
             pdu=p,
-            redacted_pdu_json=prune_event(p).get_pdu_json(),
+            redacted_json_bytes=encode_redacted_event_json(
+                p.room_version, p.get_dict()
+            ),
             sender_domain=get_domain_from_id(p.sender),
             deferreds=[],
         )
@@ -199,13 +205,13 @@ def _check_sigs_on_pdus(
     # (except if its a 3pid invite, in which case it may be sent by any server)
     pdus_to_check_sender = [p for p in pdus_to_check if not _is_invite_via_3pid(p.pdu)]
 
-    more_deferreds = keyring.verify_json_objects_for_server(
+    more_deferreds = keyring.verify_events_for_server(
         [
             (
                 p.sender_domain,
-                p.redacted_pdu_json,
+                p.pdu,
+                p.redacted_json_bytes,
                 p.pdu.origin_server_ts if v.enforce_key_validity else 0,
-                p.pdu.event_id,
             )
             for p in pdus_to_check_sender
         ]
@@ -234,13 +240,13 @@ def _check_sigs_on_pdus(
             if p.sender_domain != get_domain_from_id(p.pdu.event_id)
         ]
 
-        more_deferreds = keyring.verify_json_objects_for_server(
+        more_deferreds = keyring.verify_events_for_server(
             [
                 (
                     get_domain_from_id(p.pdu.event_id),
-                    p.redacted_pdu_json,
+                    p.pdu,
+                    p.redacted_json_bytes,
                     p.pdu.origin_server_ts if v.enforce_key_validity else 0,
-                    p.pdu.event_id,
                 )
                 for p in pdus_to_check_event_id
             ]
@@ -63,6 +63,14 @@ logger = logging.getLogger(__name__)
 
 sent_queries_counter = Counter("synapse_federation_client_sent_queries", "", ["type"])
 
+send_join_events_checked_counter = Counter(
+    "synapse_federation_client_send_join_events_checked",
+    "Number of events from send_join responses whose signatures have been checked",
+)
+
+# The number of events from a send_join response to check the signatures of at
+# a time.
+SEND_JOIN_CHECK_BATCH_SIZE = 1000
 
 PDU_RETRY_TIME_MS = 1 * 60 * 1000
 
@@ -620,8 +628,6 @@ class FederationClient(FederationBase):
         async def send_request(destination) -> Dict[str, Any]:
             content = await self._do_send_join(destination, pdu)
 
-            logger.debug("Got content: %s", content)
-
             state = [
                 event_from_pdu_json(p, room_version, outlier=True)
                 for p in content.get("state", [])
@@ -632,6 +638,13 @@ class FederationClient(FederationBase):
                 for p in content.get("auth_chain", [])
             ]
 
+            logger.info(
+                "Got %d state and %d auth chain events from send_join to %s",
+                len(state),
+                len(auth_chain),
+                destination,
+            )
+
             pdus = {p.event_id: p for p in itertools.chain(state, auth_chain)}
 
             create_event = None
@@ -657,14 +670,27 @@ class FederationClient(FederationBase):
                     % (create_room_version,)
                 )
 
-            valid_pdus = await self._check_sigs_and_hash_and_fetch(
-                destination,
-                list(pdus.values()),
-                outlier=True,
-                room_version=room_version.identifier,
-            )
+            # Check the signatures in batches, so that the number of checks in
+            # flight at once is bounded.
+            valid_pdus_map = {}  # type: Dict[str, EventBase]
+            pdu_list = list(pdus.values())
+            for i in range(0, len(pdu_list), SEND_JOIN_CHECK_BATCH_SIZE):
+                batch = pdu_list[i : i + SEND_JOIN_CHECK_BATCH_SIZE]
+                valid_pdus = await self._check_sigs_and_hash_and_fetch(
+                    destination,
+                    batch,
+                    outlier=True,
+                    room_version=room_version.identifier,
+                )
+                valid_pdus_map.update((p.event_id, p) for p in valid_pdus)
 
-            valid_pdus_map = {p.event_id: p for p in valid_pdus}
+                send_join_events_checked_counter.inc(len(batch))
+                logger.info(
+                    "Checked signatures of %d/%d events from send_join to %s",
+                    i + len(batch),
+                    len(pdu_list),
+                    destination,
+                )
 
             # NB: We *need* to copy to ensure that we don't have multiple
             # references being passed on, as that causes... issues.
@@ -15,13 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-from typing import Dict
+from typing import Dict, Optional
 
 import six
 from six import iteritems
 
-from canonicaljson import json
-from prometheus_client import Counter
+from canonicaljson import encode_canonical_json, json
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 from twisted.internet.abstract import isIPAddress
@@ -37,31 +37,48 @@ from synapse.api.errors import (
     SynapseError,
     UnsupportedRoomVersionError,
 )
-from synapse.api.room_versions import KNOWN_ROOM_VERSIONS
+from synapse.api.room_versions import KNOWN_ROOM_VERSIONS, RoomVersion
 from synapse.federation.federation_base import FederationBase, event_from_pdu_json
 from synapse.federation.persistence import TransactionActions
 from synapse.federation.units import Edu, Transaction
 from synapse.http.endpoint import parse_server_name
+from synapse.http.server import EncodedJsonResponse
 from synapse.logging.context import (
+    PreserveLoggingContext,
     make_deferred_yieldable,
     nested_logging_context,
     run_in_background,
 )
 from synapse.logging.opentracing import log_kv, start_active_span_from_edu, trace
 from synapse.logging.utils import log_function
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.http.federation import (
     ReplicationFederationSendEduRestServlet,
     ReplicationGetQueryRestServlet,
 )
 from synapse.types import JsonDict, get_domain_from_id
 from synapse.util import glob_to_regex, unwrapFirstError
-from synapse.util.async_helpers import Linearizer, concurrently_execute
+from synapse.util.async_helpers import (
+    Linearizer,
+    ObservableDeferred,
+    concurrently_execute,
+)
+from synapse.util.caches.encoded_response_cache import EncodedResponseCache
 from synapse.util.caches.response_cache import ResponseCache
 
 # when processing incoming transactions, we try to handle multiple rooms in
 # parallel, up to this limit.
 TRANSACTION_CONCURRENCY_LIMIT = 10
 
+# the maximum number of rooms we process the PDUs for at once, across all
+# incoming transactions (including those we have already responded to).
+ROOM_PROCESSING_CONCURRENCY_LIMIT = 100
+
+# How long we keep the responses to state and backfill requests cached for. We
+# invalidate them when events are redacted or purged, but other workers only
+# find out about those once this has passed.
+RESPONSE_CACHE_EXPIRY_MS = 10 * 60 * 1000
+
 logger = logging.getLogger(__name__)
 
 received_pdus_counter = Counter("synapse_federation_server_received_pdus", "")
@@ -72,6 +89,18 @@ received_queries_counter = Counter(
     "synapse_federation_server_received_queries", "", ["type"]
 )
 
+room_pdus_processing_time = Histogram(
+    "synapse_federation_server_room_pdus_processing_time_seconds",
+    "Time taken to process the PDUs for a room in an incoming transaction",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, "+Inf"),
+)
+
+transaction_time_budget_exceeded_counter = Counter(
+    "synapse_federation_server_transaction_time_budget_exceeded",
+    "Number of incoming transactions we responded to before processing all of "
+    "their PDUs",
+)
+
 
 class FederationServer(FederationBase):
     def __init__(self, hs):
@@ -86,6 +115,27 @@ class FederationServer(FederationBase):
         self._server_linearizer = Linearizer("fed_server")
         self._transaction_linearizer = Linearizer("fed_txn_handler")
 
+        # We process the PDUs for each room in a transaction in order, and
+        # make sure we've finished with those from one transaction before
+        # starting on those from the next. This matters as we may respond to a
+        # transaction before we've processed all of its PDUs.
+        self._room_pdu_linearizer = Linearizer(name="fed_txn_room", clock=self._clock)
+
+        # Limits how many rooms we process PDUs for at once, so that PDUs we
+        # carry on processing after responding can't pile up without bound.
+        self._room_pdu_limiter = Linearizer(
+            name="fed_txn_room_limit",
+            max_count=ROOM_PROCESSING_CONCURRENCY_LIMIT,
+            clock=self._clock,
+        )
+
+        # The processing still going on in the background for the last
+        # transaction from each origin that we responded to early. We don't
+        # start on another transaction from that origin until it is done.
+        self._pdu_backlogs = {}  # type: Dict[str, ObservableDeferred]
+
+        self._transaction_time_budget_ms = hs.config.federation_transaction_time_budget
+
         self.transaction_actions = TransactionActions(self.store)
 
         self.registry = hs.get_federation_registry()
@@ -94,18 +144,69 @@ class FederationServer(FederationBase):
         # come in waves.
         self._state_resp_cache = ResponseCache(hs, "state_resp", timeout_ms=30000)
 
+        # Responses to state and backfill requests for a given point in a room
+        # don't change unless events are redacted or purged, so we keep them
+        # cached, already encoded, for a while after they have been sent.
+        self._encoded_resp_cache = EncodedResponseCache(
+            hs,
+            "federation_encoded_resp",
+            max_size=hs.config.federation_response_cache_size,
+            expiry_ms=RESPONSE_CACHE_EXPIRY_MS,
+        )
+        hs.get_notifier().add_redaction_callback(self._on_redaction)
+
+    def _on_redaction(self, room_id, redacted_event_id):
+        self.invalidate_cached_responses(room_id)
+
+    def invalidate_cached_responses(self, room_id):
+        """Drop the cached responses to state and backfill requests for a room,
+        e.g. because some of its events have been purged.
+
+        Args:
+            room_id (str)
+        """
+        self._encoded_resp_cache.invalidate_room(room_id)
+
     async def on_backfill_request(self, origin, room_id, versions, limit):
         with (await self._server_linearizer.queue((origin, room_id))):
             origin_host, _ = parse_server_name(origin)
             await self.check_server_matches_acl(origin_host, room_id)
 
-            pdus = await self.handler.on_backfill_request(
-                origin, room_id, versions, limit
+            # Which events the origin can see depends on its membership, so
+            # its responses can't be shared with other servers.
+            pdus_json = await self._encoded_resp_cache.wrap(
+                room_id,
+                ("backfill", origin, tuple(sorted(versions)), limit),
+                self._encode_backfill_pdus,
+                origin,
+                room_id,
+                versions,
+                limit,
             )
 
-            res = self._transaction_from_pdus(pdus).get_dict()
+        # This is the encoding of the transaction that `_transaction_from_pdus`
+        # would give us, with the current time filled in around the cached
+        # PDUs.
+        json_bytes = b'{"origin":%s,"origin_server_ts":%d,"pdus":%s}' % (
+            encode_canonical_json(self.server_name),
+            self._clock.time_msec(),
+            pdus_json,
+        )
+
+        return 200, EncodedJsonResponse(json_bytes)
 
-        return 200, res
+    async def _encode_backfill_pdus(self, origin, room_id, versions, limit):
+        pdus = await self.handler.on_backfill_request(origin, room_id, versions, limit)
+
+        # The ages of the events would go stale while the response is cached,
+        # so unlike other transactions we send we leave them out.
+        pdus_json = []
+        for pdu in pdus:
+            pdu_json = pdu.get_pdu_json()
+            pdu_json["unsigned"].pop("age_ts", None)
+            pdus_json.append(pdu_json)
+
+        return encode_canonical_json(pdus_json)
 
     async def on_incoming_transaction(self, origin, transaction_data):
         # keep this as early as possible to make the calculated origin ts as
@@ -194,6 +295,12 @@ class FederationServer(FederationBase):
     ) -> Dict[str, dict]:
         """Process the PDUs in a received transaction.
 
+        If the PDUs take longer than `federation_transaction_time_budget` to
+        process, we return early with the results for the PDUs processed so
+        far, and carry on processing the rest in the background. We don't
+        start on (and so don't acknowledge) any more transactions from that
+        origin until we have finished with them.
+
         Args:
             origin: the server making the request
             transaction: incoming transaction
@@ -204,12 +311,26 @@ class FederationServer(FederationBase):
             report back to the sending server.
         """
 
+        backlog = self._pdu_backlogs.get(origin)
+        while backlog is not None:
+            logger.info(
+                "[%s] Waiting for PDUs from an earlier transaction from %s",
+                transaction.transaction_id,
+                origin,
+            )
+            await make_deferred_yieldable(backlog.observe())
+            backlog = self._pdu_backlogs.get(origin)
+
         received_pdus_counter.inc(len(transaction.pdus))
 
         origin_host, _ = parse_server_name(origin)
 
         pdus_by_room = {}
 
+        # The room versions of the rooms in the transaction, or None if we
+        # should ignore the PDUs for the room.
+        room_versions = {}  # type: Dict[str, Optional[RoomVersion]]
+
         for p in transaction.pdus:
             if "unsigned" in p:
                 unsigned = p["unsigned"]
@@ -234,15 +355,20 @@ class FederationServer(FederationBase):
                 )
                 continue
 
-            try:
-                room_version = await self.store.get_room_version(room_id)
-            except NotFoundError:
-                logger.info("Ignoring PDU for unknown room_id: %s", room_id)
-                continue
-            except UnsupportedRoomVersionError as e:
-                # this can happen if support for a given room version is withdrawn,
-                # so that we still get events for said room.
-                logger.info("Ignoring PDU: %s", e)
+            if room_id not in room_versions:
+                try:
+                    room_versions[room_id] = await self.store.get_room_version(room_id)
+                except NotFoundError:
+                    logger.info("Ignoring PDU for unknown room_id: %s", room_id)
+                    room_versions[room_id] = None
+                except UnsupportedRoomVersionError as e:
+                    # this can happen if support for a given room version is
+                    # withdrawn, so that we still get events for said room.
+                    logger.info("Ignoring PDU: %s", e)
+                    room_versions[room_id] = None
+
+            room_version = room_versions[room_id]
+            if room_version is None:
                 continue
 
             event = event_from_pdu_json(p, room_version)
@@ -255,6 +381,13 @@ class FederationServer(FederationBase):
         # impose a limit to avoid going too crazy with ram/cpu.
 
         async def process_pdus_for_room(room_id):
+            with (await self._room_pdu_linearizer.queue((origin, room_id))):
+                with (await self._room_pdu_limiter.queue(())):
+                    start = self._clock.time()
+                    await _process_pdus_for_room(room_id)
+                    room_pdus_processing_time.observe(self._clock.time() - start)
+
+        async def _process_pdus_for_room(room_id):
             logger.debug("Processing PDUs for %s", room_id)
             try:
                 await self.check_server_matches_acl(origin_host, room_id)
@@ -283,10 +416,71 @@ class FederationServer(FederationBase):
                             exc_info=(f.type, f.value, f.getTracebackObject()),
                         )
 
-        await concurrently_execute(
-            process_pdus_for_room, pdus_by_room.keys(), TRANSACTION_CONCURRENCY_LIMIT
+        # We process the rooms in the background, so that we can respond to
+        # the transaction once we've run out of time even if we haven't
+        # finished with them all.
+        finished = defer.Deferred()
+
+        def on_finished(completed):
+            if not finished.called:
+                with PreserveLoggingContext():
+                    finished.callback(completed)
+
+        async def process_all_rooms():
+            try:
+                await concurrently_execute(
+                    process_pdus_for_room,
+                    pdus_by_room.keys(),
+                    TRANSACTION_CONCURRENCY_LIMIT,
+                )
+            except Exception:
+                if finished.called:
+                    raise
+                f = failure.Failure()
+                with PreserveLoggingContext():
+                    finished.errback(f)
+            else:
+                on_finished(True)
+
+        timer = self._clock.call_later(
+            self._transaction_time_budget_ms / 1000.0, on_finished, False
+        )
+        processing = run_as_background_process(
+            "fed_txn_process_rooms", process_all_rooms
         )
 
+        try:
+            completed = await make_deferred_yieldable(finished)
+        finally:
+            if timer.active():
+                timer.cancel()
+
+        if not completed:
+            transaction_time_budget_exceeded_counter.inc()
+            logger.warning(
+                "[%s] Ran out of time processing PDUs from %s: responding with "
+                "%d/%d results and processing the rest in the background",
+                transaction.transaction_id,
+                origin,
+                len(pdu_results),
+                sum(len(pdus) for pdus in pdus_by_room.values()),
+            )
+            if not processing.called:
+
+                def remove_backlog(res):
+                    if self._pdu_backlogs.get(origin) is backlog:
+                        del self._pdu_backlogs[origin]
+                    return res
+
+                # Make sure we've forgotten about the backlog before anything
+                # waiting for it carries on.
+                processing.addBoth(remove_backlog)
+                backlog = ObservableDeferred(processing, consumeErrors=True)
+                self._pdu_backlogs[origin] = backlog
+
+            # The background processing will carry on updating pdu_results.
+            return dict(pdu_results)
+
         return pdu_results
 
     async def _handle_edus_in_txn(self, origin: str, transaction: Transaction):
@@ -324,6 +518,18 @@ class FederationServer(FederationBase):
         # - but that's non-trivial to get right, and anyway somewhat defeats
         # the point of the linearizer.
         with (await self._server_linearizer.queue((origin, room_id))):
+            if event_id:
+                json_bytes = await self._encoded_resp_cache.wrap(
+                    room_id,
+                    ("state", event_id),
+                    self._encode_context_state_response,
+                    room_id,
+                    event_id,
+                )
+                return 200, EncodedJsonResponse(json_bytes)
+
+            # The current state of the room changes, so we only share the
+            # response between concurrent requests.
             resp = dict(
                 await self._state_resp_cache.wrap(
                     (room_id, event_id),
@@ -349,10 +555,29 @@ class FederationServer(FederationBase):
         if not in_room:
             raise AuthError(403, "Host not in room.")
 
+        json_bytes = await self._encoded_resp_cache.wrap(
+            room_id,
+            ("state_ids", event_id),
+            self._encode_state_ids_response,
+            room_id,
+            event_id,
+        )
+
+        return 200, EncodedJsonResponse(json_bytes)
+
+    async def _encode_state_ids_response(self, room_id, event_id):
         state_ids = await self.handler.get_state_ids_for_pdu(room_id, event_id)
         auth_chain_ids = await self.store.get_auth_chain_ids(state_ids)
 
-        return 200, {"pdu_ids": state_ids, "auth_chain_ids": auth_chain_ids}
+        return encode_canonical_json(
+            {"pdu_ids": state_ids, "auth_chain_ids": auth_chain_ids}
+        )
+
+    async def _encode_context_state_response(self, room_id, event_id):
+        resp = await self._on_context_state_request_compute(room_id, event_id)
+        resp["room_version"] = await self.store.get_room_version_id(room_id)
+
+        return encode_canonical_json(resp)
 
     async def _on_context_state_request_compute(self, room_id, event_id):
         if event_id:
@@ -31,6 +31,7 @@ Events are replicated via a separate events stream.
 
 import logging
 from collections import namedtuple
+from typing import Dict
 
 from six import iteritems
 
@@ -55,6 +56,11 @@ class FederationRemoteSendQueue(object):
         self.clock = hs.get_clock()
         self.notifier = hs.get_notifier()
         self.is_mine_id = hs.is_mine_id
+        self._federation_shard_config = hs.config.federation_shard_config
+
+        # The latest position acked by each federation sender instance, if
+        # sending federation is sharded.
+        self._federation_acks = {}  # type: Dict[str, int]
 
         self.presence_map = {}  # Pending presence map user_id -> UserPresenceState
         self.presence_changed = SortedDict()  # Stream position -> list[user_id]
@@ -246,7 +252,15 @@ class FederationRemoteSendQueue(object):
     def get_current_token(self):
         return self.pos - 1
 
-    def federation_ack(self, token):
+    def federation_ack(self, instance_name, token):
+        instances = self._federation_shard_config.instances
+        if instances:
+            # We can only clear what every instance has seen.
+            self._federation_acks[instance_name] = token
+            if not all(name in self._federation_acks for name in instances):
+                return
+            token = min(self._federation_acks[name] for name in instances)
+
         self._clear_queue_before_pos(token)
 
     async def get_replication_rows(
@@ -47,6 +47,12 @@ from synapse.util.metrics import Measure, measure_func
 
 logger = logging.getLogger(__name__)
 
+# How often to look for destinations which have events to be caught up on.
+CATCH_UP_WAKEUP_PERIOD_MS = 60 * 1000
+
+# How long to wait between waking up each batch of those destinations.
+CATCH_UP_WAKEUP_BATCH_INTERVAL_SEC = 1
+
 sent_pdus_destination_dist_count = Counter(
     "synapse_federation_client_sent_pdu_destinations:count",
     "Number of PDUs queued for sending to one or more destinations",
@@ -69,6 +75,9 @@ class FederationSender(object):
         self.clock = hs.get_clock()
         self.is_mine_id = hs.is_mine_id
 
+        self._instance_name = hs.config.federation_sender_instance_name
+        self._federation_shard_config = hs.config.federation_shard_config
+
         self._transaction_manager = TransactionManager(hs)
 
         # map from destination to PerDestinationQueue
@@ -126,6 +135,21 @@ class FederationSender(object):
             1000.0 / hs.config.federation_rr_transactions_per_room_per_second
         )
 
+        # Regularly wake up destinations which have events to be caught up on,
+        # as they may have come back since we last tried them.
+        self._catching_up_destinations = False
+        self.clock.looping_call(
+            self._start_wake_destinations_needing_catchup, CATCH_UP_WAKEUP_PERIOD_MS,
+        )
+
+    def _should_send_to(self, destination: str) -> bool:
+        """Whether this instance is responsible for sending to the destination,
+        if sending federation is sharded across several instances.
+        """
+        return self._federation_shard_config.should_handle(
+            self._instance_name, destination
+        )
+
     def _get_per_destination_queue(self, destination: str) -> PerDestinationQueue:
         """Get or create a PerDestinationQueue for the given destination
 
@@ -203,7 +227,7 @@ class FederationSender(object):
 
                     logger.debug("Sending %s to %r", event, destinations)
 
-                    self._send_pdu(event, destinations)
+                    await self._send_pdu(event, destinations)
 
                 async def handle_room_events(events: Iterable[EventBase]) -> None:
                     with Measure(self.clock, "handle_room_events"):
@@ -252,7 +276,7 @@ class FederationSender(object):
         finally:
             self._is_processing = False
 
-    def _send_pdu(self, pdu: EventBase, destinations: Iterable[str]) -> None:
+    async def _send_pdu(self, pdu: EventBase, destinations: Iterable[str]) -> None:
         # We loop through all destinations to see whether we already have
         # a transaction in progress. If we do, stick it in the pending_pdus
         # table and we'll get back to it later.
@@ -260,8 +284,9 @@ class FederationSender(object):
         order = self._order
         self._order += 1
 
-        destinations = set(destinations)
-        destinations.discard(self.server_name)
+        destinations = {
+            d for d in destinations if d != self.server_name and self._should_send_to(d)
+        }
         logger.debug("Sending to: %s", str(destinations))
 
         if not destinations:
@@ -270,6 +295,12 @@ class FederationSender(object):
         sent_pdus_destination_dist_total.inc(len(destinations))
         sent_pdus_destination_dist_count.inc()
 
+        # Record that each destination should get the event, so that any which
+        # are unreachable can be caught up on the room later.
+        await self.store.store_destination_rooms_entries(
+            destinations, pdu.room_id, pdu.internal_metadata.stream_ordering
+        )
+
         for destination in destinations:
             self._get_per_destination_queue(destination).send_pdu(pdu, order)
 
@@ -316,7 +347,9 @@ class FederationSender(object):
 
         # Work out which remote servers should be poked and poke them.
         domains = yield self.state.get_current_hosts_in_room(room_id)
-        domains = [d for d in domains if d != self.server_name]
+        domains = [
+            d for d in domains if d != self.server_name and self._should_send_to(d)
+        ]
         if not domains:
             return
 
@@ -421,6 +454,8 @@ class FederationSender(object):
         for destination in destinations:
             if destination == self.server_name:
                 continue
+            if not self._should_send_to(destination):
+                continue
             self._get_per_destination_queue(destination).send_presence(states)
 
     @measure_func("txnqueue._process_presence")
@@ -429,12 +464,14 @@ class FederationSender(object):
         """Given a list of states populate self.pending_presence_by_dest and
         poke to send a new transaction to each destination
         """
-        hosts_and_states = yield get_interested_remotes(self.store, states, self.state)
+        hosts_and_states = yield get_interested_remotes(self.store, states)
 
         for destinations, states in hosts_and_states:
             for destination in destinations:
                 if destination == self.server_name:
                     continue
+                if not self._should_send_to(destination):
+                    continue
                 self._get_per_destination_queue(destination).send_presence(states)
 
     def build_and_send_edu(
@@ -472,6 +509,9 @@ class FederationSender(object):
             edu: edu to send
             key: clobbering key for this edu
         """
+        if not self._should_send_to(edu.destination):
+            return
+
         queue = self._get_per_destination_queue(edu.destination)
         if key:
             queue.send_keyed_edu(edu, key)
@@ -483,6 +523,9 @@ class FederationSender(object):
             logger.warning("Not sending device update to ourselves")
             return
 
+        if not self._should_send_to(destination):
+            return
+
         self._get_per_destination_queue(destination).attempt_new_transaction()
 
     def wake_destination(self, destination: str):
@@ -496,7 +539,44 @@ class FederationSender(object):
             logger.warning("Not waking up ourselves")
             return
 
+        if not self._should_send_to(destination):
+            return
+
         self._get_per_destination_queue(destination).attempt_new_transaction()
 
     def get_current_token(self) -> int:
         return 0
+
+    def _start_wake_destinations_needing_catchup(self):
+        if self._catching_up_destinations:
+            return
+
+        return run_as_background_process(
+            "wake_destinations_needing_catchup",
+            self._wake_destinations_needing_catchup,
+        )
+
+    async def _wake_destinations_needing_catchup(self) -> None:
+        """Wake up the destinations which have events to be caught up on and which
+        we aren't backing off from, in batches.
+        """
+        self._catching_up_destinations = True
+        try:
+            last_processed = None  # type: Optional[str]
+            while True:
+                destinations = await self.store.get_catch_up_outstanding_destinations(
+                    last_processed
+                )
+                if not destinations:
+                    break
+
+                for destination in destinations:
+                    # Waking up a destination we're already sending to is a no-op.
+                    self.wake_destination(destination)
+
+                last_processed = destinations[-1]
+
+                # Spread the load of waking up lots of destinations out a bit.
+                await self.clock.sleep(CATCH_UP_WAKEUP_BATCH_INTERVAL_SEC)
+        finally:
+            self._catching_up_destinations = False
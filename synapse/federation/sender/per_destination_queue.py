@@ -15,7 +15,7 @@
 # limitations under the License.
 import datetime
 import logging
-from typing import Dict, Hashable, Iterable, List, Tuple
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
 
 from prometheus_client import Counter
 
@@ -37,6 +37,10 @@ from synapse.util.retryutils import NotRetryingDestination, get_retry_limiter
 # This is defined in the Matrix spec and enforced by the receiver.
 MAX_EDUS_PER_TRANSACTION = 100
 
+# If we're backing off from a destination for longer than this, we drop the EDUs
+# queued up for it rather than let them pile up indefinitely.
+DROP_EDUS_AFTER_RETRY_INTERVAL_MS = 60 * 60 * 1000
+
 logger = logging.getLogger(__name__)
 
 
@@ -50,11 +54,22 @@ sent_edus_by_type = Counter(
     ["type"],
 )
 
+catch_up_pdus_counter = Counter(
+    "synapse_federation_client_catch_up_pdus",
+    "Number of PDUs sent to destinations to catch them up after being unreachable",
+)
+
 
 class PerDestinationQueue(object):
     """
     Manages the per-destination transmission queues.
 
+    When we fail to send to a destination, we stop queueing PDUs for it in
+    memory and go into "catch-up" mode. Once we can reach it again, we send it
+    the latest event in each room it has missed events in, read from the
+    database, from which it can fetch anything else it missed itself. Then we
+    go back to sending it PDUs as they arrive.
+
     Args:
         hs
         transaction_sender
@@ -76,6 +91,20 @@ class PerDestinationQueue(object):
         self._destination = destination
         self.transmission_loop_running = False
 
+        # True whilst we are sending events that the remote homeserver missed
+        # because it was unreachable. We start in this state so that we check
+        # the database for anything it missed before we were restarted.
+        self._catching_up = True
+
+        # The stream ordering of the last PDU we skipped queueing because we
+        # were catching up.
+        self._catchup_last_skipped = 0
+
+        # The stream ordering of the last PDU we successfully sent, or None if
+        # we don't know it (yet).
+        self._last_successful_stream_ordering = None  # type: Optional[int]
+        self._loaded_last_successful_stream_ordering = False
+
         # a list of tuples of (pending pdu, order)
         self._pending_pdus = []  # type: List[Tuple[EventBase, int]]
         self._pending_edus = []  # type: List[Edu]
@@ -120,7 +149,14 @@ class PerDestinationQueue(object):
             pdu: pdu to send
             order
         """
-        self._pending_pdus.append((pdu, order))
+        if not self._catching_up or self._last_successful_stream_ordering is None:
+            # We only queue up the PDU if we aren't catching up, or don't know
+            # where to catch up from.
+            self._pending_pdus.append((pdu, order))
+        else:
+            # Otherwise the remote will get it (or a later event in the room)
+            # when we catch it up.
+            self._catchup_last_skipped = pdu.internal_metadata.stream_ordering
         self.attempt_new_transaction()
 
     def send_presence(self, states: Iterable[UserPresenceState]) -> None:
@@ -190,8 +226,21 @@ class PerDestinationQueue(object):
             # This will throw if we wouldn't retry. We do this here so we fail
             # quickly, but we will later check this again in the http client,
             # hence why we throw the result away.
+            if not self._loaded_last_successful_stream_ordering:
+                self._last_successful_stream_ordering = await self._store.get_destination_last_successful_stream_ordering(
+                    self._destination
+                )
+                self._loaded_last_successful_stream_ordering = True
+
             await get_retry_limiter(self._destination, self._clock, self._store)
 
+            if self._catching_up:
+                # We need to catch the remote up before we can send it anything
+                # else. If we fail to, we'll retry next time we're woken up.
+                await self._catch_up_transmission_loop()
+                if self._catching_up:
+                    return
+
             pending_pdus = []
             while True:
                 # We have to keep 2 free slots for presence and rr_edus
@@ -299,6 +348,14 @@ class PerDestinationQueue(object):
 
                     self._last_device_stream_id = device_stream_id
                     self._last_device_list_stream_id = dev_list_id
+
+                    if pending_pdus:
+                        await self._set_last_successful_stream_ordering(
+                            max(
+                                pdu.internal_metadata.stream_ordering
+                                for pdu, _ in pending_pdus
+                            )
+                        )
                 else:
                     break
         except NotRetryingDestination as e:
@@ -310,6 +367,22 @@ class PerDestinationQueue(object):
                     (e.retry_last_ts + e.retry_interval) / 1000.0
                 ),
             )
+
+            if e.retry_interval > DROP_EDUS_AFTER_RETRY_INTERVAL_MS:
+                # The destination has been down for a while, so drop the EDUs
+                # queued up for it rather than let them pile up. (The PDUs are
+                # dropped when we start catching up.)
+                logger.info(
+                    "TX [%s] dropping unsent EDUs as we won't retry for a while",
+                    self._destination,
+                )
+                self._pending_edus = []
+                self._pending_edus_keyed = {}
+                self._pending_presence = {}
+                self._pending_rrs = {}
+                self._rrs_pending_flush = False
+
+            self._start_catching_up(pending_pdus)
         except FederationDeniedError as e:
             logger.info(e)
         except HttpResponseException as e:
@@ -319,6 +392,7 @@ class PerDestinationQueue(object):
                 e.code,
                 e,
             )
+            self._start_catching_up(pending_pdus)
         except RequestSendFailed as e:
             logger.warning(
                 "TX [%s] Failed to send transaction: %s", self._destination, e
@@ -328,16 +402,107 @@ class PerDestinationQueue(object):
                 logger.info(
                     "Failed to send event %s to %s", p.event_id, self._destination
                 )
+            self._start_catching_up(pending_pdus)
         except Exception:
             logger.exception("TX [%s] Failed to send transaction", self._destination)
             for p, _ in pending_pdus:
                 logger.info(
                     "Failed to send event %s to %s", p.event_id, self._destination
                 )
+            self._start_catching_up(pending_pdus)
         finally:
             # We want to be *very* sure we clear this after we stop processing
             self.transmission_loop_running = False
 
+    async def _catch_up_transmission_loop(self) -> None:
+        """Send the remote the latest event in each room it missed events in
+        while we were unable to reach it, until it is caught up.
+        """
+        if self._last_successful_stream_ordering is None:
+            # We've never successfully sent the remote an event (or at least not
+            # since we started keeping track), so we don't know what it might
+            # have missed.
+            self._catching_up = False
+            return
+
+        while True:
+            last_skipped = self._catchup_last_skipped
+            rows = await self._store.get_catch_up_room_event_ids(
+                self._destination, self._last_successful_stream_ordering
+            )
+
+            if not rows:
+                if self._catchup_last_skipped != last_skipped:
+                    # We skipped an event whilst we were looking, which may not
+                    # have been recorded in time to be included, so check again.
+                    continue
+
+                self._catching_up = False
+                return
+
+            # We may have queued up PDUs before we knew we needed to catch up,
+            # but the remote will be sent the latest events instead.
+            self._pending_pdus = []
+
+            event_ids = [event_id for event_id, _ in rows]
+
+            # Any events which have been purged since we looked them up are
+            # skipped.
+            catch_up_pdus = await self._store.get_events_as_list(event_ids)
+            if catch_up_pdus:
+                success = await self._transaction_manager.send_new_transaction(
+                    self._destination,
+                    [
+                        (pdu, pdu.internal_metadata.stream_ordering)
+                        for pdu in catch_up_pdus
+                    ],
+                    [],
+                )
+                if success:
+                    sent_transactions_counter.inc()
+                    catch_up_pdus_counter.inc(len(catch_up_pdus))
+                else:
+                    # The remote rejected the transaction outright, so there is
+                    # no point trying to send it these events again.
+                    logger.warning(
+                        "TX [%s] Failed to catch up on events %s",
+                        self._destination,
+                        event_ids,
+                    )
+
+            await self._set_last_successful_stream_ordering(rows[-1][1])
+
+    def _start_catching_up(self, failed_pdus: List[Tuple[EventBase, int]]) -> None:
+        """Stop queueing up PDUs for the remote, as it will be caught up on
+        the rooms it has missed events in once we can reach it.
+
+        Args:
+            failed_pdus: The PDUs we failed to send to the remote.
+        """
+        self._catching_up = True
+
+        if (
+            self._last_successful_stream_ordering is None
+            and self._loaded_last_successful_stream_ordering
+        ):
+            # We've never successfully sent the remote anything, so catch it up
+            # from the earliest PDU we've tried to.
+            stream_orderings = [
+                pdu.internal_metadata.stream_ordering
+                for pdu, _ in failed_pdus + self._pending_pdus
+            ]
+            if stream_orderings:
+                self._last_successful_stream_ordering = min(stream_orderings) - 1
+
+        if self._last_successful_stream_ordering is not None:
+            self._pending_pdus = []
+
+    async def _set_last_successful_stream_ordering(self, stream_ordering: int) -> None:
+        self._last_successful_stream_ordering = stream_ordering
+        await self._store.set_destination_last_successful_stream_ordering(
+            self._destination, stream_ordering
+        )
+
     def _get_rr_edus(self, force_flush: bool) -> Iterable[Edu]:
         if not self._pending_rrs:
             return
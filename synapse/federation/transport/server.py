@@ -274,6 +274,10 @@ class BaseFederationServlet(object):
 
     PREFIX = FEDERATION_V1_PREFIX  # Allows specifying the API version
 
+    # How expensive requests to the servlet are to handle, relative to other
+    # requests, for sharing out the ratelimiter's concurrency budget fairly.
+    RATELIMIT_COST = 1
+
     def __init__(self, handler, authenticator, ratelimiter, server_name):
         self.handler = handler
         self.authenticator = authenticator
@@ -338,7 +342,7 @@ class BaseFederationServlet(object):
 
             with scope:
                 if origin:
-                    with ratelimiter.ratelimit(origin) as d:
+                    with ratelimiter.ratelimit(origin, self.RATELIMIT_COST) as d:
                         await d
                         response = await func(
                             origin, content, request.args, *args, **kwargs
@@ -440,6 +444,7 @@ class FederationEventServlet(BaseFederationServlet):
 
 class FederationStateV1Servlet(BaseFederationServlet):
     PATH = "/state/(?P<context>[^/]*)/?"
+    RATELIMIT_COST = 10
 
     # This is when someone asks for all data for a given context.
     async def on_GET(self, origin, content, query, context):
@@ -452,6 +457,7 @@ class FederationStateV1Servlet(BaseFederationServlet):
 
 class FederationStateIdsServlet(BaseFederationServlet):
     PATH = "/state_ids/(?P<room_id>[^/]*)/?"
+    RATELIMIT_COST = 5
 
     async def on_GET(self, origin, content, query, room_id):
         return await self.handler.on_state_ids_request(
@@ -463,6 +469,7 @@ class FederationStateIdsServlet(BaseFederationServlet):
 
 class FederationBackfillServlet(BaseFederationServlet):
     PATH = "/backfill/(?P<context>[^/]*)/?"
+    RATELIMIT_COST = 5
 
     async def on_GET(self, origin, content, query, context):
         versions = [x.decode("ascii") for x in query[b"v"]]
@@ -543,6 +550,7 @@ class FederationV2SendLeaveServlet(BaseFederationServlet):
 
 class FederationEventAuthServlet(BaseFederationServlet):
     PATH = "/event_auth/(?P<context>[^/]*)/(?P<event_id>[^/]*)"
+    RATELIMIT_COST = 5
 
     async def on_GET(self, origin, content, query, context, event_id):
         return await self.handler.on_event_auth(origin, context, event_id)
@@ -550,6 +558,7 @@ class FederationEventAuthServlet(BaseFederationServlet):
 
 class FederationV1SendJoinServlet(BaseFederationServlet):
     PATH = "/send_join/(?P<context>[^/]*)/(?P<event_id>[^/]*)"
+    RATELIMIT_COST = 10
 
     async def on_PUT(self, origin, content, query, context, event_id):
         # TODO(paul): assert that context/event_id parsed from path actually
@@ -563,6 +572,8 @@ class FederationV2SendJoinServlet(BaseFederationServlet):
 
     PREFIX = FEDERATION_V2_PREFIX
 
+    RATELIMIT_COST = 10
+
     async def on_PUT(self, origin, content, query, context, event_id):
         # TODO(paul): assert that context/event_id parsed from path actually
         #   match those given in content
@@ -646,6 +657,7 @@ class FederationClientKeysClaimServlet(BaseFederationServlet):
 class FederationGetMissingEventsServlet(BaseFederationServlet):
     # TODO(paul): Why does this path alone end with "/?" optional?
     PATH = "/get_missing_events/(?P<room_id>[^/]*)/?"
+    RATELIMIT_COST = 5
 
     async def on_POST(self, origin, content, query, room_id):
         limit = int(content.get("limit", 10))
@@ -26,6 +26,7 @@ from six import iteritems, itervalues
 from six.moves import http_client, zip
 
 import attr
+from prometheus_client import Counter
 from signedjson.key import decode_verify_key_bytes
 from signedjson.sign import verify_signed_json
 from unpaddedbase64 import decode_base64
@@ -56,6 +57,7 @@ from synapse.logging.context import (
     run_in_background,
 )
 from synapse.logging.utils import log_function
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.http.devices import ReplicationUserDevicesResyncRestServlet
 from synapse.replication.http.federation import (
     ReplicationCleanRoomRestServlet,
@@ -75,6 +77,25 @@ from ._base import BaseHandler
 
 logger = logging.getLogger(__name__)
 
+# The number of servers we ask for backfill at the same time.
+BACKFILL_CONCURRENCY = 3
+
+# The maximum number of events we ask each server for when backfilling.
+BACKFILL_LIMIT = 100
+
+# The number of backwards extremities of a backfilled chunk that we fetch the
+# state at in parallel.
+BACKFILL_STATE_CONCURRENCY = 5
+
+# The number of events from the auth chain and state of a room we are joining to
+# persist at a time.
+JOIN_PERSIST_BATCH_SIZE = 1000
+
+join_events_persisted_counter = Counter(
+    "synapse_handlers_federation_join_events_persisted",
+    "Number of auth chain and state events persisted when joining remote rooms",
+)
+
 
 @attr.s
 class _NewEventInfo:
@@ -172,6 +193,10 @@ class FederationHandler(BaseHandler):
         self.room_queues = {}
         self._room_pdu_linearizer = Linearizer("fed_room_pdu")
 
+        # We only backfill a room once at a time, so that a backfill requested
+        # by a client can make use of one we started in the background.
+        self._room_backfill_linearizer = Linearizer("fed_room_backfill")
+
         self.third_party_event_rules = hs.get_third_party_event_rules()
 
         self._ephemeral_messages_enabled = hs.config.enable_ephemeral_messages
@@ -826,6 +851,22 @@ class FederationHandler(BaseHandler):
             dest, room_id, limit=limit, extremities=extremities
         )
 
+        return await self._process_backfilled_events(dest, room_id, events)
+
+    async def _process_backfilled_events(
+        self, dest: str, room_id: str, events: List[EventBase]
+    ) -> List[EventBase]:
+        """Persist the events returned by a backfill request.
+
+        Args:
+            dest: The server the events came from, which we'll ask for any
+                state and auth events we're missing.
+            room_id: The room the events are in.
+            events: The events returned by the server.
+
+        Returns:
+            The events which we didn't already have.
+        """
         # ideally we'd sanity check the events here for excess prev_events etc,
         # but it's hard to reject events at this point without completely
         # breaking backfill in the same way that it is currently broken by
@@ -862,7 +903,8 @@ class FederationHandler(BaseHandler):
         auth_events = {}
         state_events = {}
         events_to_state = {}
-        for e_id in edges:
+
+        async def get_state_for_edge(e_id):
             state, auth = await self._get_state_for_room(
                 destination=dest,
                 room_id=room_id,
@@ -874,6 +916,10 @@ class FederationHandler(BaseHandler):
             state_events.update({s.event_id: s for s in state})
             events_to_state[e_id] = state
 
+        await concurrently_execute(
+            get_state_for_edge, edges, BACKFILL_STATE_CONCURRENCY
+        )
+
         required_auth = {
             a_id
             for event in events
@@ -933,6 +979,45 @@ class FederationHandler(BaseHandler):
     async def maybe_backfill(self, room_id, current_depth):
         """Checks the database to see if we should backfill before paginating,
         and if so do.
+
+        If we do backfill, we then start fetching the batch of events before
+        the ones we got in the background, ready for when the client carries
+        on paginating.
+        """
+        with (await self._room_backfill_linearizer.queue(room_id)):
+            result = await self._maybe_backfill_inner(room_id, current_depth)
+
+        if result is None or result is False:
+            return result
+
+        if result:
+            run_as_background_process(
+                "prefetch_backfill",
+                self._prefetch_backfill,
+                room_id,
+                min(event.depth for event in result),
+            )
+
+        return True
+
+    async def _prefetch_backfill(self, room_id, current_depth):
+        """Backfill the events that a client paginating back through a room
+        will want next.
+
+        Args:
+            room_id (str)
+            current_depth (int): the depth the client is likely to paginate
+                back from next.
+        """
+        with (await self._room_backfill_linearizer.queue(room_id)):
+            await self._maybe_backfill_inner(room_id, current_depth)
+
+    async def _maybe_backfill_inner(self, room_id, current_depth):
+        """Does the work of maybe_backfill.
+
+        Returns:
+            list[EventBase]|bool|None: the events we got if we backfilled,
+                False if we tried to and failed, or None if we didn't need to.
         """
         extremities = await self.store.get_oldest_events_with_depth_in_room(room_id)
 
@@ -1046,34 +1131,21 @@ class FederationHandler(BaseHandler):
         ]
 
         async def try_backfill(domains):
-            # TODO: Should we try multiple of these at a time?
-            for dom in domains:
+            # We ask several servers at once, and go with the first one to
+            # give us some events.
+            for i in range(0, len(domains), BACKFILL_CONCURRENCY):
+                response = await self._request_backfill_from_first(
+                    domains[i : i + BACKFILL_CONCURRENCY], room_id, extremities
+                )
+                if response is None:
+                    continue
+
+                dom, events = response
                 try:
-                    await self.backfill(
-                        dom, room_id, limit=100, extremities=extremities
-                    )
                     # If this succeeded then we probably already have the
                     # appropriate stuff.
                     # TODO: We can probably do something more intelligent here.
-                    return True
-                except SynapseError as e:
-                    logger.info("Failed to backfill from %s because %s", dom, e)
-                    continue
-                except CodeMessageException as e:
-                    if 400 <= e.code < 500:
-                        raise
-
-                    logger.info("Failed to backfill from %s because %s", dom, e)
-                    continue
-                except NotRetryingDestination as e:
-                    logger.info(str(e))
-                    continue
-                except RequestSendFailed as e:
-                    logger.info("Falied to get backfill from %s because %s", dom, e)
-                    continue
-                except FederationDeniedError as e:
-                    logger.info(e)
-                    continue
+                    return await self._process_backfilled_events(dom, room_id, events)
                 except Exception as e:
                     logger.exception("Failed to backfill from %s because %s", dom, e)
                     continue
@@ -1081,8 +1153,8 @@ class FederationHandler(BaseHandler):
             return False
 
         success = await try_backfill(likely_domains)
-        if success:
-            return True
+        if success is not False:
+            return success
 
         # Huh, well *those* domains didn't work out. Lets try some domains
         # from the time.
@@ -1123,13 +1195,82 @@ class FederationHandler(BaseHandler):
             success = await try_backfill(
                 [dom for dom, _ in likely_domains if dom not in tried_domains]
             )
-            if success:
-                return True
+            if success is not False:
+                return success
 
             tried_domains.update(dom for dom, _ in likely_domains)
 
         return False
 
+    async def _request_backfill_from_first(
+        self, domains: List[str], room_id: str, extremities: Iterable[str]
+    ) -> Optional[Tuple[str, List[EventBase]]]:
+        """Asks each of the given servers for the events before the given
+        backwards extremities at once, and returns the first response with
+        some events in.
+
+        Returns:
+            The server and the events it returned. If no server returned any
+            events, but one did respond, the server and an empty list. None
+            if all the requests failed.
+        """
+        if not domains:
+            return None
+
+        first_response = defer.Deferred()
+        outstanding = set(domains)
+        responded = []
+
+        def on_response(events, dom):
+            outstanding.discard(dom)
+            if first_response.called:
+                return
+
+            if events:
+                first_response.callback((dom, events))
+                return
+
+            if events is not None:
+                responded.append(dom)
+
+            if not outstanding:
+                first_response.callback((responded[0], []) if responded else None)
+
+        for dom in domains:
+            run_in_background(
+                self._request_backfill, dom, room_id, extremities
+            ).addCallback(on_response, dom)
+
+        return await make_deferred_yieldable(first_response)
+
+    async def _request_backfill(
+        self, dest: str, room_id: str, extremities: Iterable[str]
+    ) -> Optional[List[EventBase]]:
+        """Asks a server for the events before the given backwards extremities.
+
+        Returns:
+            The events, or None if the request failed.
+        """
+        try:
+            events = await self.federation_client.backfill(
+                dest, room_id, limit=BACKFILL_LIMIT, extremities=extremities
+            )
+            return events or []
+        except SynapseError as e:
+            logger.info("Failed to backfill from %s because %s", dest, e)
+        except CodeMessageException as e:
+            logger.info("Failed to backfill from %s because %s", dest, e)
+        except NotRetryingDestination as e:
+            logger.info(str(e))
+        except RequestSendFailed as e:
+            logger.info("Failed to get backfill from %s because %s", dest, e)
+        except FederationDeniedError as e:
+            logger.info(e)
+        except Exception as e:
+            logger.exception("Failed to backfill from %s because %s", dest, e)
+
+        return None
+
     async def _get_events_and_persist(
         self, destination: str, room_id: str, events: Iterable[str]
     ):
@@ -1905,9 +2046,12 @@ class FederationHandler(BaseHandler):
         room_version: RoomVersion,
     ) -> None:
         """Checks the auth chain is valid (and passes auth checks) for the
-        state and event. Then persists the auth chain and state atomically.
-        Persists the event separately. Notifies about the persisted events
-        where appropriate.
+        state and event. Then persists the auth chain and state in batches,
+        in topological order. Persists the event separately. Notifies about the
+        persisted events where appropriate.
+
+        The auth chain and state are all outliers, so it doesn't matter if we
+        fail part way through persisting them.
 
         Will attempt to fetch missing auth events.
 
@@ -1919,11 +2063,8 @@ class FederationHandler(BaseHandler):
             room_version: The room version we expect this room to have, and
                 will raise if it doesn't match the version in the create event.
         """
-        events_to_context = {}
         for e in itertools.chain(auth_events, state):
             e.internal_metadata.outlier = True
-            ctx = await self.state_handler.compute_event_context(e)
-            events_to_context[e.event_id] = ctx
 
         event_map = {
             e.event_id: e for e in itertools.chain(auth_events, state, [event])
@@ -1962,6 +2103,7 @@ class FederationHandler(BaseHandler):
             else:
                 logger.info("Failed to find auth event %r", e_id)
 
+        rejected_event_ids = set()
         for e in itertools.chain(auth_events, state, [event]):
             auth_for_e = {
                 (event_map[e_id].type, event_map[e_id].state_key): event_map[e_id]
@@ -1984,14 +2126,34 @@ class FederationHandler(BaseHandler):
 
                 if e == event:
                     raise
-                events_to_context[e.event_id].rejected = RejectedReason.AUTH_ERROR
+                rejected_event_ids.add(e.event_id)
 
-        await self.persist_events_and_notify(
-            [
-                (e, events_to_context[e.event_id])
-                for e in itertools.chain(auth_events, state)
-            ]
-        )
+        # The auth chain and state overlap, so make sure we only persist each
+        # event once. Sorting by depth means that each batch only refers to
+        # events in itself or earlier batches.
+        to_persist = {e.event_id: e for e in itertools.chain(auth_events, state)}
+        sorted_events = sorted(to_persist.values(), key=lambda e: e.depth)
+        del to_persist
+
+        for i in range(0, len(sorted_events), JOIN_PERSIST_BATCH_SIZE):
+            batch = sorted_events[i : i + JOIN_PERSIST_BATCH_SIZE]
+
+            events_and_contexts = []
+            for e in batch:
+                ctx = await self.state_handler.compute_event_context(e)
+                if e.event_id in rejected_event_ids:
+                    ctx.rejected = RejectedReason.AUTH_ERROR
+                events_and_contexts.append((e, ctx))
+
+            await self.persist_events_and_notify(events_and_contexts)
+
+            join_events_persisted_counter.inc(len(batch))
+            logger.info(
+                "Persisted %d/%d auth chain and state events for %s",
+                i + len(batch),
+                len(sorted_events),
+                event.room_id,
+            )
 
         new_event_context = await self.state_handler.compute_event_context(
             event, old_state=state
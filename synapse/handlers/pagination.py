@@ -260,6 +260,9 @@ class PaginationHandler(object):
         finally:
             self._purges_in_progress_by_room.discard(room_id)
 
+            # Some events may have been purged even if the purge failed.
+            self.hs.get_federation_server().invalidate_cached_responses(room_id)
+
             # remove the purge from the list 24 hours after it completes
             def clear_purge():
                 del self._purges_by_id[purge_id]
@@ -292,6 +295,7 @@ class PaginationHandler(object):
                 raise SynapseError(400, "Users are still joined to this room")
 
             await self.storage.purge_events.purge_room(room_id)
+            self.hs.get_federation_server().invalidate_cached_responses(room_id)
 
     async def get_messages(
         self,
@@ -354,12 +354,14 @@ class PresenceHandler(object):
             )
             self.external_process_last_updated_ms.pop(process_id)
 
+        # Users we don't have a state for are offline, and so have no timeouts.
         states = [
-            self.user_to_current_state.get(user_id, UserPresenceState.default(user_id))
+            self.user_to_current_state[user_id]
             for user_id in users_to_check
+            if user_id in self.user_to_current_state
         ]
 
-        timers_fired_counter.inc(len(states))
+        timers_fired_counter.inc(len(users_to_check))
 
         changes = handle_timeouts(
             states,
@@ -1273,7 +1275,7 @@ def get_interested_parties(store, states):
 
 
 @defer.inlineCallbacks
-def get_interested_remotes(store, states, state_handler):
+def get_interested_remotes(store, states):
     """Given a list of presence states figure out which remote servers
     should be sent which.
 
@@ -1288,19 +1290,20 @@ def get_interested_remotes(store, states, state_handler):
         each row the list of UserPresenceState should be sent to each
         destination
     """
-    hosts_and_states = []
-
-    # First we look up the rooms each user is in (as well as any explicit
-    # subscriptions), then for each distinct room we look up the remote
-    # hosts in those rooms.
-    room_ids_to_states, users_to_states = yield get_interested_parties(store, states)
-
-    for room_id, states in iteritems(room_ids_to_states):
-        hosts = yield state_handler.get_current_hosts_in_room(room_id)
-        hosts_and_states.append((hosts, states))
+    # The hosts which share a room with each user are cached, and the cache is
+    # invalidated as room memberships change, so we only need to look through
+    # the user's rooms when they have changed. We then group the states by
+    # destination, so that each destination is only poked once however many
+    # rooms it shares with the users.
+    states_by_host = {}  # type: Dict[str, List[UserPresenceState]]
+    for state in states:
+        hosts = yield store.get_hosts_who_share_room_with_user(state.user_id)
+        for host in hosts:
+            states_by_host.setdefault(host, []).append(state)
 
-    for user_id, states in iteritems(users_to_states):
-        host = get_domain_from_id(user_id)
-        hosts_and_states.append(([host], states))
+        # Always notify self
+        host = get_domain_from_id(state.user_id)
+        if host not in hosts:
+            states_by_host.setdefault(host, []).append(state)
 
-    return hosts_and_states
+    return [([host], host_states) for host, host_states in iteritems(states_by_host)]
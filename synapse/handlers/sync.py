@@ -24,6 +24,7 @@ import attr
 from prometheus_client import Counter
 
 from synapse.api.constants import EventTypes, Membership
+from synapse.api.errors import SynapseError
 from synapse.api.filtering import FilterCollection
 from synapse.events import EventBase
 from synapse.logging.context import LoggingContext
@@ -71,6 +72,45 @@ LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
 # avoiding redundantly sending the same lazy-loaded members to the client
 LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 100
 
+# Remember what we sent in the last sync for no more than this many devices, and
+# for no more than 30 minutes.
+SYNC_SNAPSHOT_CACHE_MAX_SIZE = 10000
+SYNC_SNAPSHOT_CACHE_MAX_AGE = 30 * 60 * 1000
+
+
+@attr.s(slots=True, frozen=True)
+class InitialSyncContinuation:
+    """Tracks the joined rooms that a bounded initial sync has yet to send.
+
+    The rooms the user was joined to at `stream_ordering` are ranked by the
+    stream ordering of their most recent event at that point, then by room ID,
+    and those ranked below `(before, before_room_id)` have not been sent yet.
+
+    Attributes:
+        stream_ordering: The room stream position the rooms were ranked at
+        before: The ranking stream ordering of the last room that was sent
+        before_room_id: The ID of the last room that was sent
+    """
+
+    # Separates the continuation from the stream token in a `next_batch`.
+    # Other users of the token ignore everything after it.
+    SEPARATOR = StreamToken.SUFFIX_SEPARATOR
+
+    stream_ordering = attr.ib(type=int)
+    before = attr.ib(type=int)
+    before_room_id = attr.ib(type=str)
+
+    @classmethod
+    def from_string(cls, string: str) -> "InitialSyncContinuation":
+        try:
+            stream_ordering, before, before_room_id = string.split(".", 2)
+            return cls(int(stream_ordering), int(before), before_room_id)
+        except Exception:
+            raise SynapseError(400, "Invalid Token")
+
+    def to_string(self) -> str:
+        return "%d.%d.%s" % (self.stream_ordering, self.before, self.before_room_id)
+
 
 @attr.s(slots=True, frozen=True)
 class SyncConfig:
@@ -79,6 +119,9 @@ class SyncConfig:
     is_guest = attr.ib(type=bool)
     request_key = attr.ib(type=Tuple[Any, ...])
     device_id = attr.ib(type=str)
+    initial_sync_continuation = attr.ib(
+        type=Optional[InitialSyncContinuation], default=None
+    )
 
 
 @attr.s(slots=True, frozen=True)
@@ -191,6 +234,21 @@ class _RoomChanges:
     newly_left_rooms = attr.ib(type=List[str])
 
 
+@attr.s(slots=True, frozen=True)
+class _SyncSnapshot:
+    """What we remember about the last sync result returned to a device, so
+    that the next incremental sync can be worked out by applying the changes
+    since then.
+
+    Attributes:
+        next_batch: The token that was returned to the client
+        joined_room_ids: The rooms the user was joined to at `next_batch`
+    """
+
+    next_batch = attr.ib(type=StreamToken)
+    joined_room_ids = attr.ib(type=FrozenSet[str])
+
+
 @attr.s(slots=True, frozen=True)
 class SyncResult:
     """
@@ -206,6 +264,8 @@ class SyncResult:
         device_one_time_keys_count: Dict of algorithm to count for one time keys
             for this device
         groups: Group updates, if any
+        initial_sync_continuation: Where to carry on sending the user's joined
+            rooms from, if a bounded initial sync hasn't sent them all yet
     """
 
     next_batch = attr.ib(type=StreamToken)
@@ -218,6 +278,9 @@ class SyncResult:
     device_lists = attr.ib(type=DeviceLists)
     device_one_time_keys_count = attr.ib(type=JsonDict)
     groups = attr.ib(type=Optional[GroupsSyncResult])
+    initial_sync_continuation = attr.ib(
+        type=Optional[InitialSyncContinuation], default=None
+    )
 
     def __nonzero__(self) -> bool:
         """Make the result appear empty if there are no updates. This is used
@@ -260,6 +323,14 @@ class SyncHandler(object):
             expiry_ms=LAZY_LOADED_MEMBERS_CACHE_MAX_AGE,
         )
 
+        # ExpiringCache((User, Device)) -> _SyncSnapshot
+        self.sync_snapshot_cache = ExpiringCache(
+            "sync_snapshot_cache",
+            self.clock,
+            max_len=SYNC_SNAPSHOT_CACHE_MAX_SIZE,
+            expiry_ms=SYNC_SNAPSHOT_CACHE_MAX_AGE,
+        )
+
     async def wait_for_sync_for_user(
         self,
         sync_config: SyncConfig,
@@ -305,9 +376,16 @@ class SyncHandler(object):
         if context:
             context.tag = sync_type
 
-        if timeout == 0 or since_token is None or full_state:
+        if (
+            timeout == 0
+            or since_token is None
+            or full_state
+            or sync_config.initial_sync_continuation
+        ):
             # we are going to return immediately, so don't bother calling
-            # notifier.wait_for_events.
+            # notifier.wait_for_events. Continuations of an initial sync
+            # always have more rooms to send, so shouldn't wait for new
+            # events either.
             result = await self.current_sync_for_user(
                 sync_config, since_token, full_state=full_state
             )
@@ -933,25 +1011,19 @@ class SyncHandler(object):
             if e.type != EventTypes.Aliases  # until MSC2261 or alternative solution
         }
 
-    async def unread_notifs_for_room_id(
-        self, room_id: str, sync_config: SyncConfig
-    ) -> Optional[Dict[str, str]]:
-        with Measure(self.clock, "unread_notifs_for_room_id"):
-            last_unread_event_id = await self.store.get_last_receipt_event_id_for_user(
-                user_id=sync_config.user.to_string(),
-                room_id=room_id,
-                receipt_type="m.read",
-            )
-
-            if last_unread_event_id:
-                notifs = await self.store.get_unread_event_push_actions_by_room_for_user(
-                    room_id, sync_config.user.to_string(), last_unread_event_id
-                )
-                return notifs
+    async def unread_notifs_for_room_ids(
+        self, room_ids: Collection[str], sync_config: SyncConfig
+    ) -> Dict[str, Dict[str, int]]:
+        """Gets the unread notification counts for the given rooms.
 
-        # There is no new information in this period, so your notification
-        # count is whatever it was last time.
-        return None
+        Rooms the user hasn't read anything in are omitted, as there is no new
+        information and so their notification counts are whatever they were
+        last time.
+        """
+        with Measure(self.clock, "unread_notifs_for_room_ids"):
+            return await self.store.get_unread_event_push_actions_by_rooms_for_user(
+                room_ids, sync_config.user.to_string()
+            )
 
     async def generate_sync_result(
         self,
@@ -980,16 +1052,38 @@ class SyncHandler(object):
             # We no longer support AS users using /sync directly.
             # See https://github.com/matrix-org/matrix-doc/issues/1144
             raise NotImplementedError()
-        else:
+
+        snapshot_key = (user_id, sync_config.device_id)
+        snapshot = self.sync_snapshot_cache.get(snapshot_key)
+
+        membership_change_events = None  # type: Optional[List[EventBase]]
+        joined_room_ids = None  # type: Optional[FrozenSet[str]]
+        if (
+            since_token
+            and snapshot
+            and snapshot.next_batch.room_key == since_token.room_key
+        ):
+            # The client is syncing from the last token we gave it, so we can
+            # carry the joined rooms forward if the user's membership hasn't
+            # changed in the meantime.
+            membership_change_events = await self.store.get_membership_changes_for_user(
+                user_id, since_token.room_key, now_token.room_key
+            )
+            if not membership_change_events:
+                joined_room_ids = snapshot.joined_room_ids
+
+        if joined_room_ids is None:
             joined_room_ids = await self.get_rooms_for_user_at(
                 user_id, now_token.room_stream_id
             )
+
         sync_result_builder = SyncResultBuilder(
             sync_config,
             full_state,
             since_token=since_token,
             now_token=now_token,
             joined_room_ids=joined_room_ids,
+            membership_change_events=membership_change_events,
         )
 
         account_data_by_room = await self._generate_sync_entry_for_account_data(
@@ -1037,6 +1131,10 @@ class SyncHandler(object):
                     "Sync result for newly joined room %s: %r", room_id, joined_room
                 )
 
+        self.sync_snapshot_cache[snapshot_key] = _SyncSnapshot(
+            next_batch=sync_result_builder.now_token, joined_room_ids=joined_room_ids,
+        )
+
         return SyncResult(
             presence=sync_result_builder.presence,
             account_data=sync_result_builder.account_data,
@@ -1048,6 +1146,7 @@ class SyncHandler(object):
             groups=sync_result_builder.groups,
             device_one_time_keys_count=one_time_key_counts,
             next_batch=sync_result_builder.now_token,
+            initial_sync_continuation=sync_result_builder.initial_sync_continuation,
         )
 
     @measure_func("_generate_sync_entry_for_groups")
@@ -1363,7 +1462,8 @@ class SyncHandler(object):
         # We check up front if anything has changed, if it hasn't then there is
         # no point in going futher.
         since_token = sync_result_builder.since_token
-        if not sync_result_builder.full_state:
+        continuation = sync_result_builder.sync_config.initial_sync_continuation
+        if not sync_result_builder.full_state and not continuation:
             if since_token and not ephemeral_by_room and not account_data_by_room:
                 have_changed = await self._have_rooms_changed(sync_result_builder)
                 if not have_changed:
@@ -1400,6 +1500,25 @@ class SyncHandler(object):
         newly_joined_rooms = room_changes.newly_joined_rooms
         newly_left_rooms = room_changes.newly_left_rooms
 
+        if since_token and continuation and not sync_result_builder.full_state:
+            room_entries = await self._continue_initial_sync(
+                sync_result_builder, room_entries, continuation, account_data_by_room
+            )
+
+        if since_token and not sync_result_builder.full_state:
+            # Only look at rooms that have had something happen in them since
+            # the last sync, rather than going through every joined room.
+            room_entries = [
+                room_entry
+                for room_entry in room_entries
+                if room_entry.events != []
+                or room_entry.newly_joined
+                or room_entry.full_state
+                or room_entry.room_id in ephemeral_by_room
+                or room_entry.room_id in account_data_by_room
+                or room_entry.room_id in tags_by_room
+            ]
+
         def handle_room_entries(room_entry):
             return self._generate_room_entry(
                 sync_result_builder,
@@ -1413,6 +1532,19 @@ class SyncHandler(object):
 
         await concurrently_execute(handle_room_entries, room_entries, 10)
 
+        # Fill in the notification counts for all the joined rooms in one go,
+        # rather than looking them up a room at a time.
+        notifs_by_room = await self.unread_notifs_for_room_ids(
+            [room_sync.room_id for room_sync in sync_result_builder.joined],
+            sync_result_builder.sync_config,
+        )
+        for room_sync in sync_result_builder.joined:
+            notifs = notifs_by_room.get(room_sync.room_id)
+            if notifs is not None:
+                unread_notifications = room_sync.unread_notifications
+                unread_notifications["notification_count"] = notifs["notify_count"]
+                unread_notifications["highlight_count"] = notifs["highlight_count"]
+
         sync_result_builder.invited.extend(invited)
 
         # Now we want to get any newly joined or invited users
@@ -1451,16 +1583,12 @@ class SyncHandler(object):
         """Returns whether there may be any new events that should be sent down
         the sync. Returns True if there are.
         """
-        user_id = sync_result_builder.sync_config.user.to_string()
         since_token = sync_result_builder.since_token
-        now_token = sync_result_builder.now_token
 
         assert since_token
 
         # Get a list of membership change events that have happened.
-        rooms_changed = await self.store.get_membership_changes_for_user(
-            user_id, since_token.room_key, now_token.room_key
-        )
+        rooms_changed = await self._get_membership_change_events(sync_result_builder)
 
         if rooms_changed:
             return True
@@ -1471,6 +1599,26 @@ class SyncHandler(object):
                 return True
         return False
 
+    async def _get_membership_change_events(
+        self, sync_result_builder: "SyncResultBuilder"
+    ) -> List[EventBase]:
+        """Returns the membership events for the user between the since and now
+        tokens, fetching them if we haven't already.
+        """
+        if sync_result_builder.membership_change_events is None:
+            user_id = sync_result_builder.sync_config.user.to_string()
+            since_token = sync_result_builder.since_token
+            now_token = sync_result_builder.now_token
+
+            assert since_token
+
+            events = await self.store.get_membership_changes_for_user(
+                user_id, since_token.room_key, now_token.room_key
+            )
+            sync_result_builder.membership_change_events = events
+
+        return sync_result_builder.membership_change_events
+
     async def _get_rooms_changed(
         self, sync_result_builder: "SyncResultBuilder", ignored_users: Set[str]
     ) -> _RoomChanges:
@@ -1484,9 +1632,7 @@ class SyncHandler(object):
         assert since_token
 
         # Get a list of membership change events that have happened.
-        rooms_changed = await self.store.get_membership_changes_for_user(
-            user_id, since_token.room_key, now_token.room_key
-        )
+        rooms_changed = await self._get_membership_change_events(sync_result_builder)
 
         mem_change_events_by_room_id = {}  # type: Dict[str, List[EventBase]]
         for event in rooms_changed:
@@ -1745,8 +1891,117 @@ class SyncHandler(object):
                     )
                 )
 
+        # Full state incremental syncs aren't limited, as the client already
+        # knows about the rooms.
+        room_limit = sync_config.filter_collection.initial_sync_room_limit
+        joined_entries = [e for e in room_entries if e.rtype == "joined"]
+        if since_token is None and room_limit and len(joined_entries) > room_limit:
+            # Only send the most recently active rooms now, and leave the rest
+            # for the following syncs.
+            ranked = await self._rank_rooms_by_recency(
+                [e.room_id for e in joined_entries], now_token.room_stream_id
+            )
+            to_send, continuation = _take_initial_sync_rooms(
+                ranked, room_limit, now_token.room_stream_id
+            )
+            room_entries = [
+                e for e in room_entries if e.rtype != "joined" or e.room_id in to_send
+            ]
+            sync_result_builder.initial_sync_continuation = continuation
+
         return _RoomChanges(room_entries, invited, [], [])
 
+    async def _continue_initial_sync(
+        self,
+        sync_result_builder: "SyncResultBuilder",
+        room_entries: List["RoomSyncResultBuilder"],
+        continuation: InitialSyncContinuation,
+        account_data_by_room: Dict[str, Dict[str, JsonDict]],
+    ) -> List["RoomSyncResultBuilder"]:
+        """Adds the next batch of the joined rooms that a bounded initial sync
+        has yet to send, with full state, to the room entries.
+
+        Rooms which still haven't been sent are dropped from the entries, as the
+        client doesn't know about them yet. The continuation for the next sync is
+        set on the `sync_result_builder`.
+
+        Args:
+            sync_result_builder
+            room_entries: The entries for the rooms that have changed
+            continuation: Which joined rooms have yet to be sent
+            account_data_by_room: Dictionary of per room account data, which
+                gets all account data added for the rooms being sent.
+
+        Returns:
+            The updated room entries
+        """
+        user_id = sync_result_builder.sync_config.user.to_string()
+        now_token = sync_result_builder.now_token
+        room_limit = (
+            sync_result_builder.sync_config.filter_collection.initial_sync_room_limit
+        )
+
+        # Rooms that have been joined since the initial sync get sent down as
+        # newly joined rooms instead, and we no longer care about those that
+        # have been left.
+        joined_at_continuation = await self.get_rooms_for_user_at(
+            user_id, continuation.stream_ordering
+        )
+        room_ids = [
+            room_id
+            for room_id in joined_at_continuation
+            if room_id in sync_result_builder.joined_room_ids
+        ]
+
+        ranked = await self._rank_rooms_by_recency(
+            room_ids, continuation.stream_ordering
+        )
+        last_sent = (continuation.before, continuation.before_room_id)
+        pending = [rank for rank in ranked if rank < last_sent]
+        pending_room_ids = {room_id for _, room_id in pending}
+
+        (
+            to_send,
+            sync_result_builder.initial_sync_continuation,
+        ) = _take_initial_sync_rooms(pending, room_limit, continuation.stream_ordering)
+
+        room_entries = [e for e in room_entries if e.room_id not in pending_room_ids]
+        for room_id in to_send:
+            account_data_by_room[room_id] = await self.store.get_account_data_for_room(
+                user_id, room_id
+            )
+            room_entries.append(
+                RoomSyncResultBuilder(
+                    room_id=room_id,
+                    rtype="joined",
+                    events=None,
+                    newly_joined=False,
+                    full_state=True,
+                    since_token=None,
+                    upto_token=now_token,
+                )
+            )
+
+        return room_entries
+
+    async def _rank_rooms_by_recency(
+        self, room_ids: List[str], stream_ordering: int
+    ) -> List[Tuple[int, str]]:
+        """Ranks rooms by the stream ordering of their most recent event at or
+        before the given stream ordering, most recently active first. Rooms
+        with the same stream ordering are ranked by room ID.
+
+        Returns:
+            A `(stream_ordering, room_id)` tuple for each room
+        """
+        last_orderings = await self.store.get_last_event_stream_orderings_for_rooms(
+            room_ids, stream_ordering
+        )
+        return sorted(
+            ((last_orderings.get(room_id, 0), room_id) for room_id in room_ids),
+            reverse=True,
+        )
+
     async def _generate_room_entry(
         self,
         sync_result_builder: "SyncResultBuilder",
@@ -1869,24 +2124,19 @@ class SyncHandler(object):
             )
 
         if room_builder.rtype == "joined":
-            unread_notifications = {}  # type: Dict[str, str]
             room_sync = JoinedSyncResult(
                 room_id=room_id,
                 timeline=batch,
                 state=state,
                 ephemeral=ephemeral,
                 account_data=account_data_events,
-                unread_notifications=unread_notifications,
+                unread_notifications={},
                 summary=summary,
             )
 
             if room_sync or always_include:
-                notifs = await self.unread_notifs_for_room_id(room_id, sync_config)
-
-                if notifs is not None:
-                    unread_notifications["notification_count"] = notifs["notify_count"]
-                    unread_notifications["highlight_count"] = notifs["highlight_count"]
-
+                # The notification counts get filled in once all the rooms have
+                # been generated.
                 sync_result_builder.joined.append(room_sync)
 
             if batch.limited and since_token:
@@ -1951,6 +2201,32 @@ class SyncHandler(object):
         return frozenset(joined_room_ids)
 
 
+def _take_initial_sync_rooms(
+    ranked: List[Tuple[int, str]], limit: Optional[int], stream_ordering: int
+) -> Tuple[Set[str], Optional[InitialSyncContinuation]]:
+    """Picks which of the ranked rooms to send in a bounded initial sync.
+
+    Args:
+        ranked: `(stream_ordering, room_id)` for each room yet to be sent, most
+            recently active first
+        limit: The maximum number of rooms to send, or None for no limit
+        stream_ordering: The room stream position the rooms were ranked at
+
+    Returns:
+        The rooms to send, and where to continue from in the next sync if there
+        are rooms left over.
+    """
+    if not limit or len(ranked) <= limit:
+        return {room_id for _, room_id in ranked}, None
+
+    to_send = ranked[:limit]
+    before, before_room_id = to_send[-1]
+    continuation = InitialSyncContinuation(
+        stream_ordering=stream_ordering, before=before, before_room_id=before_room_id
+    )
+    return {room_id for _, room_id in to_send}, continuation
+
+
 def _action_has_highlight(actions: List[JsonDict]) -> bool:
     for action in actions:
         try:
@@ -2026,6 +2302,10 @@ class SyncResultBuilder:
         since_token: The token supplied by user, or None.
         now_token: The token to sync up to.
         joined_room_ids: List of rooms the user is joined to
+        membership_change_events: The user's membership events between the
+            since and now tokens, or None if they haven't been fetched yet.
+        initial_sync_continuation: Where the next sync should carry on sending
+            joined rooms from, if they haven't all been sent yet.
 
         # The following mirror the fields in a sync response
         presence (list)
@@ -2042,6 +2322,10 @@ class SyncResultBuilder:
     since_token = attr.ib(type=Optional[StreamToken])
     now_token = attr.ib(type=StreamToken)
     joined_room_ids = attr.ib(type=FrozenSet[str])
+    membership_change_events = attr.ib(type=Optional[List[EventBase]], default=None)
+    initial_sync_continuation = attr.ib(
+        type=Optional[InitialSyncContinuation], default=None
+    )
 
     presence = attr.ib(type=List[JsonDict], default=attr.Factory(list))
     account_data = attr.ib(type=List[JsonDict], default=attr.Factory(list))
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from typing import Dict
+
+from prometheus_client import Counter
+
+from twisted.web.client import HTTPConnectionPool
+
+from synapse.logging.context import make_deferred_yieldable
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
+
+logger = logging.getLogger(__name__)
+
+connections_counter = Counter(
+    "synapse_http_federation_connections",
+    "Number of connections used for outbound federation requests, by whether "
+    "they were reused from the pool, newly opened or opened in advance",
+    ["type"],
+)
+
+# How often we adjust the number of connections to keep for each destination,
+# and open connections to the most active destinations in advance.
+POOL_SWEEP_INTERVAL_MS = 60 * 1000
+
+
+class _DestinationConnections(object):
+    """Tracks how a destination's connections are being used.
+
+    Attributes:
+        endpoint (IStreamClientEndpoint): The endpoint we last connected to the
+            destination with.
+        in_use (set[HTTP11ClientProtocol]): The connections currently being
+            used for requests.
+        peak_in_use (int): The most connections in use at once since the last
+            sweep.
+        requests (int): The number of requests since the last sweep.
+        last_used_ms (int): When we last made a request to the destination.
+    """
+
+    __slots__ = ["endpoint", "in_use", "peak_in_use", "requests", "last_used_ms"]
+
+    def __init__(self, endpoint, now_ms):
+        self.endpoint = endpoint
+        self.in_use = set()
+        self.peak_in_use = 0
+        self.requests = 0
+        self.last_used_ms = now_ms
+
+
+class FederationConnectionPool(HTTPConnectionPool):
+    """An HTTPConnectionPool which adapts the number of idle connections it
+    keeps to each destination to how busy that destination is.
+
+    We keep as many idle connections to a destination as it has recently had
+    requests in flight at once, up to `max_per_destination`, so that busy
+    destinations don't have to keep opening new connections and quiet ones
+    don't hold on to several sockets. Idle connections are closed after
+    `idle_timeout_ms`, and if there are more than `max_idle_connections` in
+    total those to the least recently used destinations are closed first, to
+    bound the number of file descriptors we use when talking to a lot of
+    servers.
+
+    We also open a connection in advance to each of the `prewarm_destinations`
+    destinations with the most requests which has none idle.
+    """
+
+    retryAutomatically = False
+
+    def __init__(
+        self,
+        reactor,
+        clock,
+        max_per_destination,
+        idle_timeout_ms,
+        max_idle_connections,
+        prewarm_destinations,
+    ):
+        """
+        Args:
+            reactor (IReactorTime)
+            clock (synapse.util.Clock)
+            max_per_destination (int): The most idle connections to keep to
+                a destination.
+            idle_timeout_ms (int): How long to keep idle connections for.
+            max_idle_connections (int): The most idle connections to keep in
+                total.
+            prewarm_destinations (int): The number of the most active
+                destinations to open connections to in advance.
+        """
+        super(FederationConnectionPool, self).__init__(reactor)
+
+        self._clock = clock
+        self.maxPersistentPerHost = max_per_destination
+        self.cachedConnectionTimeout = idle_timeout_ms / 1000.0
+        self._idle_timeout_ms = idle_timeout_ms
+        self._max_idle_connections = max_idle_connections
+        self._prewarm_destinations = prewarm_destinations
+
+        self._destinations = {}  # type: Dict[tuple, _DestinationConnections]
+
+        # The number of connections we have opened, used to tell whether
+        # `getConnection` reused one.
+        self._new_connections = 0
+
+        LaterGauge(
+            "synapse_http_federation_idle_connections",
+            "Number of idle connections kept open for outbound federation requests",
+            [],
+            self._count_idle_connections,
+        )
+
+        self._clock.looping_call(self._sweep, POOL_SWEEP_INTERVAL_MS)
+
+    def getConnection(self, key, endpoint):
+        now = self._clock.time_msec()
+
+        destination = self._destinations.get(key)
+        if destination is None:
+            destination = self._destinations[key] = _DestinationConnections(
+                endpoint, now
+            )
+        destination.endpoint = endpoint
+        destination.requests += 1
+        destination.last_used_ms = now
+
+        new_connections = self._new_connections
+        d = super(FederationConnectionPool, self).getConnection(key, endpoint)
+        if self._new_connections == new_connections:
+            connections_counter.labels("reused").inc()
+        else:
+            connections_counter.labels("new").inc()
+
+        d.addCallback(self._on_connection, destination)
+        return d
+
+    def _on_connection(self, connection, destination):
+        destination.in_use.add(connection)
+        _prune_lost_connections(destination.in_use)
+        destination.peak_in_use = max(destination.peak_in_use, len(destination.in_use))
+        return connection
+
+    def _newConnection(self, key, endpoint):
+        self._new_connections += 1
+        return super(FederationConnectionPool, self)._newConnection(key, endpoint)
+
+    def _putConnection(self, key, connection):
+        destination = self._destinations.get(key)
+        if destination is not None:
+            destination.in_use.discard(connection)
+
+        if connection.state == "QUIESCENT":
+            # Make room for the connection if we already have as many idle
+            # connections to the destination as we want to keep.
+            self._trim_idle_connections(key, self._idle_limit(key) - 1)
+
+        super(FederationConnectionPool, self)._putConnection(key, connection)
+
+    def _idle_limit(self, key):
+        """The number of idle connections to keep to a destination."""
+        destination = self._destinations.get(key)
+        peak_in_use = destination.peak_in_use if destination else 0
+        return max(1, min(peak_in_use, self.maxPersistentPerHost))
+
+    def _trim_idle_connections(self, key, limit):
+        """Close the oldest idle connections to a destination until there are
+        at most `limit`.
+        """
+        connections = self._connections.get(key, [])
+        while len(connections) > max(limit, 0):
+            # This is what HTTPConnectionPool does when it has too many
+            # connections to a destination: `_removeConnection` would leave the
+            # idle timeout running.
+            dropped = connections.pop(0)
+            dropped.transport.loseConnection()
+            self._timeouts[dropped].cancel()
+            del self._timeouts[dropped]
+
+    def _count_idle_connections(self):
+        return sum(len(connections) for connections in self._connections.values())
+
+    def _sweep(self):
+        now = self._clock.time_msec()
+
+        most_active = []
+        for key, destination in list(self._destinations.items()):
+            _prune_lost_connections(destination.in_use)
+
+            if destination.requests:
+                most_active.append((destination.requests, key, destination.endpoint))
+
+            # The peak usage since the last sweep decides how many idle
+            # connections we keep until the next one.
+            self._trim_idle_connections(key, self._idle_limit(key))
+            destination.peak_in_use = len(destination.in_use)
+            destination.requests = 0
+
+            if (
+                not destination.in_use
+                and not self._connections.get(key)
+                and now - destination.last_used_ms > self._idle_timeout_ms
+            ):
+                del self._destinations[key]
+
+        # Close the idle connections to the least recently used destinations if
+        # we have too many.
+        excess = self._count_idle_connections() - self._max_idle_connections
+        if excess > 0:
+
+            def last_used_ms(key):
+                destination = self._destinations.get(key)
+                return destination.last_used_ms if destination else 0
+
+            by_last_used = sorted(
+                (key for key in self._connections if self._connections[key]),
+                key=last_used_ms,
+            )
+            for key in by_last_used:
+                if excess <= 0:
+                    break
+                closing = min(excess, len(self._connections[key]))
+                self._trim_idle_connections(key, len(self._connections[key]) - closing)
+                excess -= closing
+
+        # We may have forgotten about some of these destinations above, so we
+        # use the endpoints we noted down for them.
+        most_active.sort(key=lambda entry: entry[:2], reverse=True)
+        for _, key, endpoint in most_active[: self._prewarm_destinations]:
+            if self._connections.get(key):
+                continue
+            run_as_background_process(
+                "prewarm_federation_connection",
+                self._prewarm_connection,
+                key,
+                endpoint,
+            )
+
+    async def _prewarm_connection(self, key, endpoint):
+        try:
+            connection = await make_deferred_yieldable(
+                self._newConnection(key, endpoint)
+            )
+        except Exception as e:
+            logger.debug("Failed to open connection to %s in advance: %s", key, e)
+            return
+
+        connections_counter.labels("prewarmed").inc()
+        self._putConnection(key, connection)
+
+
+def _prune_lost_connections(connections):
+    """Remove the connections which have been closed from a set of connections.
+
+    Args:
+        connections (set[HTTP11ClientProtocol])
+    """
+    lost = [c for c in connections if c.state == "CONNECTION_LOST"]
+    connections.difference_update(lost)
@@ -55,6 +55,13 @@ class MatrixFederationAgent(object):
         _well_known_resolver (WellKnownResolver|None):
             WellKnownResolver to use to perform well-known lookups. None to use a
             default implementation.
+
+        pool (HTTPConnectionPool|None): the connection pool to use. None to
+            use a default pool.
+
+        store (synapse.storage.DataStore|None): datastore for the default
+            resolvers to store their results in, so that they survive restarts
+            and are shared between workers. None to only cache them in memory.
     """
 
     def __init__(
@@ -63,13 +70,21 @@ class MatrixFederationAgent(object):
         tls_client_options_factory,
         _srv_resolver=None,
         _well_known_resolver=None,
+        pool=None,
+        store=None,
     ):
         self._reactor = reactor
         self._clock = Clock(reactor)
-        self._pool = HTTPConnectionPool(reactor)
-        self._pool.retryAutomatically = False
-        self._pool.maxPersistentPerHost = 5
-        self._pool.cachedConnectionTimeout = 2 * 60
+
+        if pool is None:
+            pool = HTTPConnectionPool(reactor)
+            pool.retryAutomatically = False
+            pool.maxPersistentPerHost = 5
+            pool.cachedConnectionTimeout = 2 * 60
+        self._pool = pool
+
+        if _srv_resolver is None:
+            _srv_resolver = SrvResolver(store=store)
 
         self._agent = Agent.usingEndpointFactory(
             self._reactor,
@@ -87,6 +102,7 @@ class MatrixFederationAgent(object):
                     pool=self._pool,
                     contextFactory=tls_client_options_factory,
                 ),
+                store=store,
             )
 
         self._well_known_resolver = _well_known_resolver
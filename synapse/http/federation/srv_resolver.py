@@ -17,6 +17,7 @@
 import logging
 import random
 import time
+from typing import Dict, Set
 
 import attr
 
@@ -26,11 +27,19 @@ from twisted.names import client, dns
 from twisted.names.error import DNSNameError, DomainError
 
 from synapse.logging.context import make_deferred_yieldable
+from synapse.metrics.background_process_metrics import run_as_background_process
 
 logger = logging.getLogger(__name__)
 
 SERVER_CACHE = {}
 
+# How long before cached SRV records expire that we look them up again in the
+# background, in seconds. The cached records are still used in the meantime.
+SRV_REFRESH_PERIOD = 60
+
+# How long we remember that there are no SRV records for a service, in seconds.
+SRV_NEGATIVE_CACHE_PERIOD = 5 * 60
+
 
 @attr.s(slots=True, frozen=True)
 class Server(object):
@@ -102,16 +111,31 @@ class SrvResolver(object):
     The default resolver in twisted.names doesn't do any caching (it has a CacheResolver,
     but the cache never gets populated), so we add our own caching layer here.
 
+    If given a datastore, the results are also stored in the database, so that
+    they survive restarts and are shared between workers.
+
     Args:
         dns_client (twisted.internet.interfaces.IResolver): twisted resolver impl
         cache (dict): cache object
         get_time (callable): clock implementation. Should return seconds since the epoch
+        store (synapse.storage.DataStore|None): datastore to store the results
+            in, if any
     """
 
-    def __init__(self, dns_client=client, cache=SERVER_CACHE, get_time=time.time):
+    def __init__(
+        self, dns_client=client, cache=SERVER_CACHE, get_time=time.time, store=None
+    ):
         self._dns_client = dns_client
         self._cache = cache
         self._get_time = get_time
+        self._store = store
+
+        # The records we are looking up again in the background.
+        self._refreshing = set()  # type: Set[bytes]
+
+        # When our knowledge that there are no records for each service
+        # expires, in seconds since the epoch.
+        self._negative_cache = {}  # type: Dict[bytes, int]
 
     @defer.inlineCallbacks
     def resolve_service(self, service_name):
@@ -129,20 +153,158 @@ class SrvResolver(object):
         if not isinstance(service_name, bytes):
             raise TypeError("%r is not a byte string" % (service_name,))
 
-        cache_entry = self._cache.get(service_name, None)
-        if cache_entry:
-            if all(s.expires > now for s in cache_entry):
-                servers = list(cache_entry)
-                return _sort_server_list(servers)
+        cache_entry = self._get_cached_servers(service_name, now)
+        if cache_entry is None:
+            cache_entry = yield self._get_stored_servers(service_name)
+
+        if cache_entry is not None:
+            if any(s.expires <= now + SRV_REFRESH_PERIOD for s in cache_entry):
+                self._refresh_service(service_name)
+
+            return _sort_server_list(cache_entry)
+
+        servers = yield self._lookup_service(service_name)
+        return servers
+
+    def _get_cached_servers(self, service_name, now):
+        """Get the records for a service from the in-memory cache.
+
+        Args:
+            service_name (bytes)
+            now (int): The current time, in seconds since the epoch.
+
+        Returns:
+            list[Server]|None: The cached records, which will be empty if we
+            know there aren't any, or None if we don't have any current ones.
+        """
+        negative_expires = self._negative_cache.get(service_name)
+        if negative_expires is not None and negative_expires > now:
+            return []
+
+        cache_entry = self._cache.get(service_name)
+        if cache_entry and all(s.expires > now for s in cache_entry):
+            return list(cache_entry)
+
+        return None
+
+    @defer.inlineCallbacks
+    def _get_stored_servers(self, service_name, expires_after=0):
+        """Look for records for the service in the database which were stored
+        by us or another worker, and add them to the in-memory cache if there
+        are any.
+
+        Args:
+            service_name (bytes)
+            expires_after (int): Ignore records which expire before this time,
+                in seconds since the epoch.
+
+        Returns:
+            Deferred[list[Server]|None]: The stored records, which will be
+            empty if there aren't any for the service, or None if there aren't
+            any suitable ones.
+        """
+        if self._store is None:
+            return None
+
+        try:
+            row = yield self._store.get_federation_resolution(
+                "srv", service_name.decode("ascii")
+            )
+        except Exception as e:
+            logger.warning(
+                "Failed to load stored SRV records for %r: %s", service_name, e
+            )
+            return None
+
+        if row is None:
+            return None
+
+        result, expires_ts = row
+        if not result:
+            expires = expires_ts // 1000
+            if expires <= max(expires_after, self._get_time()):
+                return None
+
+            self._cache_no_servers(service_name, expires)
+            return []
+
+        servers = [
+            Server(
+                host=server["host"].encode("ascii"),
+                port=server["port"],
+                priority=server["priority"],
+                weight=server["weight"],
+                expires=server["expires"],
+            )
+            for server in result
+        ]
+        if any(s.expires <= max(expires_after, self._get_time()) for s in servers):
+            return None
+
+        self._negative_cache.pop(service_name, None)
+        self._cache[service_name] = servers
+        return list(servers)
+
+    def _cache_no_servers(self, service_name, expires):
+        """Remember that there are no records for a service.
+
+        Args:
+            service_name (bytes)
+            expires (int): When to look the service up again, in seconds since
+                the epoch.
+        """
+        self._cache.pop(service_name, None)
+        self._negative_cache[service_name] = expires
+
+    def _refresh_service(self, service_name):
+        """Look up the SRV records for a service in the background, unless we
+        are already doing so.
+
+        Args:
+            service_name (bytes)
+        """
+        if service_name in self._refreshing:
+            return
+        self._refreshing.add(service_name)
+
+        run_as_background_process(
+            "refresh_srv_records", self._do_refresh_service, service_name
+        )
+
+    @defer.inlineCallbacks
+    def _do_refresh_service(self, service_name):
+        cache_entry = self._cache.get(service_name) or []
+        expires = min((s.expires for s in cache_entry), default=0)
+
+        try:
+            # Use the records another worker has looked up, if there are any.
+            stored = yield self._get_stored_servers(service_name, expires)
+            if stored is None:
+                yield self._lookup_service(service_name)
+        finally:
+            self._refreshing.discard(service_name)
+
+    @defer.inlineCallbacks
+    def _lookup_service(self, service_name):
+        """Look up the SRV records for a service and cache them.
+
+        Args:
+            service_name (bytes)
+
+        Returns:
+            Deferred[list[Server]]:
+                a list of the SRV records, or an empty list if none found
+        """
+        now = int(self._get_time())
 
         try:
             answers, _, _ = yield make_deferred_yieldable(
                 self._dns_client.lookupService(service_name)
             )
         except DNSNameError:
-            # TODO: cache this. We can get the SOA out of the exception, and use
-            # the negative-TTL value.
-            return []
+            # TODO: We can get the SOA out of the exception, and use the
+            # negative-TTL value rather than a fixed period.
+            return self._store_no_servers(service_name, now)
         except DomainError as e:
             # We failed to resolve the name (other than a NameError)
             # Try something in the cache, else rereaise
@@ -181,5 +343,55 @@ class SrvResolver(object):
                 )
             )
 
+        if not servers:
+            return self._store_no_servers(service_name, now)
+
+        self._negative_cache.pop(service_name, None)
         self._cache[service_name] = list(servers)
+
+        if self._store is not None:
+            run_as_background_process(
+                "store_srv_records",
+                self._store.set_federation_resolution,
+                "srv",
+                service_name.decode("ascii"),
+                [
+                    {
+                        "host": s.host.decode("ascii"),
+                        "port": s.port,
+                        "priority": s.priority,
+                        "weight": s.weight,
+                        "expires": s.expires,
+                    }
+                    for s in servers
+                ],
+                min(s.expires for s in servers) * 1000,
+            )
+
         return _sort_server_list(servers)
+
+    def _store_no_servers(self, service_name, now):
+        """Cache, and store in the database, that there are no records for a
+        service.
+
+        Args:
+            service_name (bytes)
+            now (int): The current time, in seconds since the epoch.
+
+        Returns:
+            list[Server]: An empty list.
+        """
+        expires = now + SRV_NEGATIVE_CACHE_PERIOD
+        self._cache_no_servers(service_name, expires)
+
+        if self._store is not None:
+            run_as_background_process(
+                "store_srv_records",
+                self._store.set_federation_resolution,
+                "srv",
+                service_name.decode("ascii"),
+                [],
+                expires * 1000,
+            )
+
+        return []
@@ -17,6 +17,7 @@ import json
 import logging
 import random
 import time
+from typing import Set
 
 import attr
 
@@ -25,6 +26,7 @@ from twisted.web.client import RedirectAgent, readBody
 from twisted.web.http import stringToDatetime
 
 from synapse.logging.context import make_deferred_yieldable
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.util import Clock
 from synapse.util.caches.ttlcache import TTLCache
 from synapse.util.metrics import Measure
@@ -53,7 +55,8 @@ WELL_KNOWN_MIN_CACHE_PERIOD = 5 * 60
 
 # Attempt to refetch a cached well-known N% of the TTL before it expires.
 # e.g. if set to 0.2 and we have a cached entry with a TTL of 5mins, then
-# we'll start trying to refetch 1 minute before it expires.
+# we'll start trying to refetch 1 minute before it expires. The cached entry
+# is still used while we refetch it in the background.
 WELL_KNOWN_GRACE_PERIOD_FACTOR = 0.2
 
 # Number of times we retry fetching a well-known for a domain we know recently
@@ -75,10 +78,18 @@ class WellKnownLookupResult(object):
 
 class WellKnownResolver(object):
     """Handles well-known lookups for matrix servers.
+
+    If given a datastore, the results are also stored in the database, so that
+    they survive restarts and are shared between workers.
     """
 
     def __init__(
-        self, reactor, agent, well_known_cache=None, had_well_known_cache=None
+        self,
+        reactor,
+        agent,
+        well_known_cache=None,
+        had_well_known_cache=None,
+        store=None,
     ):
         self._reactor = reactor
         self._clock = Clock(reactor)
@@ -92,6 +103,10 @@ class WellKnownResolver(object):
         self._well_known_cache = well_known_cache
         self._had_valid_well_known_cache = had_well_known_cache
         self._well_known_agent = RedirectAgent(agent)
+        self._store = store
+
+        # The servers whose well-known we are refetching in the background.
+        self._refreshing = set()  # type: Set[bytes]
 
     @defer.inlineCallbacks
     def get_well_known(self, server_name):
@@ -107,25 +122,121 @@ class WellKnownResolver(object):
             prev_result, expiry, ttl = self._well_known_cache.get_with_expiry(
                 server_name
             )
-
-            now = self._clock.time()
-            if now < expiry - WELL_KNOWN_GRACE_PERIOD_FACTOR * ttl:
-                return WellKnownLookupResult(delegated_server=prev_result)
         except KeyError:
-            prev_result = None
+            stored = yield self._get_stored_well_known(server_name)
+            if stored is not None:
+                return stored
+        else:
+            now = self._clock.time()
+            if now >= expiry - WELL_KNOWN_GRACE_PERIOD_FACTOR * ttl:
+                self._refresh_well_known(server_name)
+            return WellKnownLookupResult(delegated_server=prev_result)
 
         # TODO: should we linearise so that we don't end up doing two .well-known
         # requests for the same server in parallel?
+        with Measure(self._clock, "get_well_known"):
+            result = yield self._fetch_and_cache_well_known(server_name, None)
+
+        return WellKnownLookupResult(delegated_server=result)
+
+    @defer.inlineCallbacks
+    def _get_stored_well_known(self, server_name, expires_after=0):
+        """Look for a result for the server in the database which was stored
+        by us or another worker, and add it to the in-memory cache if there is
+        one.
+
+        Args:
+            server_name (bytes)
+            expires_after (float): Ignore results which expire before this
+                time, in seconds since the epoch.
+
+        Returns:
+            Deferred[WellKnownLookupResult|None]: The stored result, or None if
+            there isn't a suitable one.
+        """
+        if self._store is None:
+            return None
+
+        try:
+            row = yield self._store.get_federation_resolution(
+                "well_known", server_name.decode("ascii")
+            )
+        except Exception as e:
+            logger.warning(
+                "Failed to load stored well-known for %s: %s", server_name, e
+            )
+            return None
+
+        if row is None:
+            return None
+
+        result, expires_ts = row
+        expiry = expires_ts / 1000.0
+        if expiry <= max(expires_after, self._clock.time()):
+            return None
+
+        delegated_server = result["m.server"]
+        if delegated_server is not None:
+            delegated_server = delegated_server.encode("ascii")
+
+        self._well_known_cache.set(
+            server_name, delegated_server, expiry - self._clock.time()
+        )
+        return WellKnownLookupResult(delegated_server=delegated_server)
+
+    def _refresh_well_known(self, server_name):
+        """Refetch the well-known for a server in the background, unless we are
+        already doing so.
+
+        Args:
+            server_name (bytes)
+        """
+        if server_name in self._refreshing:
+            return
+        self._refreshing.add(server_name)
+
+        run_as_background_process(
+            "refresh_well_known", self._do_refresh_well_known, server_name
+        )
+
+    @defer.inlineCallbacks
+    def _do_refresh_well_known(self, server_name):
+        try:
+            prev_result, expiry, _ = self._well_known_cache.get_with_expiry(server_name)
+        except KeyError:
+            prev_result, expiry = None, 0
+
         try:
-            with Measure(self._clock, "get_well_known"):
-                result, cache_period = yield self._fetch_well_known(server_name)
+            # Use the result another worker has refetched, if there is one.
+            stored = yield self._get_stored_well_known(server_name, expiry)
+            if stored is None:
+                yield self._fetch_and_cache_well_known(server_name, prev_result)
+        finally:
+            self._refreshing.discard(server_name)
+
+    @defer.inlineCallbacks
+    def _fetch_and_cache_well_known(self, server_name, prev_result):
+        """Fetch the well-known for a server and cache the result.
+
+        Args:
+            server_name (bytes)
+            prev_result (bytes|None): The result we have cached for the server,
+                which we keep using if we fail to fetch the well-known because
+                of a temporary failure.
+
+        Returns:
+            Deferred[bytes|None]: The delegated server name, or None if the
+            server doesn't have a well-known.
+        """
+        try:
+            result, cache_period = yield self._fetch_well_known(server_name)
 
         except _FetchWellKnownFailure as e:
             if prev_result and e.temporary:
                 # This is a temporary failure and we have a still valid cached
                 # result, so lets return that. Hopefully the next time we ask
                 # the remote will be back up again.
-                return WellKnownLookupResult(delegated_server=prev_result)
+                return prev_result
 
             result = None
 
@@ -145,7 +256,17 @@ class WellKnownResolver(object):
         if cache_period > 0:
             self._well_known_cache.set(server_name, result, cache_period)
 
-        return WellKnownLookupResult(delegated_server=result)
+            if self._store is not None:
+                run_as_background_process(
+                    "store_well_known",
+                    self._store.set_federation_resolution,
+                    "well_known",
+                    server_name.decode("ascii"),
+                    {"m.server": result.decode("ascii") if result else None},
+                    int((self._clock.time() + cache_period) * 1000),
+                )
+
+        return result
 
     @defer.inlineCallbacks
     def _fetch_well_known(self, server_name):
@@ -47,6 +47,7 @@ from synapse.api.errors import (
 )
 from synapse.http import QuieterFileBodyProducer
 from synapse.http.client import BlacklistingAgentWrapper, IPBlacklistingResolver
+from synapse.http.federation.connection_pool import FederationConnectionPool
 from synapse.http.federation.matrix_federation_agent import MatrixFederationAgent
 from synapse.logging.context import make_deferred_yieldable
 from synapse.logging.opentracing import (
@@ -198,7 +199,23 @@ class MatrixFederationHttpClient(object):
 
         self.reactor = Reactor()
 
-        self.agent = MatrixFederationAgent(self.reactor, tls_client_options_factory)
+        self._pool = FederationConnectionPool(
+            self.reactor,
+            hs.get_clock(),
+            max_per_destination=hs.config.federation_max_connections_per_destination,
+            idle_timeout_ms=hs.config.federation_connection_idle_timeout,
+            max_idle_connections=hs.config.federation_max_idle_connections,
+            prewarm_destinations=hs.config.federation_prewarm_destinations,
+        )
+
+        self._store = hs.get_datastore()
+
+        self.agent = MatrixFederationAgent(
+            self.reactor,
+            tls_client_options_factory,
+            pool=self._pool,
+            store=self._store,
+        )
 
         # Use a BlacklistingAgentWrapper to prevent circumventing the IP
         # blacklist via IP literals in server names
@@ -209,7 +226,6 @@ class MatrixFederationHttpClient(object):
         )
 
         self.clock = hs.get_clock()
-        self._store = hs.get_datastore()
         self.version_string_bytes = hs.version_string.encode("ascii")
         self.default_timeout = 60
 
@@ -23,8 +23,9 @@ import urllib
 from io import BytesIO
 
 from canonicaljson import encode_canonical_json, encode_pretty_printed_json, json
+from zope.interface import implementer
 
-from twisted.internet import defer
+from twisted.internet import defer, interfaces
 from twisted.python import failure
 from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
@@ -235,6 +236,21 @@ class HttpServer(object):
         pass
 
 
+class EncodedJsonResponse(object):
+    """A JSON response body which has already been encoded, e.g. because it
+    was cached. Callbacks registered with a JsonResource can return one of
+    these in place of a JSON object.
+
+    Attributes:
+        json_bytes (bytes): The encoded JSON.
+    """
+
+    __slots__ = ["json_bytes"]
+
+    def __init__(self, json_bytes):
+        self.json_bytes = json_bytes
+
+
 class JsonResource(HttpServer, resource.Resource):
     """ This implements the HttpServer interface and provides JSON support for
     Resources.
@@ -242,7 +258,8 @@ class JsonResource(HttpServer, resource.Resource):
     Register callbacks via register_paths()
 
     Callbacks can return a tuple of status code and a dict in which case the
-    the dict will automatically be sent to the client as a JSON object.
+    the dict will automatically be sent to the client as a JSON object. They
+    can also return an EncodedJsonResponse in place of the dict.
 
     The JsonResource is primarily intended for returning JSON, but callbacks
     may send something other than JSON, they may do so by using the methods
@@ -370,6 +387,16 @@ class JsonResource(HttpServer, resource.Resource):
         self, request, code, response_json_object, response_code_message=None
     ):
         # TODO: Only enable CORS for the requests that need it.
+        if isinstance(response_json_object, EncodedJsonResponse):
+            respond_with_json_bytes(
+                request,
+                code,
+                response_json_object.json_bytes,
+                send_cors=True,
+                response_code_message=response_code_message,
+            )
+            return
+
         respond_with_json(
             request,
             code,
@@ -515,6 +542,190 @@ def respond_with_json_bytes(
     return NOT_DONE_YET
 
 
+def respond_with_json_stream(
+    request,
+    code,
+    json_object,
+    send_cors=False,
+    response_code_message=None,
+    pretty_print=False,
+    canonical_json=True,
+):
+    """Sends JSON in response to the given request, encoding it a piece at a
+    time as it is written.
+
+    The top few levels of dicts and lists in `json_object` are encoded
+    incrementally, with everything below that (e.g. each room in a sync
+    response) encoded in one go. This means we never hold the whole encoded
+    response in memory, and the reactor gets control back between chunks. The
+    response is sent without a Content-Length.
+
+    Args:
+        request (twisted.web.http.Request): The http request to respond to.
+        code (int): The HTTP response code.
+        json_object (object): The JSON object to encode and send.
+        send_cors (bool): Whether to send Cross-Origin Resource Sharing headers
+            http://www.w3.org/TR/cors/
+        pretty_print (bool): Whether to pretty print the JSON. Pretty printed
+            responses are encoded in one go.
+        canonical_json (bool): Whether to encode the JSON canonically.
+    Returns:
+        twisted.web.server.NOT_DONE_YET"""
+    if request._disconnected:
+        logger.warning(
+            "Not sending response to request %s, already disconnected.", request
+        )
+        return
+
+    if pretty_print:
+        json_iterator = iter([encode_pretty_printed_json(json_object) + b"\n"])
+    elif canonical_json or synapse.events.USE_FROZEN_DICTS:
+        json_iterator = _iterencode_json(
+            json_object,
+            encode_canonical_json,
+            sort_keys=True,
+            item_separator=b",",
+            key_separator=b":",
+            depth=_JSON_STREAM_DEPTH,
+        )
+    else:
+        json_iterator = _iterencode_json(
+            json_object,
+            lambda o: json.dumps(o).encode("utf-8"),
+            sort_keys=False,
+            item_separator=b", ",
+            key_separator=b": ",
+            depth=_JSON_STREAM_DEPTH,
+        )
+
+    request.setResponseCode(code, message=response_code_message)
+    request.setHeader(b"Content-Type", b"application/json")
+    request.setHeader(b"Cache-Control", b"no-cache, no-store, must-revalidate")
+
+    if send_cors:
+        set_cors_headers(request)
+
+    producer = _ByteProducer(request, json_iterator)
+    producer.start()
+    return NOT_DONE_YET
+
+
+# How many levels of dicts and lists `respond_with_json_stream` encodes
+# incrementally. For a sync response this is enough to reach the individual
+# rooms (`{"rooms": {"join": {room_id: ...}}}`).
+_JSON_STREAM_DEPTH = 3
+
+
+def _iterencode_json(
+    json_object, encode, sort_keys, item_separator, key_separator, depth
+):
+    """Yields the JSON encoding of an object in pieces.
+
+    Args:
+        json_object (object): The JSON object to encode. The keys of any dicts
+            must be strings.
+        encode (Callable[[object], bytes]): Encodes a JSON object in one go.
+        sort_keys (bool): Whether to sort the keys of dicts.
+        item_separator (bytes): The separator between items in dicts and lists.
+        key_separator (bytes): The separator between keys and values in dicts.
+        depth (int): How many levels of dicts and lists to split up. Anything
+            deeper is passed to `encode` whole.
+
+    Yields:
+        bytes
+    """
+    if depth <= 0 or not isinstance(json_object, (dict, list, tuple)):
+        yield encode(json_object)
+        return
+
+    if isinstance(json_object, dict):
+        items = json_object.items()
+        if sort_keys:
+            items = sorted(items, key=lambda item: item[0])
+
+        yield b"{"
+        for i, (key, value) in enumerate(items):
+            if i:
+                yield item_separator
+            yield encode(key)
+            yield key_separator
+            yield from _iterencode_json(
+                value, encode, sort_keys, item_separator, key_separator, depth - 1
+            )
+        yield b"}"
+    else:
+        yield b"["
+        for i, value in enumerate(json_object):
+            if i:
+                yield item_separator
+            yield from _iterencode_json(
+                value, encode, sort_keys, item_separator, key_separator, depth - 1
+            )
+        yield b"]"
+
+
+@implementer(interfaces.IPullProducer)
+class _ByteProducer(object):
+    """Writes the bytes produced by an iterator to a request.
+
+    This is a pull producer, so each chunk is only generated once the previous
+    one has been written to the transport.
+    """
+
+    # The minimum number of bytes to write at a time. The JSON encoders produce
+    # lots of very small strings, each of which would otherwise be a separate
+    # write (and, with chunked transfer encoding, a separate chunk).
+    min_chunk_size = 64 * 1024
+
+    def __init__(self, request, iterator):
+        """
+        Args:
+            request (twisted.web.http.Request): The request to write to.
+            iterator (Iterator[bytes]): The data to write.
+        """
+        self._request = request
+        self._iterator = iterator
+
+    def start(self):
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        # We may have been stopped while the transport was asking us for more.
+        if not self._request:
+            return
+
+        buffer = []
+        buffered_bytes = 0
+        while buffered_bytes < self.min_chunk_size:
+            try:
+                data = next(self._iterator)
+            except StopIteration:
+                if buffer:
+                    self._request.write(b"".join(buffer))
+                self._request.unregisterProducer()
+                self._request.finish()
+                self.stopProducing()
+                return
+            except Exception:
+                # We have already sent the response code and headers, so the
+                # best we can do is drop the connection rather than leave the
+                # client waiting for the rest of the response.
+                logger.exception("Failed to encode response to %r", self._request)
+                self._request.unregisterProducer()
+                self._request.loseConnection()
+                self.stopProducing()
+                return
+
+            buffer.append(data)
+            buffered_bytes += len(data)
+
+        self._request.write(b"".join(buffer))
+
+    def stopProducing(self):
+        self._request = None
+        self._iterator = None
+
+
 def set_cors_headers(request):
     """Set the CORs headers so that javascript running in a web browsers can
     use this API
@@ -15,9 +15,9 @@
 
 import logging
 from collections import namedtuple
-from typing import Callable, List
+from typing import Any, Callable, Dict, List
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -30,8 +30,8 @@ from synapse.logging.utils import log_function
 from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.types import StreamToken
-from synapse.util.async_helpers import ObservableDeferred, timeout_deferred
-from synapse.util.metrics import Measure
+from synapse.util.async_helpers import ObservableDeferred
+from synapse.util.wheel_timer import WheelTimer
 from synapse.visibility import filter_events_for_client
 
 logger = logging.getLogger(__name__)
@@ -42,6 +42,34 @@ users_woken_by_stream_counter = Counter(
     "synapse_notifier_users_woken_by_stream", "", ["stream"]
 )
 
+fan_out_size_histogram = Histogram(
+    "synapse_notifier_fan_out_streams",
+    "Number of user streams woken up by each fan out",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, "+Inf"),
+)
+
+fan_out_latency_histogram = Histogram(
+    "synapse_notifier_fan_out_latency_seconds",
+    "Time from being told about new events to having woken up all the user "
+    "streams interested in them",
+)
+
+# How long we spend waking up user streams before yielding to the reactor, and
+# how many we wake up between checking the time.
+FAN_OUT_SLICE_SECONDS = 0.01
+FAN_OUT_SLICE_CHECK_EVERY = 100
+
+# How accurately we time out long polls, in ms.
+LONG_POLL_TIMER_BUCKET_MS = 100
+
+# The longest we let a long poll wait for, in ms, whatever timeout the client
+# asked for. The timer keeps a bucket for every LONG_POLL_TIMER_BUCKET_MS up to
+# the latest deadline, so this also bounds its size.
+MAX_LONG_POLL_TIMEOUT_MS = 5 * 60 * 1000
+
+# How often we check for user streams which have expired, in ms.
+STREAM_EXPIRY_CHECK_MS = 60 * 1000
+
 
 # TODO(paul): Should be shared somewhere
 def count(func, l):
@@ -91,21 +119,24 @@ class _NotifierUserStream(object):
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
 
-    def notify(self, stream_key, stream_id, time_now_ms):
-        """Notify any listeners for this user of a new event from an
-        event source.
+    def notify(self, stream_ids, time_now_ms):
+        """Notify any listeners for this user of new events from one or more
+        event sources.
         Args:
-            stream_key(str): The stream the event came from.
-            stream_id(str): The new id for the stream the event came from.
+            stream_ids(dict[str, str]): The new id for each stream that has had
+                new events, keyed by stream.
             time_now_ms(int): The current time in milliseconds.
         """
-        self.current_token = self.current_token.copy_and_advance(stream_key, stream_id)
-        self.last_notified_token = self.current_token
+        current_token = self.current_token
+        for stream_key, stream_id in stream_ids.items():
+            current_token = current_token.copy_and_advance(stream_key, stream_id)
+            users_woken_by_stream_counter.labels(stream_key).inc()
+
+        self.current_token = current_token
+        self.last_notified_token = current_token
         self.last_notified_ms = time_now_ms
         noify_deferred = self.notify_deferred
 
-        users_woken_by_stream_counter.labels(stream_key).inc()
-
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
             noify_deferred.callback(self.current_token)
@@ -140,6 +171,25 @@ class _NotifierUserStream(object):
             return _NotificationListener(self.notify_deferred.observe())
 
 
+def _advance_stream_id(stream_ids, stream_key, stream_id):
+    """Records a new id for a stream in a dict of stream ids, unless it already
+    has a later id for that stream.
+
+    Args:
+        stream_ids (dict[str, str]): The stream ids, keyed by stream
+        stream_key (str): The stream which has a new id
+        stream_id (str): The new id for the stream
+    """
+    existing = stream_ids.get(stream_key)
+    if existing is None:
+        stream_ids[stream_key] = stream_id
+        return
+
+    token = StreamToken.START.copy_and_replace(stream_key, existing)
+    if token.copy_and_advance(stream_key, stream_id) is not token:
+        stream_ids[stream_key] = stream_id
+
+
 class EventStreamResult(namedtuple("EventStreamResult", ("events", "tokens"))):
     def __nonzero__(self):
         return bool(self.events)
@@ -166,6 +216,14 @@ class Notifier(object):
         self.store = hs.get_datastore()
         self.pending_new_room_events = []
 
+        # The new stream ids for rooms and users whose streams we've yet to wake
+        # up. These get collected up over a reactor tick so that each user stream
+        # gets woken up at most once by `_fan_out`.
+        self._pending_room_wakeups = {}  # type: Dict[str, Dict[str, Any]]
+        self._pending_user_wakeups = {}  # type: Dict[str, Dict[str, Any]]
+        self._fan_out_scheduled = False
+        self._fan_out_queued_at = 0.0
+
         # Called when there are new things to stream over replication
         self.replication_callbacks = []  # type: List[Callable[[], None]]
 
@@ -173,6 +231,10 @@ class Notifier(object):
         # down.
         self.remote_server_up_callbacks = []  # type: List[Callable[[str], None]]
 
+        # Called with the room ID and the redacted event ID when events are
+        # redacted.
+        self.redaction_callbacks = []  # type: List[Callable[[str, str], None]]
+
         self.clock = hs.get_clock()
         self.appservice_handler = hs.get_application_service_handler()
 
@@ -183,9 +245,15 @@ class Notifier(object):
 
         self.state_handler = hs.get_state_handler()
 
-        self.clock.looping_call(
-            self.remove_expired_streams, self.UNUSED_STREAM_EXPIRY_MS
-        )
+        # The deferreds for long polls that are waiting for new events, bucketed
+        # by when they time out. This saves having a delayed call per long poll.
+        self._long_poll_timeouts = WheelTimer(bucket_size=LONG_POLL_TIMER_BUCKET_MS)
+        self.clock.looping_call(self._time_out_long_polls, LONG_POLL_TIMER_BUCKET_MS)
+
+        # The user streams, bucketed by when they might next have been unused
+        # for long enough to be expired.
+        self._stream_expiries = WheelTimer(bucket_size=STREAM_EXPIRY_CHECK_MS)
+        self.clock.looping_call(self.remove_expired_streams, STREAM_EXPIRY_CHECK_MS)
 
         # This is not a very cheap test to perform, but it's only executed
         # when rendering the metrics page, which is likely once per minute at
@@ -226,6 +294,13 @@ class Notifier(object):
         """
         self.remote_server_up_callbacks.append(cb)
 
+    def add_redaction_callback(self, cb: Callable[[str, str], None]):
+        """Add a callback that will be called with the room ID and redacted
+        event ID when a redaction is persisted, on whichever process it is
+        persisted or replicated to.
+        """
+        self.redaction_callbacks.append(cb)
+
     def on_new_room_event(
         self, event, room_stream_id, max_room_stream_id, extra_users=[]
     ):
@@ -240,6 +315,10 @@ class Notifier(object):
         until all previous events have been persisted before notifying
         the client streams.
         """
+        if event.type == EventTypes.Redaction and event.redacts is not None:
+            for cb in self.redaction_callbacks:
+                cb(event.room_id, event.redacts)
+
         self.pending_new_room_events.append((room_stream_id, event, extra_users))
         self._notify_pending_new_room_events(max_room_stream_id)
 
@@ -289,28 +368,88 @@ class Notifier(object):
     def on_new_event(self, stream_key, new_token, users=[], rooms=[]):
         """ Used to inform listeners that something has happened event wise.
 
-        Will wake up all listeners for the given users and rooms.
+        Will wake up all listeners for the given users and rooms. This happens
+        shortly afterwards rather than immediately, so that a user stream only
+        gets woken up once for everything that happens in a reactor tick.
         """
         with PreserveLoggingContext():
-            with Measure(self.clock, "on_new_event"):
-                user_streams = set()
+            for user in users:
+                pending = self._pending_user_wakeups.setdefault(str(user), {})
+                _advance_stream_id(pending, stream_key, new_token)
+
+            for room in rooms:
+                pending = self._pending_room_wakeups.setdefault(room, {})
+                _advance_stream_id(pending, stream_key, new_token)
+
+            if not self._fan_out_scheduled:
+                self._fan_out_scheduled = True
+                self._fan_out_queued_at = self.clock.time()
+                self.clock.call_later(0, self._start_fan_out)
 
-                for user in users:
-                    user_stream = self.user_to_user_stream.get(str(user))
+            self.notify_replication()
+
+    def _start_fan_out(self):
+        run_as_background_process("notifier_fan_out", self._fan_out)
+
+    async def _fan_out(self):
+        """Wakes up the user streams for the rooms and users that have had new
+        events, yielding to the reactor every so often so that waking up large
+        rooms doesn't stall everything else.
+        """
+        try:
+            while self._pending_room_wakeups or self._pending_user_wakeups:
+                queued_at = self._fan_out_queued_at
+                self._fan_out_queued_at = self.clock.time()
+
+                room_wakeups = self._pending_room_wakeups
+                user_wakeups = self._pending_user_wakeups
+                self._pending_room_wakeups = {}
+                self._pending_user_wakeups = {}
+
+                # Work out the new stream ids for each user stream. Usually a
+                # stream only hears about one room or user, so we share the dict
+                # rather than copying it.
+                to_notify = {}  # type: Dict[_NotifierUserStream, Dict[str, Any]]
+
+                def add_stream_ids(user_stream, stream_ids):
+                    existing = to_notify.get(user_stream)
+                    if existing is None:
+                        to_notify[user_stream] = stream_ids
+                        return
+
+                    merged = dict(existing)
+                    for stream_key, stream_id in stream_ids.items():
+                        _advance_stream_id(merged, stream_key, stream_id)
+                    to_notify[user_stream] = merged
+
+                for user_id, stream_ids in user_wakeups.items():
+                    user_stream = self.user_to_user_stream.get(user_id)
                     if user_stream is not None:
-                        user_streams.add(user_stream)
+                        add_stream_ids(user_stream, stream_ids)
+
+                for room_id, stream_ids in room_wakeups.items():
+                    for user_stream in self.room_to_user_streams.get(room_id, ()):
+                        add_stream_ids(user_stream, stream_ids)
 
-                for room in rooms:
-                    user_streams |= self.room_to_user_streams.get(room, set())
+                fan_out_size_histogram.observe(len(to_notify))
 
                 time_now_ms = self.clock.time_msec()
-                for user_stream in user_streams:
+                slice_start = self.clock.time()
+                for i, (user_stream, stream_ids) in enumerate(to_notify.items(), 1):
                     try:
-                        user_stream.notify(stream_key, new_token, time_now_ms)
+                        user_stream.notify(stream_ids, time_now_ms)
                     except Exception:
                         logger.exception("Failed to notify listener")
 
-                self.notify_replication()
+                    if i % FAN_OUT_SLICE_CHECK_EVERY == 0:
+                        if self.clock.time() - slice_start > FAN_OUT_SLICE_SECONDS:
+                            await self.clock.sleep(0)
+                            time_now_ms = self.clock.time_msec()
+                            slice_start = self.clock.time()
+
+                fan_out_latency_histogram.observe(self.clock.time() - queued_at)
+        finally:
+            self._fan_out_scheduled = False
 
     def on_new_replication_data(self):
         """Used to inform replication listeners that something has happend
@@ -322,6 +461,8 @@ class Notifier(object):
     ):
         """Wait until the callback returns a non empty response or the
         timeout fires.
+
+        The timeout is capped at MAX_LONG_POLL_TIMEOUT_MS.
         """
         user_stream = self.user_to_user_stream.get(user_id)
         if user_stream is None:
@@ -339,7 +480,7 @@ class Notifier(object):
         result = None
         prev_token = from_token
         if timeout:
-            end_time = self.clock.time_msec() + timeout
+            end_time = self.clock.time_msec() + min(timeout, MAX_LONG_POLL_TIMEOUT_MS)
 
             while not result:
                 try:
@@ -350,11 +491,10 @@ class Notifier(object):
                     # Now we wait for the _NotifierUserStream to be told there
                     # is a new token.
                     listener = user_stream.new_listener(prev_token)
-                    listener.deferred = timeout_deferred(
-                        listener.deferred,
-                        (end_time - now) / 1000.0,
-                        self.hs.get_reactor(),
-                    )
+                    if not listener.deferred.called:
+                        self._long_poll_timeouts.insert(
+                            now, listener.deferred, end_time
+                        )
                     with PreserveLoggingContext():
                         await listener.deferred
 
@@ -502,24 +642,50 @@ class Notifier(object):
         else:
             return False
 
+    def _time_out_long_polls(self):
+        """Wakes up any long polls whose timeouts have passed."""
+        expired = self._long_poll_timeouts.fetch(self.clock.time_msec())
+        with PreserveLoggingContext():
+            for d in expired:
+                if not d.called:
+                    d.errback(defer.TimeoutError())
+
     @log_function
     def remove_expired_streams(self):
+        """Removes the user streams which haven't been used for a while.
+
+        Rather than looking at every stream, we only look at those that might
+        have expired since we last checked, and check again later on those
+        that turn out to still be in use.
+        """
         time_now_ms = self.clock.time_msec()
-        expired_streams = []
         expire_before_ts = time_now_ms - self.UNUSED_STREAM_EXPIRY_MS
-        for stream in self.user_to_user_stream.values():
-            if stream.count_listeners():
+        for stream in self._stream_expiries.fetch(time_now_ms):
+            if self.user_to_user_stream.get(stream.user_id) is not stream:
                 continue
-            if stream.last_notified_ms < expire_before_ts:
-                expired_streams.append(stream)
 
-        for expired_stream in expired_streams:
-            expired_stream.remove(self)
+            if stream.count_listeners():
+                self._stream_expiries.insert(
+                    time_now_ms, stream, time_now_ms + self.UNUSED_STREAM_EXPIRY_MS
+                )
+            elif stream.last_notified_ms >= expire_before_ts:
+                self._stream_expiries.insert(
+                    time_now_ms,
+                    stream,
+                    stream.last_notified_ms + self.UNUSED_STREAM_EXPIRY_MS,
+                )
+            else:
+                stream.remove(self)
 
     @log_function
     def _register_with_keys(self, user_stream):
         self.user_to_user_stream[user_stream.user_id] = user_stream
 
+        time_now_ms = self.clock.time_msec()
+        self._stream_expiries.insert(
+            time_now_ms, user_stream, time_now_ms + self.UNUSED_STREAM_EXPIRY_MS
+        )
+
         for room in user_stream.rooms:
             s = self.room_to_user_streams.setdefault(room, set())
             s.add(user_stream)
@@ -30,6 +30,9 @@ class ActionGenerator(object):
         self.clock = hs.get_clock()
         self.store = hs.get_datastore()
         self.bulk_evaluator = BulkPushRuleEvaluator(hs)
+        self._deferred_evaluation_room_size = (
+            hs.config.push_deferred_evaluation_room_size
+        )
         # really we want to get all user ids and all profile tags too,
         # since we want the actions for each profile tag for every user and
         # also actions for a client with no profile tag for each user.
@@ -39,5 +42,17 @@ class ActionGenerator(object):
 
     @defer.inlineCallbacks
     def handle_push_actions_for_event(self, event, context):
+        if self._deferred_evaluation_room_size is not None and not event.is_state():
+            room_members = yield self.store.get_joined_users_from_context(
+                event, context
+            )
+            if len(room_members) >= self._deferred_evaluation_room_size:
+                # Leave working out the push actions until after the event has
+                # been persisted. See PushEvaluationQueue.
+                yield self.store.add_deferred_push_evaluation(
+                    event.event_id, event.room_id
+                )
+                return
+
         with Measure(self.clock, "action_for_event_by_user"):
             yield self.bulk_evaluator.action_for_event_by_user(event, context)
@@ -17,8 +17,9 @@
 import logging
 from collections import namedtuple
 
-from six import iteritems, itervalues
+from six import iteritems, itervalues, string_types
 
+from canonicaljson import json
 from prometheus_client import Counter
 
 from twisted.internet import defer
@@ -26,11 +27,12 @@ from twisted.internet import defer
 from synapse.api.constants import EventTypes, Membership
 from synapse.event_auth import get_user_power_level
 from synapse.state import POWER_KEY
+from synapse.types import UserID
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches import register_cache
 from synapse.util.caches.descriptors import cached
 
-from .push_rule_evaluator import PushRuleEvaluatorForEvent
+from .push_rule_evaluator import PushRuleEvaluatorForEvent, WordBoundaryGlobIndex
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +46,10 @@ push_rules_invalidation_counter = Counter(
 push_rules_state_size_counter = Counter(
     "synapse_push_bulk_push_rule_evaluator_push_rules_state_size_counter", ""
 )
+push_rules_compile_counter = Counter(
+    "synapse_push_bulk_push_rule_evaluator_push_rules_compile_counter",
+    "Number of times the push rules for a room have been compiled",
+)
 
 # Measures whether we use the fast path of using state deltas, or if we have to
 # recalculate from scratch
@@ -144,6 +150,21 @@ class BulkPushRuleEvaluator(object):
         Returns:
             Deferred
         """
+        actions_by_user = yield self.get_actions_for_event_by_user(event, context)
+
+        # Mark in the DB staging area the push actions for users who should be
+        # notified for this event. (This will then get handled when we persist
+        # the event)
+        yield self.store.add_push_actions_to_staging(event.event_id, actions_by_user)
+
+    @defer.inlineCallbacks
+    def get_actions_for_event_by_user(self, event, context):
+        """Given an event and context, evaluate the push rules.
+
+        Returns:
+            Deferred[dict[str, list]]: The push actions for each user who should
+            be notified of the event.
+        """
         rules_by_user = yield self._get_rules_for_event(event, context)
         actions_by_user = {}
 
@@ -158,66 +179,237 @@ class BulkPushRuleEvaluator(object):
             event, len(room_members), sender_power_level, power_levels
         )
 
-        condition_cache = {}
+        rules_for_room = yield self._get_rules_for_room(event.room_id)
+        compiled_rules = rules_for_room.get_compiled_rules(rules_by_user)
+        matcher = _EventMatcher(
+            event,
+            evaluator,
+            room_members,
+            rules_for_room.get_display_name_index(room_members),
+            compiled_rules.localpart_index,
+        )
 
-        for uid, rules in iteritems(rules_by_user):
-            if event.sender == uid:
-                continue
+        # Evaluate each distinct set of rules once for all the users who have
+        # it, narrowing down the users still to be decided as we go.
+        for rules, user_ids in compiled_rules.groups:
+            remaining = user_ids
+            for rule in rules:
+                if not all(
+                    matcher.condition_matches(key, cond)
+                    for key, cond in rule.conditions
+                ):
+                    continue
+
+                matched = remaining
+                for cond in rule.user_conditions:
+                    matched = matcher.users_matching(cond, matched)
+                    if not matched:
+                        break
+
+                if not matched:
+                    continue
+
+                if rule.actions:
+                    # Push rules say we should notify these users of this event
+                    for uid in matched:
+                        actions_by_user[uid] = rule.actions
+
+                if matched is remaining:
+                    break
+                remaining = remaining - matched
+                if not remaining:
+                    break
+
+        actions_by_user.pop(event.sender, None)
 
-            if not event.is_state():
+        if not event.is_state():
+            for uid in list(actions_by_user):
                 is_ignored = yield self.store.is_ignored_by(event.sender, uid)
                 if is_ignored:
-                    continue
+                    del actions_by_user[uid]
 
-            display_name = None
-            profile_info = room_members.get(uid)
-            if profile_info:
-                display_name = profile_info.display_name
+        return actions_by_user
 
-            if not display_name:
-                # Handle the case where we are pushing a membership event to
-                # that user, as they might not be already joined.
-                if event.type == EventTypes.Member and event.state_key == uid:
-                    display_name = event.content.get("displayname", None)
 
-            for rule in rules:
-                if "enabled" in rule and not rule["enabled"]:
-                    continue
+class _CompiledRule(
+    namedtuple("_CompiledRule", ("conditions", "user_conditions", "actions"))
+):
+    """A push rule prepared for evaluating against all the users who have it at
+    once.
 
-                matches = _condition_checker(
-                    evaluator, rule["conditions"], uid, display_name, condition_cache
-                )
-                if matches:
-                    actions = [x for x in rule["actions"] if x != "dont_notify"]
-                    if actions and "notify" in actions:
-                        # Push rules say we should notify the user of this event
-                        actions_by_user[uid] = actions
-                    break
+    Attributes:
+        conditions (list[tuple[str, dict]]): The conditions which don't depend
+            on the user, each with the key its result for an event is shared
+            under.
+        user_conditions (list[dict]): The conditions which do depend on the user.
+        actions (list|None): The actions for users the rule matches, or None
+            if they shouldn't be notified.
+    """
 
-        # Mark in the DB staging area the push actions for users who should be
-        # notified for this event. (This will then get handled when we persist
-        # the event)
-        yield self.store.add_push_actions_to_staging(event.event_id, actions_by_user)
+
+def _compile_rule(rule):
+    conditions = []
+    user_conditions = []
+    for cond in rule["conditions"]:
+        if _is_user_condition(cond):
+            user_conditions.append(cond)
+        else:
+            key = cond.get("_id") or json.dumps(cond, sort_keys=True)
+            conditions.append((key, cond))
+
+    actions = [x for x in rule["actions"] if x != "dont_notify"]
+    if "notify" not in actions:
+        actions = None
+
+    return _CompiledRule(conditions, user_conditions, actions)
 
 
-def _condition_checker(evaluator, conditions, uid, display_name, cache):
-    for cond in conditions:
-        _id = cond.get("_id", None)
-        if _id:
-            res = cache.get(_id, None)
-            if res is False:
-                return False
-            elif res is True:
-                continue
+def _is_user_condition(condition):
+    """Whether the result of a condition depends on the user being evaluated."""
+    if condition["kind"] == "contains_display_name":
+        return True
 
-        res = evaluator.matches(cond, uid, display_name)
-        if _id:
-            cache[_id] = bool(res)
+    return (
+        condition["kind"] == "event_match"
+        and not condition.get("pattern", None)
+        and condition.get("pattern_type", None) in ("user_id", "user_localpart")
+    )
 
-        if not res:
-            return False
 
-    return True
+class CompiledRulesForRoom(object):
+    """The push rules of all the users in a room, compiled so that each
+    distinct set of rules is only evaluated once per event.
+
+    Attributes:
+        groups (list[tuple[list[_CompiledRule], frozenset[str]]]): The enabled
+            rules of each distinct set of rules, in order, and the users who
+            have that set.
+        localpart_index (WordBoundaryGlobIndex): Finds the users whose localpart
+            appears in a message body.
+    """
+
+    def __init__(self, rules_by_user, rules_keys):
+        """
+        Args:
+            rules_by_user (dict[str, list[dict]]): The rules of each user.
+            rules_keys (dict[int, tuple[list[dict], str]]): Cache of the key
+                identifying each list of rules, by the list's id. Updated to
+                only include the lists in `rules_by_user`.
+        """
+        previous_keys = dict(rules_keys)
+        rules_keys.clear()
+
+        user_ids_by_key = {}
+        rules_by_key = {}
+        for uid, rules in iteritems(rules_by_user):
+            entry = previous_keys.get(id(rules))
+            if entry is None or entry[0] is not rules:
+                entry = (rules, json.dumps(rules, sort_keys=True))
+            rules_keys[id(rules)] = entry
+
+            key = entry[1]
+            user_ids_by_key.setdefault(key, []).append(uid)
+            rules_by_key.setdefault(key, rules)
+
+        self.groups = [
+            (
+                [
+                    _compile_rule(rule)
+                    for rule in rules_by_key[key]
+                    if rule.get("enabled", True)
+                ],
+                frozenset(user_ids),
+            )
+            for key, user_ids in iteritems(user_ids_by_key)
+        ]
+
+        self.localpart_index = WordBoundaryGlobIndex(
+            {uid: UserID.from_string(uid).localpart for uid in rules_by_user}
+        )
+
+
+class _EventMatcher(object):
+    """Evaluates the conditions of compiled push rules against an event."""
+
+    def __init__(
+        self, event, evaluator, room_members, display_name_index, localpart_index
+    ):
+        self._event = event
+        self._evaluator = evaluator
+        self._room_members = room_members
+        self._display_name_index = display_name_index
+        self._localpart_index = localpart_index
+
+        self._condition_cache = {}
+
+    def condition_matches(self, key, condition):
+        """Whether a condition which doesn't depend on the user matches."""
+        res = self._condition_cache.get(key, None)
+        if res is None:
+            res = bool(self._evaluator.matches(condition, None, None))
+            self._condition_cache[key] = res
+        return res
+
+    def users_matching(self, condition, user_ids):
+        """Returns which of the given users a condition which depends on the
+        user matches.
+
+        Args:
+            condition (dict)
+            user_ids (frozenset[str])
+
+        Returns:
+            frozenset[str]
+        """
+        index = None
+        if condition["kind"] == "contains_display_name":
+            index = self._display_name_index
+        elif (
+            condition["key"] == "content.body"
+            and condition.get("pattern_type", None) == "user_localpart"
+        ):
+            index = self._localpart_index
+
+        body = self._event.content.get("body", None)
+        if index is None or not isinstance(body, string_types):
+            return frozenset(
+                uid
+                for uid in user_ids
+                if self._evaluator.matches(condition, uid, self._display_name(uid))
+            )
+
+        if not body:
+            return frozenset()
+
+        matched = user_ids.intersection(index.matches(body))
+
+        # The display name of the target of a membership event may only be
+        # known from the event itself, so check them separately.
+        if (
+            condition["kind"] == "contains_display_name"
+            and self._event.type == EventTypes.Member
+            and self._event.state_key in user_ids
+            and self._event.state_key not in matched
+        ):
+            uid = self._event.state_key
+            if self._evaluator.matches(condition, uid, self._display_name(uid)):
+                matched = matched.union((uid,))
+
+        return matched
+
+    def _display_name(self, uid):
+        display_name = None
+        profile_info = self._room_members.get(uid)
+        if profile_info:
+            display_name = profile_info.display_name
+
+        if not display_name:
+            # Handle the case where we are pushing a membership event to
+            # that user, as they might not be already joined.
+            if self._event.type == EventTypes.Member and self._event.state_key == uid:
+                display_name = self._event.content.get("displayname", None)
+
+        return display_name
 
 
 class RulesForRoom(object):
@@ -246,6 +438,19 @@ class RulesForRoom(object):
         self.member_map = {}  # event_id -> (user_id, state)
         self.rules_by_user = {}  # user_id -> rules
 
+        # The rules_by_user dict we last compiled, and its CompiledRulesForRoom.
+        # The rules_by_user dicts we return are never modified afterwards, so
+        # this stays valid for as long as we keep returning the same dict.
+        self._compiled_rules = None
+
+        # id(rules) -> (rules, key) for the lists of rules we last compiled,
+        # so that we only need to work out keys for new rules when recompiling.
+        self._rules_keys = {}
+
+        # The room_members dict we last indexed the display names of, and the
+        # WordBoundaryGlobIndex for them.
+        self._display_name_index = None
+
         # The last state group we updated the caches for. If the state_group of
         # a new event comes along, we know that we can just return the cached
         # result.
@@ -299,7 +504,9 @@ class RulesForRoom(object):
             if state_group and self.state_group == context.prev_group:
                 # If we have a simple delta then we can reuse most of the previous
                 # results.
-                ret_rules_by_user = self.rules_by_user
+                # We copy the previous rules, as we promise not to modify a
+                # dict once we've returned it.
+                ret_rules_by_user = dict(self.rules_by_user)
                 current_state_ids = context.delta_ids
 
                 push_rules_delta_state_cache_metric.inc_hits()
@@ -369,6 +576,54 @@ class RulesForRoom(object):
             )
         return ret_rules_by_user
 
+    def get_compiled_rules(self, rules_by_user):
+        """Get the compiled form of a rules_by_user dict returned by `get_rules`.
+
+        The result is cached until a different dict is passed in, so it is only
+        recompiled when the rules or the users in the room change.
+
+        Args:
+            rules_by_user (dict[str, list[dict]])
+
+        Returns:
+            CompiledRulesForRoom
+        """
+        if self._compiled_rules is not None:
+            compiled_for, compiled_rules = self._compiled_rules
+            if compiled_for is rules_by_user:
+                return compiled_rules
+
+        push_rules_compile_counter.inc()
+        compiled_rules = CompiledRulesForRoom(rules_by_user, self._rules_keys)
+        self._compiled_rules = (rules_by_user, compiled_rules)
+        return compiled_rules
+
+    def get_display_name_index(self, room_members):
+        """Get an index of the display names of the given room members.
+
+        Args:
+            room_members (dict[str, ProfileInfo]): As returned by
+                `get_joined_users_from_context`.
+
+        Returns:
+            WordBoundaryGlobIndex: Finds the users whose display name appears
+            in a message body.
+        """
+        if self._display_name_index is not None:
+            indexed_members, index = self._display_name_index
+            if indexed_members is room_members:
+                return index
+
+        index = WordBoundaryGlobIndex(
+            {
+                uid: profile_info.display_name
+                for uid, profile_info in iteritems(room_members)
+                if profile_info.display_name
+            }
+        )
+        self._display_name_index = (room_members, index)
+        return index
+
     @defer.inlineCallbacks
     def _update_rules_with_member_event_ids(
         self, ret_rules_by_user, member_event_ids, state_group, event
@@ -449,6 +704,7 @@ class RulesForRoom(object):
         self.state_group = object()
         self.member_map = {}
         self.rules_by_user = {}
+        self._compiled_rules = None
         push_rules_invalidation_counter.inc()
 
     def update_cache(self, sequence, members, rules_by_user, state_group):
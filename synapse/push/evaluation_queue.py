@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from prometheus_client import Counter, Histogram
+
+from synapse.events.snapshot import EventContext
+from synapse.metrics.background_process_metrics import run_as_background_process
+
+logger = logging.getLogger(__name__)
+
+deferred_evaluation_lag = Histogram(
+    "synapse_push_deferred_evaluation_lag_seconds",
+    "Time between an event being queued for push evaluation and its push actions "
+    "being added",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, "+Inf"),
+)
+
+deferred_evaluation_failures = Counter(
+    "synapse_push_deferred_evaluation_failures",
+    "Number of events whose deferred push evaluation failed",
+)
+
+# The maximum number of events to calculate the push actions for at a time.
+EVALUATION_BATCH_SIZE = 100
+
+# How long an event can be queued without being persisted before we assume it
+# never will be, e.g. because we restarted while persisting it.
+STALE_EVALUATION_MS = 60 * 60 * 1000
+
+
+class PushEvaluationQueue(object):
+    """Calculates the push actions for events queued up by the ActionGenerator
+    to be evaluated after they have been persisted. See
+    `push.deferred_evaluation_room_size`.
+
+    Pushers must only be told about new events once the push actions for them
+    have been added, or they would skip past them. So we keep track of the
+    stream ordering that all the queued events before have been evaluated up
+    to, and tell the pushers about new events as it advances.
+    """
+
+    def __init__(self, hs, on_evaluated):
+        """
+        Args:
+            hs (synapse.server.HomeServer)
+            on_evaluated (Callable[[int, int], Deferred]): Called with a range
+                of stream orderings once the push actions for all events in it
+                have been added.
+        """
+        self.clock = hs.get_clock()
+        self.store = hs.get_datastore()
+        self.state_store = hs.get_storage().state
+        self.bulk_evaluator = hs.get_action_generator().bulk_evaluator
+        self._on_evaluated = on_evaluated
+
+        # The stream ordering up to which we have told the pushers about events.
+        self._evaluated_stream_ordering = self.store.get_room_max_stream_ordering()
+
+        self._is_processing = False
+        self._should_reprocess = False
+
+        self.clock.looping_call(self._start_delete_stale_evaluations, 60 * 1000)
+
+    def on_new_events(self):
+        """Called when new events have been persisted."""
+        if self._is_processing:
+            self._should_reprocess = True
+            return
+
+        run_as_background_process("push_evaluation_queue", self._process)
+
+    async def _process(self):
+        self._is_processing = True
+        try:
+            while True:
+                self._should_reprocess = False
+                caught_up = await self._process_batch()
+                if caught_up and not self._should_reprocess:
+                    break
+        except Exception:
+            logger.exception("Error processing deferred push evaluations")
+        finally:
+            self._is_processing = False
+
+    async def _process_batch(self):
+        """Add the push actions for the next batch of queued events, and tell
+        the pushers about them.
+
+        Returns:
+            bool: True if there are no more queued events to evaluate.
+        """
+        # Any event before the current max stream ordering has been persisted,
+        # so will be in the queue if its push evaluation was deferred.
+        max_stream_ordering = self.store.get_room_max_stream_ordering()
+
+        rows = await self.store.get_deferred_push_evaluations(
+            max_stream_ordering, EVALUATION_BATCH_SIZE
+        )
+
+        if rows:
+            event_ids = [event_id for event_id, _, _ in rows]
+            events_and_actions = await self._evaluate(event_ids)
+            await self.store.add_deferred_push_actions(event_ids, events_and_actions)
+
+            now = self.clock.time_msec()
+            for _, _, queued_ts in rows:
+                deferred_evaluation_lag.observe((now - queued_ts) / 1000.0)
+
+        caught_up = len(rows) < EVALUATION_BATCH_SIZE
+        if caught_up:
+            evaluated_stream_ordering = max_stream_ordering
+        else:
+            evaluated_stream_ordering = rows[-1][1]
+
+        min_stream_ordering = self._evaluated_stream_ordering + 1
+        if rows:
+            # We may have been restarted with events still queued from before
+            # the stream ordering we started at.
+            min_stream_ordering = min(min_stream_ordering, rows[0][1])
+
+        if evaluated_stream_ordering >= min_stream_ordering:
+            self._evaluated_stream_ordering = max(
+                self._evaluated_stream_ordering, evaluated_stream_ordering
+            )
+            await self._on_evaluated(min_stream_ordering, evaluated_stream_ordering)
+
+        return caught_up
+
+    async def _evaluate(self, event_ids):
+        """Calculate the push actions for the given persisted events.
+
+        Args:
+            event_ids (list[str])
+
+        Returns:
+            list[tuple[EventBase, dict[str, list]]]: The events, each with the
+            push actions for each user to notify.
+        """
+        events = await self.store.get_events(event_ids, allow_rejected=True)
+        state_groups = await self.store._get_state_group_for_events(event_ids)
+        state_ids_by_event = await self.state_store.get_state_ids_for_events(event_ids)
+
+        events_and_actions = []
+        for event_id in event_ids:
+            event = events.get(event_id)
+            if not event or event.rejected_reason:
+                continue
+
+            # Only non-state events get queued, so the state before and after
+            # the event are the same.
+            state_group = state_groups.get(event_id)
+            state_ids = state_ids_by_event.get(event_id, {})
+            context = EventContext.with_state(
+                state_group=state_group,
+                state_group_before_event=state_group,
+                current_state_ids=state_ids,
+                prev_state_ids=state_ids,
+            )
+
+            try:
+                actions_by_user = await self.bulk_evaluator.get_actions_for_event_by_user(
+                    event, context
+                )
+            except Exception:
+                # We don't want one bad event to hold up notifications for all
+                # the events after it.
+                logger.exception("Failed to calculate push actions for %s", event_id)
+                deferred_evaluation_failures.inc()
+                continue
+
+            events_and_actions.append((event, actions_by_user))
+
+        return events_and_actions
+
+    def _start_delete_stale_evaluations(self):
+        return run_as_background_process(
+            "delete_stale_deferred_push_evaluations",
+            self.store.delete_stale_deferred_push_evaluations,
+            self.clock.time_msec() - STALE_EVALUATION_MS,
+        )
@@ -103,7 +103,7 @@ class HttpPusher(object):
         if "url" not in self.data:
             raise PusherConfigException("'url' required in data for HTTP pusher")
         self.url = self.data["url"]
-        self.http_client = hs.get_proxied_http_client()
+        self.push_gateway_client = hs.get_push_gateway_client()
         self.data_minus_url = {}
         self.data_minus_url.update(self.data)
         del self.data_minus_url["url"]
@@ -374,9 +374,11 @@ class HttpPusher(object):
         notification_dict = yield self._build_notification_dict(event, tweaks, badge)
         if not notification_dict:
             return []
+        notification = dict(notification_dict["notification"])
+        (device,) = notification.pop("devices")
         try:
-            resp = yield self.http_client.post_json_get_json(
-                self.url, notification_dict
+            rejected = yield self.push_gateway_client.send_notification(
+                self.url, notification, device
             )
         except Exception as e:
             logger.warning(
@@ -387,9 +389,6 @@ class HttpPusher(object):
                 e,
             )
             return False
-        rejected = []
-        if "rejected" in resp:
-            rejected = resp["rejected"]
         return rejected
 
     @defer.inlineCallbacks
@@ -399,24 +398,27 @@ class HttpPusher(object):
             badge (int): number of unread messages
         """
         logger.debug("Sending updated badge count %d to %s", badge, self.name)
-        d = {
-            "notification": {
-                "id": "",
-                "type": None,
-                "sender": "",
-                "counts": {"unread": badge},
-                "devices": [
-                    {
-                        "app_id": self.app_id,
-                        "pushkey": self.pushkey,
-                        "pushkey_ts": long(self.pushkey_ts / 1000),
-                        "data": self.data_minus_url,
-                    }
-                ],
-            }
+        notification = {
+            "id": "",
+            "type": None,
+            "sender": "",
+            "counts": {"unread": badge},
+        }
+        device = {
+            "app_id": self.app_id,
+            "pushkey": self.pushkey,
+            "pushkey_ts": long(self.pushkey_ts / 1000),
+            "data": self.data_minus_url,
         }
         try:
-            yield self.http_client.post_json_get_json(self.url, d)
+            # Only the latest badge count matters, so any update still queued
+            # for the device can be replaced by this one.
+            yield self.push_gateway_client.send_notification(
+                self.url,
+                notification,
+                device,
+                coalesce_key=("badge", self.app_id, self.pushkey),
+            )
             http_badges_processed_counter.inc()
         except Exception as e:
             logger.warning(
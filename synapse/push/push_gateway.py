@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import logging
+import urllib.parse
+from collections import OrderedDict
+from typing import Dict
+
+from canonicaljson import json
+from prometheus_client import Counter, Histogram
+
+from twisted.internet import defer
+
+from synapse.logging.context import PreserveLoggingContext, make_deferred_yieldable
+from synapse.metrics.background_process_metrics import run_as_background_process
+
+logger = logging.getLogger(__name__)
+
+# The `gateway` label of the metrics below is the host of the push gateway if it
+# is listed in `push.gateway_metrics_hosts`, or this otherwise. Pusher URLs are
+# chosen by clients, so labelling by every one of them would let any user add
+# series to the metrics without limit.
+OTHER_GATEWAY_LABEL = "other"
+
+gateway_request_duration = Histogram(
+    "synapse_http_httppusher_gateway_request_duration_seconds",
+    "Time taken for requests to push gateways",
+    ["gateway", "outcome"],
+)
+
+gateway_request_devices = Histogram(
+    "synapse_http_httppusher_gateway_request_devices",
+    "Number of devices sent to a push gateway in each request",
+    ["gateway"],
+    buckets=(1, 2, 5, 10, 20, 50, "+Inf"),
+)
+
+gateway_coalesced_counter = Counter(
+    "synapse_http_httppusher_gateway_coalesced",
+    "Number of queued pushes which were replaced by a later push to the same device",
+    ["gateway"],
+)
+
+# The maximum number of devices we send a notification to in one request.
+MAX_DEVICES_PER_REQUEST = 20
+
+
+class _PendingRequest(object):
+    """A notification waiting to be sent to a push gateway.
+
+    Attributes:
+        notification (dict): The notification, without its devices.
+        devices (OrderedDict[object, tuple[dict, list[Deferred]]]): The devices
+            to send it to, each with the deferreds waiting on the result.
+    """
+
+    __slots__ = ["notification", "devices"]
+
+    def __init__(self, notification):
+        self.notification = notification
+        self.devices = OrderedDict()  # type: OrderedDict[object, tuple]
+
+
+class _Gateway(object):
+    """The requests queued up for a push gateway URL."""
+
+    __slots__ = [
+        "url",
+        "metrics_label",
+        "in_flight",
+        "pending",
+        "open_requests",
+        "coalescable",
+    ]
+
+    def __init__(self, url, metrics_label):
+        self.url = url
+
+        # The `gateway` label to report metrics about the gateway under.
+        self.metrics_label = metrics_label
+
+        # The number of requests currently being made to the gateway.
+        self.in_flight = 0
+
+        # The requests waiting to be sent, in order, keyed by an arbitrary id.
+        self.pending = OrderedDict()  # type: OrderedDict[int, _PendingRequest]
+
+        # The pending requests which can still have more devices added, by the
+        # serialised notification.
+        self.open_requests = {}  # type: Dict[str, _PendingRequest]
+
+        # Map from coalesce key to the pending request it is queued in.
+        self.coalescable = {}  # type: Dict[object, _PendingRequest]
+
+
+class PushGatewayClient(object):
+    """Sends notifications to push gateways on behalf of the HTTP pushers.
+
+    Requests to each gateway URL share a queue, with at most
+    `push.gateway_max_concurrent_requests` in flight at a time, so that a
+    message to a big room doesn't open a flood of connections to the same
+    gateway. The rest reuse the HTTP client's persistent connections as they
+    free up.
+
+    While requests are queued we:
+
+    * batch identical notifications for different devices into a single
+      request, as the push gateway API allows; and
+    * replace pushes which have been marked as coalescable (i.e. badge updates)
+      with any later push for the same device.
+    """
+
+    def __init__(self, hs):
+        self.clock = hs.get_clock()
+        self.http_client = hs.get_proxied_http_client()
+        self.max_concurrent_requests = hs.config.push_gateway_max_concurrent_requests
+        self.metrics_hosts = hs.config.push_gateway_metrics_hosts
+
+        self._gateways = {}  # type: Dict[str, _Gateway]
+        self._request_ids = itertools.count()
+
+    def send_notification(self, url, notification, device, coalesce_key=None):
+        """Send a notification to a device via a push gateway.
+
+        Args:
+            url (str): The URL of the push gateway.
+            notification (dict): The notification to send, without the
+                `devices` key.
+            device (dict): The device to send it to.
+            coalesce_key (object|None): If set, this push can be replaced by a
+                later push with the same coalesce key while it is queued.
+
+        Returns:
+            Deferred[list[str]]: The pushkeys of the device which were
+            rejected by the gateway. Fails if the request failed.
+        """
+        gateway = self._gateways.get(url)
+        if gateway is None:
+            gateway = self._gateways[url] = _Gateway(url, self._metrics_label(url))
+
+        d = defer.Deferred()
+        waiting = [d]
+
+        if coalesce_key is not None:
+            previous = gateway.coalescable.pop(coalesce_key, None)
+            if previous is not None:
+                _, previous_waiting = previous.devices.pop(coalesce_key)
+                waiting.extend(previous_waiting)
+                gateway_coalesced_counter.labels(gateway.metrics_label).inc()
+                self._discard_if_empty(gateway, previous)
+
+        notification_key = json.dumps(notification, sort_keys=True)
+        request = gateway.open_requests.get(notification_key)
+        if request is None:
+            request = _PendingRequest(notification)
+            gateway.pending[next(self._request_ids)] = request
+            gateway.open_requests[notification_key] = request
+
+        device_key = coalesce_key
+        if device_key is None:
+            device_key = json.dumps(device, sort_keys=True)
+
+        if device_key in request.devices:
+            # The same notification is already queued for the device.
+            request.devices[device_key][1].extend(waiting)
+        else:
+            request.devices[device_key] = (device, waiting)
+
+        if coalesce_key is not None:
+            gateway.coalescable[coalesce_key] = request
+
+        if len(request.devices) >= MAX_DEVICES_PER_REQUEST:
+            gateway.open_requests.pop(notification_key, None)
+
+        self._send_pending(gateway)
+
+        return make_deferred_yieldable(d)
+
+    def _metrics_label(self, url):
+        """Get the `gateway` label to report metrics about a gateway under.
+
+        Args:
+            url (str)
+
+        Returns:
+            str
+        """
+        try:
+            host = urllib.parse.urlparse(url).hostname
+        except ValueError:
+            host = None
+
+        if host in self.metrics_hosts:
+            return host
+        return OTHER_GATEWAY_LABEL
+
+    def _discard_if_empty(self, gateway, request):
+        if request.devices:
+            return
+
+        for request_id, pending in gateway.pending.items():
+            if pending is request:
+                del gateway.pending[request_id]
+                break
+
+        notification_key = json.dumps(request.notification, sort_keys=True)
+        if gateway.open_requests.get(notification_key) is request:
+            del gateway.open_requests[notification_key]
+
+    def _send_pending(self, gateway):
+        """Start sending queued requests to the gateway, up to the limit on
+        concurrent requests.
+        """
+        while gateway.pending and gateway.in_flight < self.max_concurrent_requests:
+            _, request = gateway.pending.popitem(last=False)
+
+            notification_key = json.dumps(request.notification, sort_keys=True)
+            if gateway.open_requests.get(notification_key) is request:
+                del gateway.open_requests[notification_key]
+
+            for device_key in request.devices:
+                if gateway.coalescable.get(device_key) is request:
+                    del gateway.coalescable[device_key]
+
+            gateway.in_flight += 1
+            run_as_background_process(
+                "push_gateway_send", self._send_request, gateway, request
+            )
+
+    async def _send_request(self, gateway, request):
+        devices = [device for device, _ in request.devices.values()]
+        body = {"notification": dict(request.notification, devices=devices)}
+
+        gateway_request_devices.labels(gateway.metrics_label).observe(len(devices))
+        start = self.clock.time()
+        try:
+            resp = await self.http_client.post_json_get_json(gateway.url, body)
+        except Exception as e:
+            gateway_request_duration.labels(gateway.metrics_label, "failure").observe(
+                self.clock.time() - start
+            )
+            with PreserveLoggingContext():
+                for _, waiting in request.devices.values():
+                    for d in waiting:
+                        d.errback(e)
+        else:
+            gateway_request_duration.labels(gateway.metrics_label, "success").observe(
+                self.clock.time() - start
+            )
+            rejected = resp.get("rejected", [])
+            with PreserveLoggingContext():
+                for device, waiting in request.devices.values():
+                    device_rejected = [
+                        pk for pk in rejected if pk == device.get("pushkey")
+                    ]
+                    for d in waiting:
+                        d.callback(device_rejected)
+        finally:
+            gateway.in_flight -= 1
+            self._send_pending(gateway)
+            if not gateway.in_flight and not gateway.pending:
+                self._gateways.pop(gateway.url, None)
@@ -17,7 +17,7 @@
 import logging
 import re
 
-from six import string_types
+from six import iteritems, string_types
 
 from synapse.types import UserID
 from synapse.util.caches import CACHE_SIZE_FACTOR, register_cache
@@ -29,6 +29,13 @@ logger = logging.getLogger(__name__)
 GLOB_REGEX = re.compile(r"\\\[(\\\!|)(.*)\\\]")
 IS_GLOB = re.compile(r"[\?\*\[\]]")
 INEQUALITY_EXPR = re.compile("^([=<>]*)([0-9]*)$")
+WORD_CHAR_REGEX = re.compile(r"\w")
+WORD_SPLIT_REGEX = re.compile(r"\W+")
+ASCII_WORD_REGEX = re.compile(r"[A-Za-z0-9_]+")
+
+# Characters other than ASCII letters which match ASCII letters when matching
+# case insensitively.
+ASCII_CASE_EQUIVALENTS_REGEX = re.compile("[\u0130\u0131\u017f\u212a]")
 
 
 def _room_member_count(ev, condition, room_member_count):
@@ -231,6 +238,81 @@ def _re_word_boundary(r):
     return r"(^|\W)%s(\W|$)" % (r,)
 
 
+class WordBoundaryGlobIndex(object):
+    """Finds which of a collection of globs match a string on word boundaries,
+    i.e. for which `_glob_matches(glob, value, word_boundary=True)` is true,
+    without testing every glob in turn.
+
+    Globs of plain text which start and end with a word character are indexed
+    by their first word, as that has to appear as a whole word in any string
+    they match. Only the globs whose first word appears in the string then need
+    testing, along with those which couldn't be indexed.
+    """
+
+    def __init__(self, globs):
+        """
+        Args:
+            globs (dict[str, str]): The globs to index, keyed by an identifier
+                which `matches` returns.
+        """
+        self._by_first_word = {}
+        self._unindexed = []
+
+        for key, glob in iteritems(globs):
+            if not glob:
+                continue
+
+            first_word = _indexable_first_word(glob)
+            if first_word is None:
+                self._unindexed.append((key, glob))
+            else:
+                self._by_first_word.setdefault(first_word, []).append((key, glob))
+
+    def matches(self, value):
+        """Returns the identifiers of the globs which match the given string.
+
+        Args:
+            value (str)
+
+        Returns:
+            set[str]
+        """
+        if ASCII_CASE_EQUIVALENTS_REGEX.search(value):
+            # We can't rely on splitting the value into lower cased words to
+            # find the globs which might match, so test them all.
+            candidates = list(self._unindexed)
+            for globs in self._by_first_word.values():
+                candidates.extend(globs)
+        else:
+            candidates = list(self._unindexed)
+            for word in set(WORD_SPLIT_REGEX.split(value.lower())):
+                candidates.extend(self._by_first_word.get(word, ()))
+
+        return {
+            key
+            for key, glob in candidates
+            if _glob_matches(glob, value, word_boundary=True)
+        }
+
+
+def _indexable_first_word(glob):
+    """Returns the lower cased first word of a glob which it can be indexed
+    under by `WordBoundaryGlobIndex`, or None if it can't be indexed.
+    """
+    if IS_GLOB.search(glob) or not WORD_CHAR_REGEX.match(glob[-1]):
+        return None
+
+    # We only index by ASCII words, as they are the only ones where lower casing
+    # them matches what case insensitive regex matching does.
+    m = ASCII_WORD_REGEX.match(glob)
+    if not m:
+        return None
+    if m.end() < len(glob) and WORD_CHAR_REGEX.match(glob[m.end()]):
+        return None
+
+    return m.group(0).lower()
+
+
 def _flatten_dict(d, prefix=[], result=None):
     if result is None:
         result = {}
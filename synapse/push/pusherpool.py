@@ -17,7 +17,7 @@
 import logging
 from collections import defaultdict
 from threading import Lock
-from typing import Dict, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 
 from twisted.internet import defer
 
@@ -25,6 +25,7 @@ from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.push import PusherConfigException
 from synapse.push.emailpusher import EmailPusher
+from synapse.push.evaluation_queue import PushEvaluationQueue
 from synapse.push.httppusher import HttpPusher
 from synapse.push.pusher import PusherFactory
 from synapse.util.async_helpers import concurrently_execute
@@ -54,6 +55,17 @@ class PusherPool:
         self.store = self.hs.get_datastore()
         self.clock = self.hs.get_clock()
 
+        # If push evaluation is being deferred until after events are persisted,
+        # the pushers get told about new events by the evaluation queue once
+        # their push actions have been added.
+        self._evaluation_queue = None  # type: Optional[PushEvaluationQueue]
+        if (
+            self._should_start_pushers
+            and not _hs.config.worker_app
+            and _hs.config.push_deferred_evaluation_room_size is not None
+        ):
+            self._evaluation_queue = PushEvaluationQueue(_hs, self._notify_pushers)
+
         # map from user id to app_id:pushkey to pusher
         self.pushers = {}  # type: Dict[str, Dict[str, Union[HttpPusher, EmailPusher]]]
 
@@ -85,6 +97,10 @@ class PusherPool:
             return
         run_as_background_process("start_pushers", self._start_pushers)
 
+        if self._evaluation_queue is not None:
+            # Pick up any events left in the queue when we last stopped.
+            self._evaluation_queue.on_new_events()
+
     @defer.inlineCallbacks
     def add_pusher(
         self,
@@ -189,6 +205,14 @@ class PusherPool:
 
     @defer.inlineCallbacks
     def on_new_notifications(self, min_stream_id, max_stream_id):
+        if self._evaluation_queue is not None:
+            self._evaluation_queue.on_new_events()
+            return
+
+        yield self._notify_pushers(min_stream_id, max_stream_id)
+
+    @defer.inlineCallbacks
+    def _notify_pushers(self, min_stream_id, max_stream_id):
         if not self.pushers:
             # nothing to do here.
             return
@@ -13,10 +13,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from twisted.internet import defer
+
 from synapse.storage.data_stores.main.transactions import TransactionStore
 
 from ._base import BaseSlavedStore
 
 
 class SlavedTransactionStore(TransactionStore, BaseSlavedStore):
-    pass
+    def set_destination_retry_timings(
+        self, destination, failure_ts, retry_last_ts, retry_interval
+    ):
+        # We use the new timings straight away, and the master persists them
+        # and streams them to the other workers.
+        if self._should_update_destination_retry_timings(destination, retry_interval):
+            self._update_destination_retry_timings(
+                destination, failure_ts, retry_last_ts, retry_interval
+            )
+
+        self.hs.get_tcp_replication().send_destination_retry(
+            destination, failure_ts, retry_last_ts, retry_interval
+        )
+        return defer.succeed(None)
+
+    def stream_positions(self):
+        result = super(SlavedTransactionStore, self).stream_positions()
+        result["destination_retry"] = self._destination_retry_stream_id
+        return result
+
+    def process_replication_rows(self, stream_name, token, rows):
+        if stream_name == "destination_retry":
+            self._destination_retry_stream_id = token
+            for row in rows:
+                self._update_destination_retry_timings(
+                    row.destination,
+                    row.failure_ts,
+                    row.retry_last_ts,
+                    row.retry_interval,
+                )
+        return super(SlavedTransactionStore, self).process_replication_rows(
+            stream_name, token, rows
+        )
@@ -29,6 +29,7 @@ from synapse.replication.tcp.protocol import (
 
 from .commands import (
     Command,
+    DestinationRetryCommand,
     FederationAckCommand,
     InvalidateCacheCommand,
     RemoteServerUpCommand,
@@ -182,11 +183,11 @@ class ReplicationClientHandler(AbstractReplicationClientHandler):
             logger.warning("Queuing command as not connected: %r", cmd.NAME)
             self.pending_commands.append(cmd)
 
-    def send_federation_ack(self, token):
+    def send_federation_ack(self, instance_name, token):
         """Ack data for the federation stream. This allows the master to drop
         data stored purely in memory.
         """
-        self.send_command(FederationAckCommand(token))
+        self.send_command(FederationAckCommand(instance_name, token))
 
     def send_user_sync(self, user_id, is_syncing, last_sync_ms):
         """Poke the master that a user has started/stopped syncing.
@@ -214,6 +215,16 @@ class ReplicationClientHandler(AbstractReplicationClientHandler):
     def send_remote_server_up(self, server: str):
         self.send_command(RemoteServerUpCommand(server))
 
+    def send_destination_retry(
+        self, destination, failure_ts, retry_last_ts, retry_interval
+    ):
+        """Tell the master that we have updated a destination's retry timings.
+        """
+        cmd = DestinationRetryCommand(
+            destination, failure_ts, retry_last_ts, retry_interval
+        )
+        self.send_command(cmd)
+
     def await_sync(self, data):
         """Returns a deferred that is resolved when we receive a SYNC command
         with given data.
@@ -261,24 +261,27 @@ class FederationAckCommand(Command):
     federation stream. This allows the master to drop in-memory caches of the
     federation stream.
 
-    This must only be sent from one worker (i.e. the one sending federation)
+    This must only be sent from the workers sending federation, which identify
+    themselves by their `worker_name`.
 
     Format::
 
-        FEDERATION_ACK <token>
+        FEDERATION_ACK <instance_name> <token>
     """
 
     NAME = "FEDERATION_ACK"
 
-    def __init__(self, token):
+    def __init__(self, instance_name, token):
+        self.instance_name = instance_name
         self.token = token
 
     @classmethod
     def from_line(cls, line):
-        return cls(int(line))
+        instance_name, token = line.rsplit(" ", 1)
+        return cls(instance_name, int(token))
 
     def to_line(self):
-        return str(self.token)
+        return "%s %s" % (self.instance_name, self.token)
 
 
 class SyncCommand(Command):
@@ -401,6 +404,43 @@ class RemoteServerUpCommand(Command):
     NAME = "REMOTE_SERVER_UP"
 
 
+class DestinationRetryCommand(Command):
+    """Sent when a worker has updated the retry timings of a remote server.
+
+    The server applies the update and streams the resulting timings to all
+    workers on the `destination_retry` stream.
+
+    Format::
+
+        DESTINATION_RETRY <destination> <json: [failure_ts, retry_last_ts, retry_interval]>
+    """
+
+    NAME = "DESTINATION_RETRY"
+
+    def __init__(self, destination, failure_ts, retry_last_ts, retry_interval):
+        self.destination = destination
+        self.failure_ts = failure_ts
+        self.retry_last_ts = retry_last_ts
+        self.retry_interval = retry_interval
+
+    @classmethod
+    def from_line(cls, line):
+        destination, jsn = line.split(" ", 1)
+
+        failure_ts, retry_last_ts, retry_interval = json.loads(jsn)
+
+        return cls(destination, failure_ts, retry_last_ts, retry_interval)
+
+    def to_line(self):
+        return (
+            self.destination
+            + " "
+            + _json_encoder.encode(
+                (self.failure_ts, self.retry_last_ts, self.retry_interval)
+            )
+        )
+
+
 _COMMANDS = (
     ServerCommand,
     RdataCommand,
@@ -416,6 +456,7 @@ _COMMANDS = (
     InvalidateCacheCommand,
     UserIpCommand,
     RemoteServerUpCommand,
+    DestinationRetryCommand,
 )  # type: Tuple[Type[Command], ...]
 
 # Map of command name to command type.
@@ -444,4 +485,5 @@ VALID_CLIENT_COMMANDS = (
     UserIpCommand.NAME,
     ErrorCommand.NAME,
     RemoteServerUpCommand.NAME,
+    DestinationRetryCommand.NAME,
 )
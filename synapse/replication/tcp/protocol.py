@@ -453,7 +453,7 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
             await self.subscribe_to_stream(stream_name, token)
 
     async def on_FEDERATION_ACK(self, cmd):
-        self.streamer.federation_ack(cmd.token)
+        self.streamer.federation_ack(cmd.instance_name, cmd.token)
 
     async def on_REMOVE_PUSHER(self, cmd):
         await self.streamer.on_remove_pusher(cmd.app_id, cmd.push_key, cmd.user_id)
@@ -464,6 +464,11 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
     async def on_REMOTE_SERVER_UP(self, cmd: RemoteServerUpCommand):
         self.streamer.on_remote_server_up(cmd.data)
 
+    async def on_DESTINATION_RETRY(self, cmd):
+        await self.streamer.on_destination_retry(
+            cmd.destination, cmd.failure_ts, cmd.retry_last_ts, cmd.retry_interval
+        )
+
     async def on_USER_IP(self, cmd):
         self.streamer.on_user_ip(
             cmd.user_id,
@@ -243,12 +243,12 @@ class ReplicationStreamer(object):
         return await stream.get_updates_since(token)
 
     @measure_func("repl.federation_ack")
-    def federation_ack(self, token):
+    def federation_ack(self, instance_name, token):
         """We've received an ack for federation stream from a client.
         """
         federation_ack_counter.inc()
         if self.federation_sender:
-            self.federation_sender.federation_ack(token)
+            self.federation_sender.federation_ack(instance_name, token)
 
     @measure_func("repl.on_user_sync")
     async def on_user_sync(self, conn_id, user_id, is_syncing, last_sync_ms):
@@ -292,6 +292,16 @@ class ReplicationStreamer(object):
         )
         await self._server_notices_sender.on_user_ip(user_id)
 
+    @measure_func("repl.on_destination_retry")
+    async def on_destination_retry(
+        self, destination, failure_ts, retry_last_ts, retry_interval
+    ):
+        """The client updated the retry timings of a remote server
+        """
+        await self.store.set_destination_retry_timings(
+            destination, failure_ts, retry_last_ts, retry_interval
+        )
+
     @measure_func("repl.on_remote_server_up")
     def on_remote_server_up(self, server: str):
         self.notifier.notify_remote_server_up(server)
@@ -46,5 +46,6 @@ STREAMS_MAP = {
         _base.AccountDataStream,
         _base.GroupServerStream,
         _base.UserSignatureStream,
+        _base.DestinationRetryStream,
     )
 }
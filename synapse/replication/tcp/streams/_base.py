@@ -109,6 +109,15 @@ GroupsStreamRow = namedtuple(
     ("group_id", "user_id", "type", "content"),  # str  # str  # str  # dict
 )
 UserSignatureStreamRow = namedtuple("UserSignatureStreamRow", ("user_id"))  # str
+DestinationRetryStreamRow = namedtuple(
+    "DestinationRetryStreamRow",
+    (
+        "destination",  # str
+        "failure_ts",  # int, optional
+        "retry_last_ts",  # int
+        "retry_interval",  # int
+    ),
+)
 
 
 class Stream(object):
@@ -467,3 +476,20 @@ class UserSignatureStream(Stream):
         self.update_function = store.get_all_user_signature_changes_for_remotes  # type: ignore
 
         super(UserSignatureStream, self).__init__(hs)
+
+
+class DestinationRetryStream(Stream):
+    """The retry timings of a remote server have changed
+    """
+
+    NAME = "destination_retry"
+    _LIMITED = False
+    ROW_TYPE = DestinationRetryStreamRow
+
+    def __init__(self, hs):
+        store = hs.get_datastore()
+
+        self.current_token = store.get_destination_retry_stream_token  # type: ignore
+        self.update_function = store.get_all_destination_retry_updates  # type: ignore
+
+        super(DestinationRetryStream, self).__init__(hs)
@@ -26,7 +26,8 @@ from synapse.events.utils import (
     format_event_raw,
 )
 from synapse.handlers.presence import format_user_presence_state
-from synapse.handlers.sync import SyncConfig
+from synapse.handlers.sync import InitialSyncContinuation, SyncConfig
+from synapse.http.server import _request_user_agent_is_curl, respond_with_json_stream
 from synapse.http.servlet import RestServlet, parse_boolean, parse_integer, parse_string
 from synapse.types import StreamToken
 
@@ -144,19 +145,28 @@ class SyncRestServlet(RestServlet):
                 # fix up the description and errcode to be more useful
                 raise SynapseError(400, "No such filter", errcode=Codes.INVALID_PARAM)
 
+        continuation = None
+        if since is not None:
+            # A bounded initial sync which hasn't sent all the joined rooms yet
+            # tacks where it got up to on to the end of the token.
+            since, sep, continuation_str = since.partition(
+                InitialSyncContinuation.SEPARATOR
+            )
+            if sep:
+                continuation = InitialSyncContinuation.from_string(continuation_str)
+            since_token = StreamToken.from_string(since)
+        else:
+            since_token = None
+
         sync_config = SyncConfig(
             user=user,
             filter_collection=filter_collection,
             is_guest=requester.is_guest,
             request_key=request_key,
             device_id=device_id,
+            initial_sync_continuation=continuation,
         )
 
-        if since is not None:
-            since_token = StreamToken.from_string(since)
-        else:
-            since_token = None
-
         # send any outstanding server notices to the user.
         await self._server_notices_sender.on_user_syncing(user.to_string())
 
@@ -183,7 +193,16 @@ class SyncRestServlet(RestServlet):
             time_now, sync_result, requester.access_token_id, filter_collection
         )
 
-        return 200, response_content
+        # Sync responses can be very large, so we encode them a chunk at a time
+        # as they are written rather than all in one go.
+        respond_with_json_stream(
+            request,
+            200,
+            response_content,
+            send_cors=True,
+            pretty_print=_request_user_agent_is_curl(request),
+            canonical_json=False,
+        )
 
     async def encode_response(self, time_now, sync_result, access_token_id, filter):
         if filter.event_format == "client":
@@ -228,9 +247,19 @@ class SyncRestServlet(RestServlet):
                 "leave": sync_result.groups.leave,
             },
             "device_one_time_keys_count": sync_result.device_one_time_keys_count,
-            "next_batch": sync_result.next_batch.to_string(),
+            "next_batch": self.encode_next_batch(sync_result),
         }
 
+    @staticmethod
+    def encode_next_batch(sync_result):
+        next_batch = sync_result.next_batch.to_string()
+        if sync_result.initial_sync_continuation:
+            next_batch += (
+                InitialSyncContinuation.SEPARATOR
+                + sync_result.initial_sync_continuation.to_string()
+            )
+        return next_batch
+
     @staticmethod
     def encode_presence(events, time_now):
         return {
@@ -84,6 +84,7 @@ from synapse.http.client import InsecureInterceptableContextFactory, SimpleHttpC
 from synapse.http.matrixfederationclient import MatrixFederationHttpClient
 from synapse.notifier import Notifier
 from synapse.push.action_generator import ActionGenerator
+from synapse.push.push_gateway import PushGatewayClient
 from synapse.push.pusherpool import PusherPool
 from synapse.rest.media.v1.media_repository import (
     MediaRepository,
@@ -164,6 +165,7 @@ class HomeServer(object):
         "event_sources",
         "keyring",
         "pusherpool",
+        "push_gateway_client",
         "event_builder_factory",
         "filtering",
         "http_client_context_factory",
@@ -419,6 +421,9 @@ class HomeServer(object):
     def build_pusherpool(self):
         return PusherPool(self)
 
+    def build_push_gateway_client(self):
+        return PushGatewayClient(self)
+
     def build_http_client(self):
         tls_client_options_factory = context_factory.FederationPolicyForHTTPS(
             self.config
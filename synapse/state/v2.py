@@ -167,51 +167,54 @@ def resolve_events_with_store(
     return resolved_state
 
 
-@defer.inlineCallbacks
-def _get_power_level_for_sender(room_id, event_id, event_map, state_res_store):
+def _get_power_level_for_sender(event, auth_events, power_level_cache=None):
     """Return the power level of the sender of the given event according to
     their auth events.
 
     Args:
-        room_id (str)
-        event_id (str)
-        event_map (dict[str,FrozenEvent])
-        state_res_store (StateResolutionStore)
+        event (FrozenEvent)
+        auth_events (list[FrozenEvent]): the auth events of `event`, in the
+            order they are listed in the event.
+        power_level_cache (dict[tuple[str, str], int]|None): if given, a map
+            from (power level event ID, sender) to power level, used to avoid
+            recalculating the level of the same sender under the same power
+            level event. Updated in place.
 
     Returns:
-        Deferred[int]
+        int
     """
-    event = yield _get_event(room_id, event_id, event_map, state_res_store)
-
     pl = None
-    for aid in event.auth_event_ids():
-        aev = yield _get_event(
-            room_id, aid, event_map, state_res_store, allow_none=True
-        )
-        if aev and (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
+    for aev in auth_events:
+        if (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
             pl = aev
             break
 
     if pl is None:
         # Couldn't find power level. Check if they're the creator of the room
-        for aid in event.auth_event_ids():
-            aev = yield _get_event(
-                room_id, aid, event_map, state_res_store, allow_none=True
-            )
-            if aev and (aev.type, aev.state_key) == (EventTypes.Create, ""):
+        for aev in auth_events:
+            if (aev.type, aev.state_key) == (EventTypes.Create, ""):
                 if aev.content.get("creator") == event.sender:
                     return 100
                 break
         return 0
 
+    cache_key = (pl.event_id, event.sender)
+    if power_level_cache is not None and cache_key in power_level_cache:
+        return power_level_cache[cache_key]
+
     level = pl.content.get("users", {}).get(event.sender)
     if level is None:
         level = pl.content.get("users_default", 0)
 
     if level is None:
-        return 0
+        level = 0
     else:
-        return int(level)
+        level = int(level)
+
+    if power_level_cache is not None:
+        power_level_cache[cache_key] = level
+
+    return level
 
 
 @defer.inlineCallbacks
@@ -307,7 +310,12 @@ def _add_event_and_auth_chain_to_graph(
         eid = state.pop()
         graph.setdefault(eid, set())
 
-        event = yield _get_event(room_id, eid, event_map, state_res_store)
+        # Everything in the event map has already been checked to be in the
+        # right room, so we only need to go via `_get_event` for misses.
+        event = event_map.get(eid)
+        if event is None:
+            event = yield _get_event(room_id, eid, event_map, state_res_store)
+
         for aid in event.auth_event_ids():
             if aid in auth_diff:
                 if aid not in graph:
@@ -340,12 +348,39 @@ def _reverse_topological_power_sort(
             graph, room_id, event_id, event_map, state_res_store, auth_diff
         )
 
+    # Pull in any auth events we don't have yet in one go, rather than one at
+    # a time while looking up the power level of each sender.
+    missing_auth_event_ids = {
+        aid
+        for event_id in graph
+        for aid in event_map[event_id].auth_event_ids()
+        if aid not in event_map
+    }
+    if missing_auth_event_ids:
+        events = yield state_res_store.get_events(
+            list(missing_auth_event_ids), allow_rejected=True
+        )
+        for event in events.values():
+            if event.room_id != room_id:
+                raise Exception(
+                    "In state res for room %s, event %s is in %s"
+                    % (room_id, event.event_id, event.room_id)
+                )
+        event_map.update(events)
+
+    # Many events in the graph share both a sender and a power level event, so
+    # we only calculate each such power level once.
+    power_level_cache = {}
+
     event_to_pl = {}
     for event_id in graph:
-        pl = yield _get_power_level_for_sender(
-            room_id, event_id, event_map, state_res_store
+        event = event_map[event_id]
+        auth_events = [
+            event_map[aid] for aid in event.auth_event_ids() if aid in event_map
+        ]
+        event_to_pl[event_id] = _get_power_level_for_sender(
+            event, auth_events, power_level_cache
         )
-        event_to_pl[event_id] = pl
 
     def _get_power_order(event_id):
         ev = event_map[event_id]
@@ -353,7 +388,6 @@ def _reverse_topological_power_sort(
 
         return -pl, ev.origin_server_ts, event_id
 
-    # Note: graph is modified during the sort
     it = lexicographical_topological_sort(graph, key=_get_power_order)
     sorted_events = list(it)
 
@@ -550,7 +584,7 @@ def lexicographical_topological_sort(graph, key):
     appears before A in the sort), with ties broken lexicographically based on
     return value of the `key` function.
 
-    NOTE: `graph` is modified during the sort.
+    `key` is called at most once per node.
 
     Args:
         graph (dict[str, set[str]]): A representation of the graph where each
@@ -565,7 +599,11 @@ def lexicographical_topological_sort(graph, key):
     # Note, this is basically Kahn's algorithm except we look at nodes with no
     # outgoing edges, c.f.
     # https://en.wikipedia.org/wiki/Topological_sorting#Kahn's_algorithm
-    outdegree_map = graph
+    #
+    # Rather than removing edges from `graph` as we go we keep a count of the
+    # remaining outgoing edges of each node, which leaves the graph untouched
+    # and means each edge is only looked at twice.
+    outdegree_map = {}
     reverse_graph = {}
 
     # Lists of nodes with zero out degree. Is actually a tuple of
@@ -573,12 +611,13 @@ def lexicographical_topological_sort(graph, key):
     zero_outdegree = []
 
     for node, edges in iteritems(graph):
+        outdegree_map[node] = len(edges)
         if len(edges) == 0:
             zero_outdegree.append((key(node), node))
 
-        reverse_graph.setdefault(node, set())
+        reverse_graph.setdefault(node, [])
         for edge in edges:
-            reverse_graph.setdefault(edge, set()).add(node)
+            reverse_graph.setdefault(edge, []).append(node)
 
     # heapq is a built in implementation of a sorted queue.
     heapq.heapify(zero_outdegree)
@@ -587,9 +626,8 @@ def lexicographical_topological_sort(graph, key):
         _, node = heapq.heappop(zero_outdegree)
 
         for parent in reverse_graph[node]:
-            out = outdegree_map[parent]
-            out.discard(node)
-            if len(out) == 0:
+            outdegree_map[parent] -= 1
+            if outdegree_map[parent] == 0:
                 heapq.heappush(zero_outdegree, (key(parent), parent))
 
         yield node
@@ -29,7 +29,6 @@ from synapse.logging.opentracing import (
     trace,
     whitelisted_homeserver,
 )
-from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage._base import SQLBaseStore, db_to_json, make_in_list_sql_clause
 from synapse.storage.database import Database
 from synapse.types import Collection, get_verify_key_from_cross_signing_key
@@ -47,6 +46,12 @@ DROP_DEVICE_LIST_STREAMS_NON_UNIQUE_INDEXES = (
     "drop_device_list_streams_non_unique_indexes"
 )
 
+# If a destination has this many device list updates for a user waiting to be
+# sent, or one that is older than OUTBOUND_DEVICE_POKE_MAX_AGE_MS, we replace
+# them with a single update which makes it resync the user's device list.
+MAX_PENDING_OUTBOUND_DEVICE_POKES_PER_USER = 200
+OUTBOUND_DEVICE_POKE_MAX_AGE_MS = 24 * 60 * 60 * 1000
+
 
 class DeviceWorkerStore(SQLBaseStore):
     def get_device(self, user_id, device_id):
@@ -753,8 +758,6 @@ class DeviceStore(DeviceWorkerStore, DeviceBackgroundUpdateStore):
             name="device_id_exists", keylen=2, max_entries=10000
         )
 
-        self._clock.looping_call(self._prune_old_outbound_device_pokes, 60 * 60 * 1000)
-
     @defer.inlineCallbacks
     def store_device(self, user_id, device_id, initial_device_display_name):
         """Ensure the given device is known; add it to the store if not
@@ -1064,6 +1067,16 @@ class DeviceStore(DeviceWorkerStore, DeviceBackgroundUpdateStore):
             ],
         )
 
+        if not hosts:
+            return
+
+        # We don't delete earlier updates to the same devices here, even though
+        # only the latest needs sending: the federation sender may be sending
+        # them right now, and mark_as_sent_devices_by_remote relies on finding
+        # them to advance the destination's last successful position. Instead
+        # get_device_updates_by_remote skips updates which have been superseded.
+        self._collapse_outbound_device_pokes_txn(txn, user_id, hosts, now)
+
         context = get_active_span_text_map()
 
         self.db.simple_insert_many_txn(
@@ -1086,50 +1099,60 @@ class DeviceStore(DeviceWorkerStore, DeviceBackgroundUpdateStore):
             ],
         )
 
-    def _prune_old_outbound_device_pokes(self):
-        """Delete old entries out of the device_lists_outbound_pokes to ensure
-        that we don't fill up due to dead servers. We keep one entry per
-        (destination, user_id) tuple to ensure that the prev_ids remain correct
-        if the server does come back.
+    def _collapse_outbound_device_pokes_txn(self, txn, user_id, hosts, now):
+        """Drop the device list updates for the user which are waiting to be
+        sent to any of the given destinations that have a backlog of them,
+        either because the destination has been unreachable for a while or
+        because the user's devices keep changing.
+
+        The next update we send those destinations for the user will have no
+        prev_id, so they will resync the user's whole device list rather than
+        us sending them every change.
         """
-        yesterday = self._clock.time_msec() - 24 * 60 * 60 * 1000
-
-        def _prune_txn(txn):
-            select_sql = """
-                SELECT destination, user_id, max(stream_id) as stream_id
-                FROM device_lists_outbound_pokes
-                GROUP BY destination, user_id
-                HAVING min(ts) < ? AND count(*) > 1
-            """
+        min_ts = now - OUTBOUND_DEVICE_POKE_MAX_AGE_MS
 
-            txn.execute(select_sql, (yesterday,))
-            rows = txn.fetchall()
+        to_collapse = []
+        for batch in batch_iter(hosts, 100):
+            clause, args = make_in_list_sql_clause(
+                self.database_engine, "destination", batch
+            )
+            sql = """
+                SELECT destination FROM device_lists_outbound_pokes
+                WHERE user_id = ? AND %s
+                GROUP BY destination
+                HAVING count(*) >= ? OR min(ts) < ?
+            """ % (
+                clause,
+            )
+            txn.execute(
+                sql,
+                [user_id] + args + [MAX_PENDING_OUTBOUND_DEVICE_POKES_PER_USER, min_ts],
+            )
+            to_collapse.extend(destination for destination, in txn)
 
-            if not rows:
-                return
+        if not to_collapse:
+            return
 
-            delete_sql = """
-                DELETE FROM device_lists_outbound_pokes
-                WHERE ts < ? AND destination = ? AND user_id = ? AND stream_id < ?
+        txn.executemany(
             """
+            DELETE FROM device_lists_outbound_pokes
+            WHERE destination = ? AND user_id = ?
+            """,
+            [(destination, user_id) for destination in to_collapse],
+        )
 
-            txn.executemany(
-                delete_sql, ((yesterday, row[0], row[1], row[2]) for row in rows)
-            )
-
-            # Since we've deleted unsent deltas, we need to remove the entry
-            # of last successful sent so that the prev_ids are correctly set.
-            sql = """
-                DELETE FROM device_lists_outbound_last_success
-                WHERE destination = ? AND user_id = ?
+        # Since we've deleted unsent updates, we need to remove the entry of
+        # the last successful send so that the prev_ids are correctly set.
+        txn.executemany(
             """
-            txn.executemany(sql, ((row[0], row[1]) for row in rows))
-
-            logger.info("Pruned %d device list outbound pokes", txn.rowcount)
+            DELETE FROM device_lists_outbound_last_success
+            WHERE destination = ? AND user_id = ?
+            """,
+            [(destination, user_id) for destination in to_collapse],
+        )
 
-        return run_as_background_process(
-            "prune_old_outbound_device_pokes",
-            self.db.runInteraction,
-            "_prune_old_outbound_device_pokes",
-            _prune_txn,
+        logger.info(
+            "Collapsed outbound device list updates for %s to %d destinations",
+            user_id,
+            len(to_collapse),
         )
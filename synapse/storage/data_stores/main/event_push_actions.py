@@ -23,9 +23,14 @@ from canonicaljson import json
 from twisted.internet import defer
 
 from synapse.metrics.background_process_metrics import run_as_background_process
-from synapse.storage._base import LoggingTransaction, SQLBaseStore
+from synapse.storage._base import (
+    LoggingTransaction,
+    SQLBaseStore,
+    make_in_list_sql_clause,
+)
 from synapse.storage.database import Database
 from synapse.util.caches.descriptors import cachedInlineCallbacks
+from synapse.util.iterutils import batch_iter
 
 logger = logging.getLogger(__name__)
 
@@ -106,17 +111,30 @@ class EventPushActionsWorkerStore(SQLBaseStore):
     def _get_unread_counts_by_receipt_txn(
         self, txn, room_id, user_id, last_read_event_id
     ):
-        sql = (
-            "SELECT stream_ordering"
-            " FROM events"
-            " WHERE room_id = ? AND event_id = ?"
-        )
-        txn.execute(sql, (room_id, last_read_event_id))
+        sql = """
+            SELECT e.stream_ordering, c.receipt_stream_ordering, c.notif_count,
+                c.highlight_count
+            FROM events AS e
+            LEFT JOIN event_push_counts AS c ON (
+                c.room_id = e.room_id AND c.user_id = ?
+            )
+            WHERE e.room_id = ? AND e.event_id = ?
+        """
+        txn.execute(sql, (user_id, room_id, last_read_event_id))
         results = txn.fetchall()
         if len(results) == 0:
             return {"notify_count": 0, "highlight_count": 0}
 
-        stream_ordering = results[0][0]
+        (
+            stream_ordering,
+            receipt_stream_ordering,
+            notif_count,
+            highlight_count,
+        ) = results[0]
+
+        if receipt_stream_ordering == stream_ordering:
+            # The counts are up to date for this receipt.
+            return {"notify_count": notif_count, "highlight_count": highlight_count}
 
         return self._get_unread_counts_by_pos_txn(
             txn, room_id, user_id, stream_ordering
@@ -168,6 +186,119 @@ class EventPushActionsWorkerStore(SQLBaseStore):
 
         return {"notify_count": notify_count, "highlight_count": highlight_count}
 
+    def get_unread_event_push_actions_by_rooms_for_user(self, room_ids, user_id):
+        """Bulk version of `get_unread_event_push_actions_by_room_for_user`,
+        which gets the unread counts for each of the given rooms after the
+        user's read receipt in that room.
+
+        Rather than querying each room in turn this does a fixed number of
+        queries per batch of rooms, so is suitable for large numbers of rooms.
+
+        Args:
+            room_ids (Iterable[str])
+            user_id (str)
+
+        Returns:
+            Deferred[dict[str, dict[str, int]]]: map from room ID to a dict with
+            "notify_count" and "highlight_count" keys. Rooms the user has no
+            read receipt in are omitted.
+        """
+        return self.db.runInteraction(
+            "get_unread_event_push_actions_by_rooms_for_user",
+            self._get_unread_counts_by_rooms_txn,
+            room_ids,
+            user_id,
+        )
+
+    def _get_unread_counts_by_rooms_txn(self, txn, room_ids, user_id):
+        results = {}
+
+        # Rooms whose counts we have to work out from the push actions, as
+        # they're not up to date in event_push_counts.
+        uncounted_room_ids = []
+
+        # The receipts are joined against the events table to get the stream
+        # ordering to count from in each room.
+        receipts_sql = """
+            INNER JOIN receipts_linearized AS r USING (room_id, user_id)
+            INNER JOIN events AS e ON (
+                e.room_id = r.room_id AND e.event_id = r.event_id
+            )
+        """
+
+        for chunk in batch_iter(room_ids, 500):
+            clause, args = make_in_list_sql_clause(
+                self.database_engine, "r.room_id", chunk
+            )
+
+            # Rooms with a receipt for an event we don't know about have no
+            # unread notifications, as in `_get_unread_counts_by_receipt_txn`.
+            sql = """
+                SELECT r.room_id, e.stream_ordering, c.receipt_stream_ordering,
+                    c.notif_count, c.highlight_count
+                FROM receipts_linearized AS r
+                LEFT JOIN events AS e ON (
+                    e.room_id = r.room_id AND e.event_id = r.event_id
+                )
+                LEFT JOIN event_push_counts AS c ON (
+                    c.room_id = r.room_id AND c.user_id = r.user_id
+                )
+                WHERE r.user_id = ? AND r.receipt_type = 'm.read' AND %s
+            """ % (
+                clause,
+            )
+            txn.execute(sql, [user_id] + args)
+            for row in txn:
+                room_id, stream_ordering, receipt_stream_ordering = row[:3]
+                if stream_ordering is None:
+                    results[room_id] = {"notify_count": 0, "highlight_count": 0}
+                elif receipt_stream_ordering == stream_ordering:
+                    results[room_id] = {
+                        "notify_count": row[3],
+                        "highlight_count": row[4],
+                    }
+                else:
+                    results[room_id] = {"notify_count": 0, "highlight_count": 0}
+                    uncounted_room_ids.append(room_id)
+
+        for chunk in batch_iter(uncounted_room_ids, 500):
+            clause, args = make_in_list_sql_clause(
+                self.database_engine, "r.room_id", chunk
+            )
+
+            # We don't need to put a notif=1 clause as all rows always have
+            # notif=1
+            sql = """
+                SELECT r.room_id, COUNT(*), SUM(ea.highlight)
+                FROM event_push_actions AS ea %s
+                WHERE ea.user_id = ? AND r.receipt_type = 'm.read' AND %s
+                    AND ea.stream_ordering > e.stream_ordering
+                GROUP BY r.room_id
+            """ % (
+                receipts_sql,
+                clause,
+            )
+            txn.execute(sql, [user_id] + args)
+            for room_id, notify_count, highlight_count in txn:
+                counts = results[room_id]
+                counts["notify_count"] += notify_count
+                counts["highlight_count"] += highlight_count
+
+            sql = """
+                SELECT r.room_id, s.notif_count
+                FROM event_push_summary AS s %s
+                WHERE s.user_id = ? AND r.receipt_type = 'm.read' AND %s
+                    AND s.stream_ordering > e.stream_ordering
+            """ % (
+                receipts_sql,
+                clause,
+            )
+            txn.execute(sql, [user_id] + args)
+            for room_id, notif_count in txn:
+                results[room_id]["notify_count"] += notif_count
+
+        return results
+
     @defer.inlineCallbacks
     def get_push_action_users_in_range(self, min_stream_ordering, max_stream_ordering):
         def f(txn):
@@ -451,18 +582,39 @@ class EventPushActionsWorkerStore(SQLBaseStore):
                 VALUES (?, ?, ?, ?, ?)
             """
 
-            txn.executemany(
+            txn.execute_batch(
                 sql,
-                (
+                [
                     _gen_entry(user_id, actions)
                     for user_id, actions in iteritems(user_id_actions)
-                ),
+                ],
             )
 
         return self.db.runInteraction(
             "add_push_actions_to_staging", _add_push_actions_to_staging_txn
         )
 
+    def add_deferred_push_evaluation(self, event_id, room_id):
+        """Queue up the push actions for the event to be calculated once it
+        has been persisted, rather than adding them to the staging area.
+
+        Args:
+            event_id (str)
+            room_id (str)
+
+        Returns:
+            Deferred
+        """
+        return self.db.simple_insert(
+            table="deferred_push_evaluations",
+            values={
+                "event_id": event_id,
+                "room_id": room_id,
+                "queued_ts": self._clock.time_msec(),
+            },
+            desc="add_deferred_push_evaluation",
+        )
+
     @defer.inlineCallbacks
     def remove_push_actions_from_staging(self, event_id):
         """Called if we failed to persist the event to ensure that stale push
@@ -472,11 +624,16 @@ class EventPushActionsWorkerStore(SQLBaseStore):
             event_id (str)
         """
 
+        def _remove_push_actions_from_staging_txn(txn):
+            for table in ("event_push_actions_staging", "deferred_push_evaluations"):
+                self.db.simple_delete_txn(
+                    txn, table=table, keyvalues={"event_id": event_id}
+                )
+
         try:
-            res = yield self.db.simple_delete(
-                table="event_push_actions_staging",
-                keyvalues={"event_id": event_id},
-                desc="remove_push_actions_from_staging",
+            res = yield self.db.runInteraction(
+                "remove_push_actions_from_staging",
+                _remove_push_actions_from_staging_txn,
             )
             return res
         except Exception:
@@ -652,6 +809,225 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
             self._start_rotate_notifs, 30 * 60 * 1000
         )
 
+    def get_deferred_push_evaluations(self, max_stream_ordering, limit):
+        """Get the earliest persisted events whose push actions have been
+        deferred.
+
+        Args:
+            max_stream_ordering (int): Only return events up to this stream
+                ordering.
+            limit (int): The maximum number of events to return.
+
+        Returns:
+            Deferred[list[tuple[str, int, int]]]: The event ID, stream ordering
+            and time queued of each event, ordered by stream ordering.
+        """
+
+        def _get_deferred_push_evaluations_txn(txn):
+            sql = """
+                SELECT q.event_id, e.stream_ordering, q.queued_ts
+                FROM deferred_push_evaluations AS q
+                INNER JOIN events AS e USING (event_id)
+                WHERE e.stream_ordering <= ?
+                ORDER BY e.stream_ordering ASC
+                LIMIT ?
+            """
+            txn.execute(sql, (max_stream_ordering, limit))
+            return txn.fetchall()
+
+        return self.db.runInteraction(
+            "get_deferred_push_evaluations", _get_deferred_push_evaluations_txn
+        )
+
+    def add_deferred_push_actions(self, event_ids, events_and_actions):
+        """Add the push actions calculated for events which were queued by
+        `add_deferred_push_evaluation`, and take them off the queue.
+
+        Args:
+            event_ids (list[str]): The events to take off the queue.
+            events_and_actions (list[tuple[EventBase, dict[str, list]]]): The
+                events to add push actions for, with a dict of user ID to push
+                actions for each.
+
+        Returns:
+            Deferred
+        """
+
+        def _add_deferred_push_actions_txn(txn):
+            sql = """
+                INSERT INTO event_push_actions (
+                    room_id, event_id, user_id, actions, stream_ordering,
+                    topological_ordering, notif, highlight
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """
+
+            rows = []
+            for event, user_id_actions in events_and_actions:
+                user_highlights = []
+                for user_id, actions in iteritems(user_id_actions):
+                    is_highlight = 1 if _action_has_highlight(actions) else 0
+                    user_highlights.append((user_id, is_highlight))
+                    rows.append(
+                        (
+                            event.room_id,
+                            event.event_id,
+                            user_id,
+                            _serialize_action(actions, is_highlight),
+                            event.internal_metadata.stream_ordering,
+                            event.depth,
+                            1,
+                            is_highlight,
+                        )
+                    )
+
+                    txn.call_after(
+                        self.get_unread_event_push_actions_by_room_for_user.invalidate_many,
+                        (event.room_id, user_id),
+                    )
+
+                self._add_push_counts_txn(
+                    txn,
+                    event.room_id,
+                    event.internal_metadata.stream_ordering,
+                    user_highlights,
+                )
+
+            txn.execute_batch(sql, rows)
+
+            txn.executemany(
+                "DELETE FROM deferred_push_evaluations WHERE event_id = ?",
+                [(event_id,) for event_id in event_ids],
+            )
+
+        return self.db.runInteraction(
+            "add_deferred_push_actions", _add_deferred_push_actions_txn
+        )
+
+    def delete_stale_deferred_push_evaluations(self, queued_before_ts):
+        """Take events off the queue of deferred push evaluations which were
+        queued before the given time but never persisted.
+
+        Args:
+            queued_before_ts (int)
+
+        Returns:
+            Deferred
+        """
+
+        def _delete_stale_deferred_push_evaluations_txn(txn):
+            sql = """
+                DELETE FROM deferred_push_evaluations
+                WHERE queued_ts < ? AND NOT EXISTS (
+                    SELECT 1 FROM events
+                    WHERE events.event_id = deferred_push_evaluations.event_id
+                )
+            """
+            txn.execute(sql, (queued_before_ts,))
+
+        return self.db.runInteraction(
+            "delete_stale_deferred_push_evaluations",
+            _delete_stale_deferred_push_evaluations_txn,
+        )
+
+    def _add_push_counts_txn(self, txn, room_id, stream_ordering, user_highlights):
+        """Count new push actions for an event in event_push_counts.
+
+        Args:
+            txn (LoggingTransaction)
+            room_id (str)
+            stream_ordering (int): The stream ordering of the event.
+            user_highlights (list[tuple[str, int]]): The users with push actions
+                for the event, each with whether it is a highlight.
+        """
+        if not user_highlights:
+            return
+
+        if self.database_engine.can_native_upsert:
+            sql = """
+                INSERT INTO event_push_counts (
+                    user_id, room_id, receipt_stream_ordering, notif_count,
+                    highlight_count
+                )
+                VALUES (?, ?, NULL, 1, ?)
+                ON CONFLICT (user_id, room_id) DO UPDATE SET
+                    notif_count = event_push_counts.notif_count + 1,
+                    highlight_count = (
+                        event_push_counts.highlight_count
+                        + EXCLUDED.highlight_count
+                    )
+                WHERE event_push_counts.receipt_stream_ordering IS NULL
+                    OR event_push_counts.receipt_stream_ordering < ?
+            """
+            txn.execute_batch(
+                sql,
+                [
+                    (user_id, room_id, highlight, stream_ordering)
+                    for user_id, highlight in user_highlights
+                ],
+            )
+            return
+
+        # Without native upserts we update the existing rows and then insert
+        # the missing ones. That's safe as only old SQLite versions lack native
+        # upserts, and SQLite only allows one writer at a time.
+        txn.executemany(
+            """
+                UPDATE event_push_counts SET
+                    notif_count = notif_count + 1,
+                    highlight_count = highlight_count + ?
+                WHERE user_id = ? AND room_id = ? AND (
+                    receipt_stream_ordering IS NULL
+                    OR receipt_stream_ordering < ?
+                )
+            """,
+            [
+                (highlight, user_id, room_id, stream_ordering)
+                for user_id, highlight in user_highlights
+            ],
+        )
+        txn.executemany(
+            """
+                INSERT INTO event_push_counts (
+                    user_id, room_id, receipt_stream_ordering, notif_count,
+                    highlight_count
+                )
+                SELECT ?, ?, NULL, 1, ? WHERE NOT EXISTS (
+                    SELECT 1 FROM event_push_counts WHERE user_id = ? AND room_id = ?
+                )
+            """,
+            [
+                (user_id, room_id, highlight, user_id, room_id)
+                for user_id, highlight in user_highlights
+            ],
+        )
+
+    def _reset_push_counts_txn(self, txn, room_id, user_id, stream_ordering):
+        """Recount a user's unread notifications in a room after their read
+        receipt has moved.
+
+        Args:
+            txn (LoggingTransaction)
+            room_id (str)
+            user_id (str)
+            stream_ordering (int): The stream ordering of the event the receipt
+                is for.
+        """
+        counts = self._get_unread_counts_by_pos_txn(
+            txn, room_id, user_id, stream_ordering
+        )
+
+        self.db.simple_upsert_txn(
+            txn,
+            table="event_push_counts",
+            keyvalues={"user_id": user_id, "room_id": room_id},
+            values={
+                "receipt_stream_ordering": stream_ordering,
+                "notif_count": counts["notify_count"],
+                "highlight_count": counts["highlight_count"],
+            },
+        )
+
     def _set_push_actions_for_event_and_users_txn(
         self, txn, events_and_contexts, all_events_and_contexts
     ):
@@ -695,19 +1071,26 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
             )
 
         for event, _ in events_and_contexts:
-            user_ids = self.db.simple_select_onecol_txn(
-                txn,
-                table="event_push_actions_staging",
-                keyvalues={"event_id": event.event_id},
-                retcol="user_id",
+            txn.execute(
+                "SELECT user_id, highlight FROM event_push_actions_staging"
+                " WHERE event_id = ?",
+                (event.event_id,),
             )
+            user_highlights = txn.fetchall()
 
-            for uid in user_ids:
+            for uid, _ in user_highlights:
                 txn.call_after(
                     self.get_unread_event_push_actions_by_room_for_user.invalidate_many,
                     (event.room_id, uid),
                 )
 
+            self._add_push_counts_txn(
+                txn,
+                event.room_id,
+                event.internal_metadata.stream_ordering,
+                user_highlights,
+            )
+
         # Now we delete the staging area for *all* events that were being
         # persisted.
         txn.executemany(
@@ -769,6 +1152,31 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
             self.get_unread_event_push_actions_by_room_for_user.invalidate_many,
             (room_id,),
         )
+
+        # Uncount the push actions we're about to remove, for any users they
+        # were counted for.
+        txn.execute(
+            """
+                UPDATE event_push_counts SET
+                    notif_count = notif_count - 1,
+                    highlight_count = highlight_count - (
+                        SELECT ea.highlight FROM event_push_actions AS ea
+                        WHERE ea.room_id = ? AND ea.event_id = ?
+                            AND ea.user_id = event_push_counts.user_id
+                    )
+                WHERE room_id = ? AND user_id IN (
+                    SELECT user_id FROM event_push_actions
+                    WHERE room_id = ? AND event_id = ?
+                ) AND (
+                    receipt_stream_ordering IS NULL
+                    OR receipt_stream_ordering < (
+                        SELECT stream_ordering FROM events WHERE event_id = ?
+                    )
+                )
+            """,
+            (room_id, event_id, room_id, room_id, event_id, event_id),
+        )
+
         txn.execute(
             "DELETE FROM event_push_actions WHERE room_id = ? AND event_id = ?",
             (room_id, event_id),
@@ -784,6 +1192,10 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
         We however keep a months worth of highlighted notifications, so that
         users can still get a list of recent highlights.
 
+        This doesn't need to touch event_push_counts: only push actions after
+        the receipt the counts are for are counted, and we are only removing
+        those up to the new receipt, which the counts are then reset for.
+
         Args:
             txn: The transcation
             room_id: Room ID to delete from
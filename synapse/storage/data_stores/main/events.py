@@ -1663,6 +1663,11 @@ class EventsStore(
                 (room_id,),
             )
 
+        # The unread counts may have included the push actions we've just
+        # deleted, so throw them away. They'll be recounted from the remaining
+        # push actions when needed.
+        txn.execute("DELETE FROM event_push_counts WHERE room_id = ?", (room_id,))
+
         # Mark all state and own events as outliers
         logger.info("[purge] marking remaining events as outliers")
         txn.execute(
@@ -1765,10 +1770,13 @@ class EventsStore(
         # and finally, the tables with an index on room_id (or no useful index)
         for table in (
             "current_state_events",
+            "deferred_push_evaluations",
+            "destination_rooms",
             "event_backward_extremities",
             "event_forward_extremities",
             "event_json",
             "event_push_actions",
+            "event_push_counts",
             "event_search",
             "events",
             "group_rooms",
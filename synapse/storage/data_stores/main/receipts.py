@@ -419,6 +419,9 @@ class ReceiptsStore(ReceiptsWorkerStore):
                 txn, room_id=room_id, user_id=user_id, stream_ordering=stream_ordering
             )
 
+            if self.hs.is_mine_id(user_id):
+                self._reset_push_counts_txn(txn, room_id, user_id, stream_ordering)
+
         return rx_ts
 
     @defer.inlineCallbacks
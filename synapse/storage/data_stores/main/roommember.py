@@ -501,6 +501,26 @@ class RoomMemberWorkerStore(EventsWorkerStore):
 
         return user_who_share_room
 
+    @cachedInlineCallbacks(max_entries=500000, cache_context=True, iterable=True)
+    def get_hosts_who_share_room_with_user(self, user_id, cache_context):
+        """Returns the set of hosts which have users in a room with `user_id`
+
+        The result is invalidated whenever the user joins or leaves a room, or
+        the hosts in one of their rooms change.
+        """
+        room_ids = yield self.get_rooms_for_user(
+            user_id, on_invalidate=cache_context.invalidate
+        )
+
+        hosts = set()  # type: Set[str]
+        for room_id in room_ids:
+            room_hosts = yield self.get_hosts_in_room(
+                room_id, on_invalidate=cache_context.invalidate
+            )
+            hosts.update(room_hosts)
+
+        return frozenset(hosts)
+
     @defer.inlineCallbacks
     def get_joined_users_from_context(self, event, context):
         state_group = context.state_group
@@ -0,0 +1,25 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+
+-- Events whose push actions are to be calculated after they have been persisted,
+-- rather than before. See `push.deferred_evaluation_room_size`.
+CREATE TABLE IF NOT EXISTS deferred_push_evaluations (
+    event_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    queued_ts BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX deferred_push_evaluations_event_id ON deferred_push_evaluations (event_id);
@@ -0,0 +1,30 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The stream ordering of the last event we successfully sent to each
+-- destination, or NULL if we haven't sent one since we started tracking this.
+ALTER TABLE destinations ADD COLUMN last_successful_stream_ordering BIGINT;
+
+-- The stream ordering of the latest event in each room that we have wanted to
+-- send to each destination. Together with the above this tells us which rooms
+-- a destination that has been unreachable needs catching up on.
+CREATE TABLE IF NOT EXISTS destination_rooms (
+    destination TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    stream_ordering BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX destination_rooms_destination_room ON destination_rooms (destination, room_id);
+CREATE INDEX destination_rooms_room_id ON destination_rooms (room_id);
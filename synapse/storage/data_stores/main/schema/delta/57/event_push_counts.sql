@@ -0,0 +1,29 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+
+-- The number of notifications and highlights for each user in each room since
+-- their read receipt, kept up to date as push actions are added and receipts
+-- arrive. `receipt_stream_ordering` is the stream ordering of the event the
+-- counts are since, or NULL if the counts are since the start of the room.
+CREATE TABLE IF NOT EXISTS event_push_counts (
+    user_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    receipt_stream_ordering BIGINT,
+    notif_count BIGINT NOT NULL,
+    highlight_count BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX event_push_counts_user_room ON event_push_counts (user_id, room_id);
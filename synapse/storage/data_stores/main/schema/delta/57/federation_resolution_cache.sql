@@ -0,0 +1,28 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The results of resolving the names of remote servers, so that they survive
+-- restarts and are shared between workers. `lookup_type` is the kind of
+-- lookup: 'well_known' for .well-known delegation and 'srv' for SRV records.
+CREATE TABLE IF NOT EXISTS federation_resolution_cache (
+    lookup_type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    result_json TEXT NOT NULL,
+    -- When the result expires, in ms since the epoch.
+    expires_ts BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX federation_resolution_cache_key ON federation_resolution_cache (lookup_type, name);
+CREATE INDEX federation_resolution_cache_expires_ts ON federation_resolution_cache (expires_ts);
@@ -0,0 +1,22 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Each federation sender instance tracks its own position in the streams it
+-- sends federation for. Existing positions belong to the one instance there
+-- was before, which is named 'master' when federation sending isn't sharded.
+ALTER TABLE federation_stream_position ADD COLUMN instance_name TEXT;
+UPDATE federation_stream_position SET instance_name = 'master' WHERE instance_name IS NULL;
+
+CREATE UNIQUE INDEX federation_stream_position_instance ON federation_stream_position(type, instance_name);
@@ -40,6 +40,7 @@ import abc
 import logging
 from collections import namedtuple
 
+from six import iteritems
 from six.moves import range
 
 from twisted.internet import defer
@@ -47,7 +48,7 @@ from twisted.internet import defer
 from synapse.logging.context import make_deferred_yieldable, run_in_background
 from synapse.storage._base import SQLBaseStore
 from synapse.storage.data_stores.main.events_worker import EventsWorkerStore
-from synapse.storage.database import Database
+from synapse.storage.database import Database, make_in_list_sql_clause
 from synapse.storage.engines import PostgresEngine
 from synapse.types import RoomStreamToken
 from synapse.util.caches.stream_change_cache import StreamChangeCache
@@ -274,6 +275,12 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         self._stream_order_on_start = self.get_room_max_stream_ordering()
 
+        # The name we track our position in the federation streams under, and
+        # whether we need to make sure the positions match the configured
+        # federation sender instances before using them.
+        self._federation_instance_name = hs.config.federation_sender_instance_name
+        self._need_to_reset_federation_stream_positions = hs.config.send_federation
+
     @abc.abstractmethod
     def get_room_max_stream_ordering(self):
         raise NotImplementedError()
@@ -551,6 +558,41 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         return self.db.runInteraction("get_room_event_before_stream_ordering", _f)
 
+    def get_last_event_stream_orderings_for_rooms(self, room_ids, stream_ordering):
+        """Gets the stream ordering of the most recent event at or before a
+        stream ordering in each of the given rooms.
+
+        Args:
+            room_ids (Iterable[str]):
+            stream_ordering (int):
+
+        Returns:
+            Deferred[dict[str, int]]: map from room ID to stream ordering. Rooms
+            with no events at or before `stream_ordering` are omitted.
+        """
+
+        def _f(txn):
+            # We do a query per room rather than a single GROUP BY, as each of
+            # these is a short walk backwards along the events_room_stream index
+            # whereas the GROUP BY would scan every event in the rooms.
+            sql = (
+                "SELECT stream_ordering FROM events"
+                " WHERE room_id = ? AND stream_ordering <= ?"
+                " AND NOT outlier"
+                " ORDER BY stream_ordering DESC"
+                " LIMIT 1"
+            )
+
+            results = {}
+            for room_id in room_ids:
+                txn.execute(sql, (room_id, stream_ordering))
+                row = txn.fetchone()
+                if row:
+                    results[room_id] = row[0]
+            return results
+
+        return self.db.runInteraction("get_last_event_stream_orderings_for_rooms", _f)
+
     @defer.inlineCallbacks
     def get_room_events_max_id(self, room_id=None):
         """Returns the current token for rooms stream.
@@ -797,18 +839,69 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         return upper_bound, events
 
+    @defer.inlineCallbacks
+    def _ensure_federation_stream_positions(self):
+        if self._need_to_reset_federation_stream_positions:
+            yield self.db.runInteraction(
+                "_reset_federation_positions_txn", self._reset_federation_positions_txn
+            )
+            self._need_to_reset_federation_stream_positions = False
+
+    def _reset_federation_positions_txn(self, txn):
+        """Make sure there is a position in each federation stream for each
+        configured federation sender instance, and none for instances which have
+        since been removed.
+
+        An instance which is new to the config starts from the earliest position
+        of all the instances, so that nothing is missed for the destinations
+        which have been moved to it. This may mean that some things get sent to
+        those destinations twice.
+        """
+        instances = self.hs.config.federation_shard_config.instances
+        if not instances:
+            instances = ["master"]
+
+        txn.execute(
+            "SELECT type, MIN(stream_id) FROM federation_stream_position GROUP BY type"
+        )
+        min_positions = dict(txn)
+
+        for typ, stream_id in iteritems(min_positions):
+            for instance_name in instances:
+                self.db.simple_upsert_txn(
+                    txn,
+                    table="federation_stream_position",
+                    keyvalues={"type": typ, "instance_name": instance_name},
+                    values={},
+                    insertion_values={"stream_id": stream_id},
+                )
+
+        clause, args = make_in_list_sql_clause(
+            txn.database_engine, "instance_name", instances
+        )
+        txn.execute(
+            "DELETE FROM federation_stream_position WHERE NOT %s" % (clause,), args
+        )
+
+    @defer.inlineCallbacks
     def get_federation_out_pos(self, typ):
-        return self.db.simple_select_one_onecol(
+        yield self._ensure_federation_stream_positions()
+
+        pos = yield self.db.simple_select_one_onecol(
             table="federation_stream_position",
             retcol="stream_id",
-            keyvalues={"type": typ},
+            keyvalues={"type": typ, "instance_name": self._federation_instance_name},
             desc="get_federation_out_pos",
         )
+        return pos
 
+    @defer.inlineCallbacks
     def update_federation_out_pos(self, typ, stream_id):
-        return self.db.simple_update_one(
+        yield self._ensure_federation_stream_positions()
+
+        yield self.db.simple_update_one(
             table="federation_stream_position",
-            keyvalues={"type": typ},
+            keyvalues={"type": typ, "instance_name": self._federation_instance_name},
             updatevalues={"stream_id": stream_id},
             desc="update_federation_out_pos",
         )
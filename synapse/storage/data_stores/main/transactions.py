@@ -15,17 +15,21 @@
 
 import logging
 from collections import namedtuple
+from typing import Dict, Optional
 
 import six
 
-from canonicaljson import encode_canonical_json
+from canonicaljson import encode_canonical_json, json
 
 from twisted.internet import defer
 
-from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.metrics.background_process_metrics import (
+    run_as_background_process,
+    wrap_as_background_process,
+)
 from synapse.storage._base import SQLBaseStore, db_to_json
 from synapse.storage.database import Database
-from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.caches.stream_change_cache import StreamChangeCache
 
 # py2 sqlite has buffer hardcoded as only binary type, so we must use it,
 # despite being deprecated and removed in favor of memoryview
@@ -48,6 +52,9 @@ _UpdateTransactionRow = namedtuple(
 
 SENTINEL = object()
 
+# How often we write updated destination retry timings to the database.
+RETRY_TIMINGS_PERSIST_INTERVAL_MS = 5 * 1000
+
 
 class TransactionStore(SQLBaseStore):
     """A collection of queries for handling PDUs.
@@ -58,10 +65,29 @@ class TransactionStore(SQLBaseStore):
 
         self._clock.looping_call(self._start_cleanup_transactions, 30 * 60 * 1000)
 
-        self._destination_retry_cache = ExpiringCache(
-            cache_name="get_destination_retry_timings",
-            clock=self._clock,
-            expiry_ms=5 * 60 * 1000,
+        # The retry timings of each destination we know about, or None if we
+        # aren't backing off from it. These are authoritative: updates are
+        # applied here straight away, streamed to workers over the
+        # `destination_retry` replication stream, and written to the database
+        # by the master in batches.
+        self._destination_retry_timings = {}  # type: Dict[str, Optional[dict]]
+
+        # Updated timings which have yet to be written to the database.
+        self._retry_timings_to_persist = {}  # type: Dict[str, tuple]
+
+        # The position of the `destination_retry` stream, and of the latest
+        # change to each destination's timings on it.
+        self._destination_retry_stream_id = 0
+        self._destination_retry_serials = {}  # type: Dict[str, int]
+        self._destination_retry_stream_change_cache = StreamChangeCache(
+            "DestinationRetryStreamChangeCache", self._destination_retry_stream_id
+        )
+
+        self._clock.looping_call(
+            self._persist_destination_retry_timings, RETRY_TIMINGS_PERSIST_INTERVAL_MS
+        )
+        self.hs.get_reactor().addSystemEventTrigger(
+            "before", "shutdown", self._persist_destination_retry_timings
         )
 
     def get_received_txn_response(self, transaction_id, origin):
@@ -137,6 +163,8 @@ class TransactionStore(SQLBaseStore):
     def get_destination_retry_timings(self, destination):
         """Gets the current retry timings (if any) for a given destination.
 
+        Only the first lookup of a destination reads from the database.
+
         Args:
             destination (str)
 
@@ -145,20 +173,19 @@ class TransactionStore(SQLBaseStore):
             Otherwise a dict for the retry scheme
         """
 
-        result = self._destination_retry_cache.get(destination, SENTINEL)
+        result = self._destination_retry_timings.get(destination, SENTINEL)
         if result is not SENTINEL:
             return result
 
-        result = yield self.db.runInteraction(
+        timings = yield self.db.runInteraction(
             "get_destination_retry_timings",
             self._get_destination_retry_timings,
             destination,
         )
 
-        # We don't hugely care about race conditions between getting and
-        # invalidating the cache, since we time out fairly quickly anyway.
-        self._destination_retry_cache[destination] = result
-        return result
+        # The timings may have been updated while we were reading them, in which
+        # case the update wins.
+        return self._destination_retry_timings.setdefault(destination, timings)
 
     def _get_destination_retry_timings(self, txn, destination):
         result = self.db.simple_select_one_txn(
@@ -180,84 +207,318 @@ class TransactionStore(SQLBaseStore):
         """Sets the current retry timings for a given destination.
         Both timings should be zero if retrying is no longer occuring.
 
+        The timings are only updated if retry_interval is zero (i.e. we're
+        resetting them) or greater than the current retry interval. They take
+        effect straight away, and are written to the database in the
+        background.
+
         Args:
             destination (str)
             failure_ts (int|None) - when the server started failing (ms since epoch)
             retry_last_ts (int) - time of last retry attempt in unix epoch ms
             retry_interval (int) - how long until next retry in ms
+
+        Returns:
+            Deferred
         """
 
-        self._destination_retry_cache.pop(destination, None)
-        return self.db.runInteraction(
-            "set_destination_retry_timings",
-            self._set_destination_retry_timings,
-            destination,
-            failure_ts,
-            retry_last_ts,
-            retry_interval,
+        if self._should_update_destination_retry_timings(destination, retry_interval):
+            self._update_destination_retry_timings(
+                destination, failure_ts, retry_last_ts, retry_interval
+            )
+            self._retry_timings_to_persist[destination] = (
+                failure_ts,
+                retry_last_ts,
+                retry_interval,
+            )
+
+        # We stream the destination's timings even if we didn't change them,
+        # so that a worker which tried to change them learns the current ones.
+        self._destination_retry_stream_id += 1
+        stream_id = self._destination_retry_stream_id
+        self._destination_retry_serials[destination] = stream_id
+        self._destination_retry_stream_change_cache.entity_has_changed(
+            destination, stream_id
+        )
+        self.hs.get_notifier().on_new_replication_data()
+
+        return defer.succeed(None)
+
+    def _should_update_destination_retry_timings(self, destination, retry_interval):
+        prev = self._destination_retry_timings.get(destination)
+        return (
+            retry_interval == 0
+            or prev is None
+            or prev["retry_interval"] < retry_interval
         )
 
-    def _set_destination_retry_timings(
-        self, txn, destination, failure_ts, retry_last_ts, retry_interval
+    def _update_destination_retry_timings(
+        self, destination, failure_ts, retry_last_ts, retry_interval
     ):
+        """Replace the in-memory retry timings for a destination."""
+        if retry_last_ts > 0:
+            self._destination_retry_timings[destination] = {
+                "destination": destination,
+                "failure_ts": failure_ts,
+                "retry_last_ts": retry_last_ts,
+                "retry_interval": retry_interval,
+            }
+        else:
+            self._destination_retry_timings[destination] = None
 
-        if self.database_engine.can_native_upsert:
-            # Upsert retry time interval if retry_interval is zero (i.e. we're
-            # resetting it) or greater than the existing retry interval.
+    def get_destination_retry_stream_token(self):
+        return self._destination_retry_stream_id
 
-            sql = """
-                INSERT INTO destinations (
-                    destination, failure_ts, retry_last_ts, retry_interval
-                )
-                    VALUES (?, ?, ?, ?)
-                ON CONFLICT (destination) DO UPDATE SET
-                        failure_ts = EXCLUDED.failure_ts,
-                        retry_last_ts = EXCLUDED.retry_last_ts,
-                        retry_interval = EXCLUDED.retry_interval
-                    WHERE
-                        EXCLUDED.retry_interval = 0
-                        OR destinations.retry_interval < EXCLUDED.retry_interval
-            """
+    async def get_all_destination_retry_updates(self, last_id, current_id):
+        """Get the destinations whose retry timings changed between the given
+        positions of the `destination_retry` stream, and their current timings.
 
-            txn.execute(sql, (destination, failure_ts, retry_last_ts, retry_interval))
+        Returns:
+            list[tuple[int, str, int|None, int, int]]: The stream position,
+            destination, failure_ts, retry_last_ts and retry_interval of each
+            change, in stream order.
+        """
+        if last_id == current_id:
+            return []
 
+        changed = self._destination_retry_stream_change_cache.get_all_entities_changed(
+            last_id
+        )
+        if changed is None:
+            changed = self._destination_retry_serials
+
+        rows = []
+        for destination in changed:
+            serial = self._destination_retry_serials[destination]
+            if last_id < serial <= current_id:
+                timings = self._destination_retry_timings.get(destination)
+                if timings:
+                    rows.append(
+                        (
+                            serial,
+                            destination,
+                            timings["failure_ts"],
+                            timings["retry_last_ts"],
+                            timings["retry_interval"],
+                        )
+                    )
+                else:
+                    rows.append((serial, destination, None, 0, 0))
+        rows.sort()
+        return rows
+
+    @wrap_as_background_process("persist_destination_retry_timings")
+    async def _persist_destination_retry_timings(self):
+        """Write the retry timings which have changed since we last did so to
+        the database, in a single transaction.
+        """
+        # If the DB pool has already terminated, don't try updating
+        if not self._retry_timings_to_persist or not self.db.is_running():
             return
 
-        self.database_engine.lock_table(txn, "destinations")
+        to_persist = self._retry_timings_to_persist
+        self._retry_timings_to_persist = {}
+
+        destinations = list(to_persist)
+        try:
+            await self.db.runInteraction(
+                "persist_destination_retry_timings",
+                self.db.simple_upsert_many_txn,
+                "destinations",
+                ("destination",),
+                [(destination,) for destination in destinations],
+                ("failure_ts", "retry_last_ts", "retry_interval"),
+                [to_persist[destination] for destination in destinations],
+            )
+        except Exception:
+            # Try again next time, unless they have been updated since.
+            for destination, timings in to_persist.items():
+                self._retry_timings_to_persist.setdefault(destination, timings)
+            raise
 
-        # We need to be careful here as the data may have changed from under us
-        # due to a worker setting the timings.
+    def store_destination_rooms_entries(self, destinations, room_id, stream_ordering):
+        """Record that we want to send the event at the given stream ordering in
+        the room to the destinations, so that we can catch them up on it if
+        they are unreachable.
 
-        prev_row = self.db.simple_select_one_txn(
-            txn,
+        Args:
+            destinations (Iterable[str])
+            room_id (str)
+            stream_ordering (int)
+
+        Returns:
+            Deferred
+        """
+
+        def _store_destination_rooms_entries_txn(txn):
+            rows = [(destination, room_id) for destination in destinations]
+            self.db.simple_upsert_many_txn(
+                txn,
+                table="destination_rooms",
+                key_names=("destination", "room_id"),
+                key_values=rows,
+                value_names=("stream_ordering",),
+                value_values=[(stream_ordering,)] * len(rows),
+            )
+
+        return self.db.runInteraction(
+            "store_destination_rooms_entries", _store_destination_rooms_entries_txn
+        )
+
+    def get_destination_last_successful_stream_ordering(self, destination):
+        """Gets the stream ordering of the last event we successfully sent to the
+        destination.
+
+        Args:
+            destination (str)
+
+        Returns:
+            Deferred[int|None]: None if we haven't sent it an event since we
+            started tracking this.
+        """
+        return self.db.simple_select_one_onecol(
             table="destinations",
             keyvalues={"destination": destination},
-            retcols=("failure_ts", "retry_last_ts", "retry_interval"),
+            retcol="last_successful_stream_ordering",
             allow_none=True,
+            desc="get_destination_last_successful_stream_ordering",
         )
 
-        if not prev_row:
-            self.db.simple_insert_txn(
-                txn,
-                table="destinations",
-                values={
-                    "destination": destination,
-                    "failure_ts": failure_ts,
-                    "retry_last_ts": retry_last_ts,
-                    "retry_interval": retry_interval,
-                },
-            )
-        elif retry_interval == 0 or prev_row["retry_interval"] < retry_interval:
-            self.db.simple_update_one_txn(
+    def set_destination_last_successful_stream_ordering(
+        self, destination, last_successful_stream_ordering
+    ):
+        """Sets the stream ordering of the last event we successfully sent to the
+        destination.
+
+        Args:
+            destination (str)
+            last_successful_stream_ordering (int)
+
+        Returns:
+            Deferred
+        """
+        return self.db.simple_upsert(
+            table="destinations",
+            keyvalues={"destination": destination},
+            values={"last_successful_stream_ordering": last_successful_stream_ordering},
+            desc="set_destination_last_successful_stream_ordering",
+        )
+
+    def get_catch_up_room_event_ids(
+        self, destination, last_successful_stream_ordering, limit=50
+    ):
+        """Gets the latest event we have wanted to send to the destination in each
+        room it has missed events in since it was last successfully sent one.
+
+        Args:
+            destination (str)
+            last_successful_stream_ordering (int)
+            limit (int): The maximum number of rooms to return an event for.
+
+        Returns:
+            Deferred[list[tuple[str, int]]]: The event IDs and their stream
+            orderings, in stream order.
+        """
+
+        def _get_catch_up_room_event_ids_txn(txn):
+            sql = """
+                SELECT event_id, stream_ordering FROM destination_rooms
+                INNER JOIN events USING (stream_ordering)
+                WHERE destination = ? AND stream_ordering > ?
+                ORDER BY stream_ordering
+                LIMIT ?
+            """
+            txn.execute(sql, (destination, last_successful_stream_ordering, limit))
+            return txn.fetchall()
+
+        return self.db.runInteraction(
+            "get_catch_up_room_event_ids", _get_catch_up_room_event_ids_txn
+        )
+
+    def get_catch_up_outstanding_destinations(self, after_destination, limit=25):
+        """Gets destinations which need catching up on events and which we aren't
+        backing off from.
+
+        Args:
+            after_destination (str|None): Only return destinations after this
+                one, for paginating through them.
+            limit (int)
+
+        Returns:
+            Deferred[list[str]]: The destinations, in order.
+        """
+        now = self._clock.time_msec()
+
+        def _get_catch_up_outstanding_destinations_txn(txn):
+            sql = """
+                SELECT DISTINCT destination FROM destinations
+                INNER JOIN destination_rooms USING (destination)
+                WHERE
+                    stream_ordering > last_successful_stream_ordering
+                    AND destination > ?
+                    AND (
+                        retry_last_ts IS NULL
+                        OR retry_last_ts + retry_interval < ?
+                    )
+                ORDER BY destination
+                LIMIT ?
+            """
+            txn.execute(sql, (after_destination or "", now, limit))
+            return [destination for destination, in txn]
+
+        return self.db.runInteraction(
+            "get_catch_up_outstanding_destinations",
+            _get_catch_up_outstanding_destinations_txn,
+        )
+
+    def get_federation_resolution(self, lookup_type, name):
+        """Gets the stored result of resolving a remote server's name.
+
+        Args:
+            lookup_type (str): The kind of lookup, either "well_known" or "srv".
+            name (str): The name that was resolved.
+
+        Returns:
+            Deferred[tuple[object, int]|None]: The result and when it expires,
+            in ms since the epoch, or None if we have no result for the name.
+        """
+
+        def _get_federation_resolution_txn(txn):
+            row = self.db.simple_select_one_txn(
                 txn,
-                "destinations",
-                keyvalues={"destination": destination},
-                updatevalues={
-                    "failure_ts": failure_ts,
-                    "retry_last_ts": retry_last_ts,
-                    "retry_interval": retry_interval,
-                },
+                table="federation_resolution_cache",
+                keyvalues={"lookup_type": lookup_type, "name": name},
+                retcols=("result_json", "expires_ts"),
+                allow_none=True,
             )
+            if row is None:
+                return None
+            return db_to_json(row["result_json"]), row["expires_ts"]
+
+        return self.db.runInteraction(
+            "get_federation_resolution", _get_federation_resolution_txn
+        )
+
+    def set_federation_resolution(self, lookup_type, name, result, expires_ts):
+        """Stores the result of resolving a remote server's name, so that it
+        can be used by other workers and after a restart.
+
+        Args:
+            lookup_type (str): The kind of lookup, either "well_known" or "srv".
+            name (str): The name that was resolved.
+            result (object): The JSON-serialisable result.
+            expires_ts (int): When the result expires, in ms since the epoch.
+
+        Returns:
+            Deferred
+        """
+        return self.db.simple_upsert(
+            table="federation_resolution_cache",
+            keyvalues={"lookup_type": lookup_type, "name": name},
+            values={"result_json": json.dumps(result), "expires_ts": expires_ts},
+            lock=False,
+            desc="set_federation_resolution",
+        )
 
     def _start_cleanup_transactions(self):
         return run_as_background_process(
@@ -270,6 +531,9 @@ class TransactionStore(SQLBaseStore):
 
         def _cleanup_transactions_txn(txn):
             txn.execute("DELETE FROM received_transactions WHERE ts < ?", (month_ago,))
+            txn.execute(
+                "DELETE FROM federation_resolution_cache WHERE expires_ts < ?", (now,)
+            )
 
         return self.db.runInteraction(
             "_cleanup_transactions", _cleanup_transactions_txn
@@ -352,9 +352,14 @@ class StreamToken(
     _SEPARATOR = "_"
     START = None  # type: StreamToken
 
+    # Tokens handed out by some endpoints (e.g. /sync) have extra information
+    # for that endpoint appended after this, which is ignored elsewhere.
+    SUFFIX_SEPARATOR = "~"
+
     @classmethod
     def from_string(cls, string):
         try:
+            string = string.split(cls.SUFFIX_SEPARATOR, 1)[0]
             keys = string.split(cls._SEPARATOR)
             while len(keys) < len(cls._fields):
                 # i.e. old token from before receipt_key
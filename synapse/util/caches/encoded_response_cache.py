@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from typing import Dict, Hashable, Tuple
+
+from twisted.internet import defer
+
+from synapse.logging.context import make_deferred_yieldable, run_in_background
+from synapse.util.async_helpers import ObservableDeferred
+from synapse.util.caches import register_cache
+from synapse.util.caches.lrucache import LruCache
+from synapse.util.caches.treecache import TreeCache
+
+logger = logging.getLogger(__name__)
+
+
+class EncodedResponseCache(object):
+    """
+    Caches the encoded JSON responses to requests about rooms.
+
+    As with ResponseCache, requests for a key whose response is still being
+    computed wait for that response rather than computing it again. Unlike
+    ResponseCache, the encoded response is then kept until it expires, it is
+    evicted to keep the cache under its maximum size, or the responses for its
+    room are invalidated.
+
+    Failed requests aren't cached.
+    """
+
+    def __init__(self, hs, name, max_size, expiry_ms):
+        """
+        Args:
+            hs (synapse.server.HomeServer)
+            name (str): The name of the cache, for metrics.
+            max_size (int): The maximum total size of the cached responses,
+                in bytes.
+            expiry_ms (int): How long to keep each response for.
+        """
+        self.clock = hs.get_clock()
+        self._expiry_ms = expiry_ms
+
+        self._name = name
+        self._metrics = register_cache("response_cache", name, self)
+
+        # Requests that haven't finished yet.
+        self._pending = {}  # type: Dict[Tuple[str, Hashable], ObservableDeferred]
+
+        # Map from (room_id, key) to the time the response expires and the
+        # response itself.
+        self._cache = LruCache(
+            max_size,
+            keylen=2,
+            cache_type=TreeCache,
+            size_callback=lambda entry: len(entry[1]),
+            evicted_callback=self._metrics.inc_evictions,
+        )
+
+    def __len__(self):
+        return len(self._cache)
+
+    def wrap(self, room_id, key, callback, *args, **kwargs):
+        """Get the encoded response to a request, computing it if it isn't
+        cached.
+
+        Args:
+            room_id (str): The room the request is about.
+            key (Hashable): Identifies the request amongst those about the
+                room.
+            callback (Callable[..., Awaitable[bytes]]): Called with *args and
+                **kwargs to compute the encoded response if it isn't cached.
+                Should follow the synapse logcontext rules.
+
+        Returns:
+            Deferred[bytes]
+        """
+        cache_key = (room_id, key)
+
+        entry = self._cache.get(cache_key)
+        if entry is not None:
+            expiry_ts, json_bytes = entry
+            if expiry_ts > self.clock.time_msec():
+                self._metrics.inc_hits()
+                return defer.succeed(json_bytes)
+            self._cache.pop(cache_key)
+
+        result = self._pending.get(cache_key)
+        if result is not None:
+            self._metrics.inc_hits()
+            logger.info(
+                "[%s]: using incomplete cached result for [%s]", self._name, cache_key
+            )
+            return make_deferred_yieldable(result.observe())
+
+        self._metrics.inc_misses()
+
+        result = ObservableDeferred(
+            run_in_background(callback, *args, **kwargs), consumeErrors=True
+        )
+        self._pending[cache_key] = result
+
+        def on_complete(r):
+            # The room may have been invalidated while we were computing the
+            # response, in which case it mustn't be cached.
+            if self._pending.get(cache_key) is result:
+                del self._pending[cache_key]
+
+                # Failures have been consumed by this point, leaving None.
+                if isinstance(r, bytes):
+                    expiry_ts = self.clock.time_msec() + self._expiry_ms
+                    self._cache[cache_key] = (expiry_ts, r)
+            return r
+
+        result.addBoth(on_complete)
+        return make_deferred_yieldable(result.observe())
+
+    def invalidate_room(self, room_id):
+        """Drop the cached responses to requests about the given room.
+
+        Args:
+            room_id (str)
+        """
+        self._cache.del_multi((room_id,))
+
+        for cache_key in [k for k in self._pending if k[0] == room_id]:
+            del self._pending[cache_key]
@@ -15,8 +15,12 @@
 
 import collections
 import contextlib
+import heapq
+import itertools
 import logging
 
+from prometheus_client import Histogram
+
 from twisted.internet import defer
 
 from synapse.api.errors import LimitExceededError
@@ -28,6 +32,12 @@ from synapse.logging.context import (
 
 logger = logging.getLogger(__name__)
 
+queue_time_histogram = Histogram(
+    "synapse_federation_rate_limiter_queue_time_seconds",
+    "Time requests spent waiting for a share of the global concurrency budget",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
 
 class FederationRateLimiter(object):
     def __init__(self, clock, config):
@@ -36,13 +46,17 @@ class FederationRateLimiter(object):
             clock (Clock)
             config (FederationRateLimitConfig)
         """
+        fair_queue = _FairQueue(clock, config.global_concurrent)
 
         def new_limiter():
-            return _PerHostRatelimiter(clock=clock, config=config)
+            return _PerHostRatelimiter(
+                clock=clock, config=config, fair_queue=fair_queue
+            )
 
         self.ratelimiters = collections.defaultdict(new_limiter)
+        self.fair_queue = fair_queue
 
-    def ratelimit(self, host):
+    def ratelimit(self, host, cost=1):
         """Used to ratelimit an incoming request from given host
 
         Example usage:
@@ -53,21 +67,142 @@ class FederationRateLimiter(object):
 
         Args:
             host (str): Origin of incoming request.
+            cost (int): How expensive the request is to handle, relative to
+                other requests. Hosts making more expensive requests get a
+                correspondingly smaller share of the global concurrency budget
+                when it is exhausted.
 
         Returns:
             context manager which returns a deferred.
         """
-        return self.ratelimiters[host].ratelimit()
+        return self.ratelimiters[host].ratelimit(host, cost)
+
+
+class _FairQueue(object):
+    """Shares out a global budget of concurrent requests between hosts.
+
+    Once the budget is used up, requests are queued and started in weighted
+    fair queueing order: each queued request is tagged with the virtual time at
+    which it would start if every host with queued requests was getting an
+    equal share of the budget, accounting for the cost of each request, and
+    the one with the earliest tag is started next. A host which makes lots of
+    (or lots of expensive) requests therefore can't delay the requests of
+    other hosts for long.
+    """
+
+    def __init__(self, clock, concurrent):
+        """
+        Args:
+            clock (Clock)
+            concurrent (int): The maximum number of requests to process at
+                once.
+        """
+        self.clock = clock
+        self.concurrent = concurrent
+
+        # request_id objects for requests which are in progress
+        self.current_processing = set()
+
+        # heap of (start tag, sequence number, request_id) for queued requests.
+        # The sequence number breaks ties in arrival order.
+        self.queue = []
+        self._sequence = itertools.count()
+
+        # map from request_id object to (host, time queued in ms, Deferred) for
+        # queued requests
+        self.queued_requests = {}
+
+        # The start tag of the request we most recently started.
+        self.virtual_time = 0
+
+        # map from host to the virtual time at which its latest queued request
+        # would finish.
+        self.finish_tags = {}
+
+    def acquire(self, request_id, host, cost):
+        """Wait for a share of the budget to process a request.
+
+        Args:
+            request_id (object)
+            host (str)
+            cost (int)
+
+        Returns:
+            Deferred: resolves when the request can be processed.
+        """
+        if not self.queue and len(self.current_processing) < self.concurrent:
+            self.current_processing.add(request_id)
+            return defer.succeed(None)
+
+        start_tag = max(self.virtual_time, self.finish_tags.get(host, 0))
+        self.finish_tags[host] = start_tag + cost
+
+        queue_defer = defer.Deferred()
+        heapq.heappush(self.queue, (start_tag, next(self._sequence), request_id))
+        self.queued_requests[request_id] = (host, self.clock.time_msec(), queue_defer)
+        logger.debug(
+            "Ratelimiter: queueing request from %s (global queue now %i items)",
+            host,
+            len(self.queued_requests),
+        )
+
+        return queue_defer
+
+    def release(self, request_id):
+        """Give back the share of the budget used to process a request, or
+        stop waiting for one.
+
+        Args:
+            request_id (object)
+        """
+        # If the request is still queued it is removed from the heap when it
+        # reaches the front.
+        if self.queued_requests.pop(request_id, None) is None:
+            self.current_processing.discard(request_id)
+            self._start_queued_requests()
+
+        if not self.queued_requests:
+            # Nothing is waiting, so no host is owed a share of the budget.
+            self.queue = []
+            self.finish_tags.clear()
+            self.virtual_time = 0
+
+    def _start_queued_requests(self):
+        """Start processing queued requests until the budget is used up."""
+        while self.queue and len(self.current_processing) < self.concurrent:
+            start_tag, _, next_request_id = heapq.heappop(self.queue)
+            entry = self.queued_requests.pop(next_request_id, None)
+            if entry is None:
+                continue
+
+            host, queued_ms, deferred = entry
+            queue_time = (self.clock.time_msec() - queued_ms) / 1000.0
+            queue_time_histogram.observe(queue_time)
+            logger.debug(
+                "Ratelimiter: starting request from %s after %.3f sec in the "
+                "global queue",
+                host,
+                queue_time,
+            )
+
+            self.virtual_time = start_tag
+            self.current_processing.add(next_request_id)
+
+            with PreserveLoggingContext():
+                deferred.callback(None)
 
 
 class _PerHostRatelimiter(object):
-    def __init__(self, clock, config):
+    def __init__(self, clock, config, fair_queue):
         """
         Args:
             clock (Clock)
             config (FederationRateLimitConfig)
+            fair_queue (_FairQueue): The queue which shares out the global
+                concurrency budget.
         """
         self.clock = clock
+        self.fair_queue = fair_queue
 
         self.window_size = config.window_size
         self.sleep_limit = config.sleep_limit
@@ -90,20 +225,20 @@ class _PerHostRatelimiter(object):
         self.request_times = []
 
     @contextlib.contextmanager
-    def ratelimit(self):
+    def ratelimit(self, host, cost):
         # `contextlib.contextmanager` takes a generator and turns it into a
         # context manager. The generator should only yield once with a value
         # to be returned by manager.
         # Exceptions will be reraised at the yield.
 
         request_id = object()
-        ret = self._on_enter(request_id)
+        ret = self._on_enter(request_id, host, cost)
         try:
             yield ret
         finally:
             self._on_exit(request_id)
 
-    def _on_enter(self, request_id):
+    def _on_enter(self, request_id, host, cost):
         time_now = self.clock.time_msec()
 
         # remove any entries from request_times which aren't within the window
@@ -176,10 +311,15 @@ class _PerHostRatelimiter(object):
 
         ret_defer.addCallbacks(on_start, on_err)
         ret_defer.addBoth(on_both)
+
+        # Once this host's limits allow the request, it still has to wait for
+        # a share of the global budget.
+        ret_defer.addCallback(lambda _: self.fair_queue.acquire(request_id, host, cost))
         return make_deferred_yieldable(ret_defer)
 
     def _on_exit(self, request_id):
         logger.debug("Ratelimit [%s]: Processed req", id(request_id))
+        self.fair_queue.release(request_id)
         self.current_processing.discard(request_id)
         try:
             # start processing the next item on the queue.
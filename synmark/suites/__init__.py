@@ -1,3 +1,10 @@
-from . import logging
+from . import logging, state_res
 
-SUITES = [(logging, 1000), (logging, 10000), (logging, None)]
+SUITES = [
+    (logging, 1000),
+    (logging, 10000),
+    (logging, None),
+    (state_res, 1000),
+    (state_res, 10000),
+    (state_res, 50000),
+]
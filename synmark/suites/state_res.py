@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+from pyperf import perf_counter
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.events import make_event_from_dict
+from synapse.state.v2 import _reverse_topological_power_sort
+
+ROOM_ID = "!bench:example.com"
+CREATOR = "@creator:example.com"
+
+# How many distinct senders the synthetic events are spread across.
+NUM_SENDERS = 100
+
+# One in this many events is a power levels change, the rest are kicks.
+POWER_LEVEL_EVERY = 20
+
+
+class _StateResStore(object):
+    """A minimal in-memory StateResolutionStore over a dict of events."""
+
+    def __init__(self, event_map):
+        self.event_map = event_map
+
+    def get_events(self, event_ids, allow_rejected=False):
+        return defer.succeed(
+            {eid: self.event_map[eid] for eid in event_ids if eid in self.event_map}
+        )
+
+
+def _make_event(event_id, sender, type, state_key, content, auth_events, ts):
+    return make_event_from_dict(
+        {
+            "auth_events": [(a, {}) for a in auth_events],
+            "prev_events": [],
+            "event_id": event_id,
+            "sender": sender,
+            "type": type,
+            "state_key": state_key,
+            "content": content,
+            "origin_server_ts": ts,
+            "room_id": ROOM_ID,
+        }
+    )
+
+
+def build_auth_dag(num_events, seed=0):
+    """Build a synthetic auth DAG of power events.
+
+    The DAG has a create event, a power levels event and a membership event for
+    each sender, followed by `num_events` kicks and power level changes, each
+    of which cites the power levels event current at the time it was sent.
+
+    Args:
+        num_events (int): the number of power events to generate
+        seed (int): seed for the random choice of senders
+
+    Returns:
+        tuple[dict[str, FrozenEvent], list[str]]: the map of all events and the
+        IDs of the generated power events.
+    """
+    rng = random.Random(seed)
+    event_map = {}
+    ts = 0
+
+    def add(event_id, sender, type, state_key, content, auth_events):
+        nonlocal ts
+        ts += 1
+        event_map[event_id] = _make_event(
+            event_id, sender, type, state_key, content, auth_events, ts
+        )
+        return event_id
+
+    create_id = add("$create", CREATOR, EventTypes.Create, "", {"creator": CREATOR}, [])
+
+    senders = ["@user%d:example.com" % (i,) for i in range(NUM_SENDERS)]
+    users = {CREATOR: 100}
+    users.update({sender: 50 + i % 50 for i, sender in enumerate(senders)})
+
+    pl_id = add(
+        "$pl0", CREATOR, EventTypes.PowerLevels, "", {"users": users}, [create_id]
+    )
+
+    member_ids = {}
+    for sender in senders:
+        member_ids[sender] = add(
+            "$join_%s" % (sender,),
+            sender,
+            EventTypes.Member,
+            sender,
+            {"membership": Membership.JOIN},
+            [create_id, pl_id],
+        )
+
+    power_event_ids = []
+    for i in range(num_events):
+        sender = rng.choice(senders)
+        auth_events = [create_id, pl_id, member_ids[sender]]
+
+        if i % POWER_LEVEL_EVERY == 0:
+            pl_id = add(
+                "$pl%d" % (i + 1,),
+                sender,
+                EventTypes.PowerLevels,
+                "",
+                {"users": users},
+                auth_events,
+            )
+            power_event_ids.append(pl_id)
+        else:
+            target = rng.choice(senders)
+            power_event_ids.append(
+                add(
+                    "$kick%d" % (i,),
+                    sender,
+                    EventTypes.Member,
+                    target,
+                    {"membership": Membership.LEAVE},
+                    auth_events + [member_ids[target]],
+                )
+            )
+
+    return event_map, power_event_ids
+
+
+async def main(reactor, loops):
+    """
+    Benchmark how long it takes to sort an auth DAG with `loops` power events.
+    """
+    event_map, power_event_ids = build_auth_dag(loops)
+    auth_diff = set(event_map)
+    store = _StateResStore(event_map)
+
+    start = perf_counter()
+
+    await _reverse_topological_power_sort(
+        ROOM_ID, power_event_ids, dict(event_map), store, auth_diff
+    )
+
+    return perf_counter() - start
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from synapse.config import ConfigError
+from synapse.config.homeserver import HomeServerConfig
+from synapse.config.workers import ShardedWorkerHandlingConfig
+
+from tests.unittest import TestCase
+from tests.utils import default_config
+
+
+class ShardedWorkerHandlingConfigTestCase(TestCase):
+    def test_unsharded(self):
+        config = ShardedWorkerHandlingConfig([])
+        self.assertTrue(config.should_handle("master", "example.com"))
+
+    def test_each_key_handled_once(self):
+        instances = ["sender1", "sender2", "sender3"]
+        config = ShardedWorkerHandlingConfig(instances)
+
+        counts = dict.fromkeys(instances, 0)
+        for i in range(300):
+            key = "host%d.example.com" % (i,)
+            handlers = [name for name in instances if config.should_handle(name, key)]
+            self.assertEqual(len(handlers), 1)
+            counts[handlers[0]] += 1
+
+        # The keys should be spread roughly evenly between the instances.
+        for count in counts.values():
+            self.assertTrue(50 < count < 150, counts)
+
+        self.assertFalse(config.should_handle("other", "host1.example.com"))
+
+    def test_main_process_must_not_send_federation(self):
+        config_dict = default_config("test")
+        config_dict["federation_sender_instances"] = ["sender1", "sender2"]
+        config_dict["send_federation"] = True
+
+        config = HomeServerConfig()
+        with self.assertRaises(ConfigError):
+            config.parse_config_dict(config_dict, "", "")
+
+        config_dict["send_federation"] = False
+        config.parse_config_dict(config_dict, "", "")
+        self.assertEqual(
+            config.federation_shard_config.instances, ["sender1", "sender2"]
+        )
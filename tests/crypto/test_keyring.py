@@ -25,12 +25,18 @@ from signedjson.key import encode_verify_key_base64, get_verify_key
 from twisted.internet import defer
 
 from synapse.api.errors import SynapseError
+from synapse.api.room_versions import RoomVersions
 from synapse.crypto import keyring
+from synapse.crypto.event_signing import (
+    add_hashes_and_signatures,
+    encode_redacted_event_json,
+)
 from synapse.crypto.keyring import (
     PerspectivesKeyFetcher,
     ServerKeyFetcher,
     StoreKeyFetcher,
 )
+from synapse.events import make_event_from_dict
 from synapse.logging.context import (
     LoggingContext,
     PreserveLoggingContext,
@@ -325,6 +331,141 @@ class KeyringTestCase(unittest.HomeserverTestCase):
         mock_fetcher1.get_keys.assert_called_once()
         mock_fetcher2.get_keys.assert_called_once()
 
+    def test_verify_json_uses_cached_keys(self):
+        """Keys we have fetched are remembered for later verifications"""
+        key1 = signedjson.key.generate_signing_key(1)
+
+        def get_keys(keys_to_fetch):
+            return defer.succeed(
+                {
+                    "server1": {
+                        get_key_id(key1): FetchKeyResult(get_verify_key(key1), 1200)
+                    }
+                }
+            )
+
+        mock_fetcher = keyring.KeyFetcher()
+        mock_fetcher.get_keys = Mock(side_effect=get_keys)
+        kr = keyring.Keyring(self.hs, key_fetchers=(mock_fetcher,))
+
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server1", key1)
+
+        d = _verify_json_for_server(kr, "server1", json1, 1000, "test1")
+        self.get_success(d)
+        mock_fetcher.get_keys.assert_called_once()
+
+        # a second verification with the same key doesn't need a fetch
+        d = _verify_json_for_server(kr, "server1", json1, 1100, "test2")
+        self.get_success(d)
+        mock_fetcher.get_keys.assert_called_once()
+
+        # ... unless the key we have isn't valid for long enough
+        d = _verify_json_for_server(kr, "server1", json1, 1500, "test3")
+        self.get_failure(d, SynapseError)
+        self.assertEqual(mock_fetcher.get_keys.call_count, 2)
+
+    def test_verify_json_objects_in_batches(self):
+        """Many objects can be checked at once, with a bad signature only
+        failing its own object.
+        """
+        key1 = signedjson.key.generate_signing_key(1)
+        key2 = signedjson.key.generate_signing_key(2)
+
+        mock_fetcher = keyring.KeyFetcher()
+        mock_fetcher.get_keys = Mock(
+            return_value=defer.succeed(
+                {
+                    "server1": {
+                        get_key_id(key1): FetchKeyResult(get_verify_key(key1), 1200)
+                    },
+                    "server2": {
+                        get_key_id(key2): FetchKeyResult(get_verify_key(key2), 1200)
+                    },
+                }
+            )
+        )
+        kr = keyring.Keyring(self.hs, key_fetchers=(mock_fetcher,))
+
+        to_verify = []
+        for i in range(keyring.VERIFY_BATCH_SIZE + 5):
+            server_name, key = ("server1", key1) if i % 2 else ("server2", key2)
+            json_object = {"i": i}
+            signedjson.sign.sign_json(json_object, server_name, key)
+            to_verify.append((server_name, json_object, 0, "test%i" % (i,)))
+
+        # tamper with one of the objects
+        to_verify[3][1]["i"] = -1
+
+        results = kr.verify_json_objects_for_server(to_verify)
+        for i, d in enumerate(results):
+            if i == 3:
+                e = self.get_failure(d, SynapseError).value
+                self.assertEqual(e.errcode, "M_UNAUTHORIZED")
+            else:
+                self.get_success(d)
+
+        mock_fetcher.get_keys.assert_called_once()
+
+    def test_verify_events_for_server(self):
+        """Events are checked against the given encodings of the redacted events"""
+        key1 = signedjson.key.generate_signing_key(1)
+
+        mock_fetcher = keyring.KeyFetcher()
+        mock_fetcher.get_keys = Mock(
+            return_value=defer.succeed(
+                {
+                    "server1": {
+                        get_key_id(key1): FetchKeyResult(get_verify_key(key1), 1200)
+                    }
+                }
+            )
+        )
+        kr = keyring.Keyring(self.hs, key_fetchers=(mock_fetcher,))
+
+        def make_event(body):
+            event_dict = {
+                "type": "m.room.message",
+                "room_id": "!room:server1",
+                "sender": "@user:server1",
+                "depth": 1,
+                "prev_events": [],
+                "auth_events": [],
+                "origin_server_ts": 1000,
+                "content": {"body": body},
+            }
+            add_hashes_and_signatures(RoomVersions.V5, event_dict, "server1", key1)
+            return event_dict
+
+        event = make_event_from_dict(make_event("hello"), RoomVersions.V5)
+
+        # the signature only covers the redacted event, so changing the
+        # content doesn't invalidate it...
+        modified_event_dict = make_event("hello")
+        modified_event_dict["content"]["body"] = "goodbye"
+        modified_event = make_event_from_dict(modified_event_dict, RoomVersions.V5)
+
+        # ... but changing the timestamp does
+        tampered_event_dict = make_event("hello")
+        tampered_event_dict["origin_server_ts"] = 1001
+        tampered_event = make_event_from_dict(tampered_event_dict, RoomVersions.V5)
+
+        results = kr.verify_events_for_server(
+            [
+                (
+                    "server1",
+                    e,
+                    encode_redacted_event_json(RoomVersions.V5, e.get_dict()),
+                    0,
+                )
+                for e in (event, modified_event, tampered_event)
+            ]
+        )
+        self.get_success(results[0])
+        self.get_success(results[1])
+        e = self.get_failure(results[2], SynapseError).value
+        self.assertEqual(e.errcode, "M_UNAUTHORIZED")
+
 
 class ServerKeyFetcherTestCase(unittest.HomeserverTestCase):
     def make_homeserver(self, reactor, clock):
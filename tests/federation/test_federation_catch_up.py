@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+import synapse.rest.admin
+from synapse.api.errors import RequestSendFailed
+from synapse.rest.client.v1 import login, room
+
+from tests.unittest import HomeserverTestCase, override_config
+
+
+class FederationCatchUpTestCases(HomeserverTestCase):
+    servlets = [
+        synapse.rest.admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver(
+            federation_transport_client=Mock(spec=["send_transaction"]),
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.sender = hs.get_federation_sender()
+
+        self.sent_pdus = []
+        self.failing = False
+
+        def send_transaction(transaction, json_data_cb):
+            if self.failing:
+                return defer.fail(RequestSendFailed(Exception("down"), False))
+            self.sent_pdus.append(
+                [pdu["content"]["body"] for pdu in json_data_cb()["pdus"]]
+            )
+            return defer.succeed({})
+
+        hs.get_federation_transport_client().send_transaction = send_transaction
+
+        self.register_user("u1", "you the one")
+        self.tok = self.login("u1", "you the one")
+
+    def _send_message(self, room_id, body):
+        event_id = self.helper.send(room_id, body, tok=self.tok)["event_id"]
+        event = self.get_success(self.store.get_event(event_id))
+        self.get_success(self.sender._send_pdu(event, ["host2"]))
+        self.pump()
+
+    @override_config({"send_federation": True})
+    def test_catch_up_after_outage(self):
+        """
+        While a destination is unreachable we stop queueing PDUs for it, then
+        send it the latest event in each room it missed once it is back.
+        """
+        room_1 = self.helper.create_room_as("u1", tok=self.tok)
+        room_2 = self.helper.create_room_as("u1", tok=self.tok)
+
+        self._send_message(room_1, "wombats")
+        self.assertEqual(self.sent_pdus, [["wombats"]])
+
+        self.failing = True
+        self._send_message(room_1, "rabbits")
+        self._send_message(room_1, "hares")
+        self._send_message(room_1, "beavers")
+        self._send_message(room_2, "otters")
+
+        queue = self.sender._per_destination_queues["host2"]
+        self.assertTrue(queue._catching_up)
+        self.assertEqual(queue.pending_pdu_count(), 0)
+
+        self.failing = False
+        self.sender.wake_destination("host2")
+        self.pump()
+
+        self.assertEqual(self.sent_pdus, [["wombats"], ["beavers", "otters"]])
+        self.assertFalse(queue._catching_up)
+
+        last_successful = self.get_success(
+            self.store.get_destination_last_successful_stream_ordering("host2")
+        )
+        self.assertEqual(last_successful, self.store.get_room_max_stream_ordering())
+
+        # Once caught up, PDUs are sent as normal again.
+        self._send_message(room_2, "badgers")
+        self.assertEqual(self.sent_pdus[-1], ["badgers"])
+
+    @override_config({"send_federation": True})
+    def test_catch_up_from_first_failure(self):
+        """
+        A destination we have never successfully sent to is caught up from the
+        first PDU we failed to send it.
+        """
+        room_1 = self.helper.create_room_as("u1", tok=self.tok)
+
+        self.failing = True
+        self._send_message(room_1, "wombats")
+        self._send_message(room_1, "rabbits")
+
+        queue = self.sender._per_destination_queues["host2"]
+        self.assertEqual(queue.pending_pdu_count(), 0)
+
+        self.failing = False
+        self.sender.wake_destination("host2")
+        self.pump()
+
+        self.assertEqual(self.sent_pdus, [["rabbits"]])
@@ -17,6 +17,7 @@ from mock import Mock
 
 from twisted.internet import defer
 
+from synapse.app.generic_worker import GenericWorkerServer
 from synapse.types import ReadReceipt
 
 from tests.unittest import HomeserverTestCase, override_config
@@ -147,3 +148,120 @@ class FederationSenderTestCases(HomeserverTestCase):
                 }
             ],
         )
+
+    @override_config(
+        {
+            "send_federation": True,
+            "worker_app": "synapse.app.federation_sender",
+            "worker_name": "sender1",
+            "federation_sender_instances": ["sender1", "sender2"],
+        }
+    )
+    def test_send_receipts_sharded(self):
+        """Only the destinations for this instance's shard get sent receipts."""
+        hosts = ["host%d" % (i,) for i in range(10)]
+        shard_config = self.hs.config.federation_shard_config
+        our_hosts = [h for h in hosts if shard_config.should_handle("sender1", h)]
+        self.assertTrue(0 < len(our_hosts) < len(hosts))
+
+        mock_state_handler = self.hs.get_state_handler()
+        mock_state_handler.get_current_hosts_in_room.return_value = hosts
+
+        mock_send_transaction = (
+            self.hs.get_federation_transport_client().send_transaction
+        )
+        mock_send_transaction.return_value = defer.succeed({})
+
+        sender = self.hs.get_federation_sender()
+        receipt = ReadReceipt(
+            "room_id", "m.read", "user_id", ["event_id"], {"ts": 1234}
+        )
+        self.successResultOf(sender.send_read_receipt(receipt))
+
+        self.pump()
+
+        destinations = {
+            call[0][0].destination for call in mock_send_transaction.call_args_list
+        }
+        self.assertEqual(destinations, set(our_hosts))
+
+
+class FederationStreamPositionTestCase(HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+    def test_positions_follow_instances(self):
+        """
+        Each federation sender instance gets its own position in the federation
+        streams, starting from the earliest of the existing positions.
+        """
+        self.get_success(
+            self.store.db.simple_update_one(
+                "federation_stream_position",
+                {"type": "events", "instance_name": "master"},
+                {"stream_id": 5},
+            )
+        )
+
+        self.hs.config.federation_shard_config.instances = ["sender1", "sender2"]
+        self.store._need_to_reset_federation_stream_positions = True
+        self.store._federation_instance_name = "sender1"
+
+        self.assertEqual(
+            self.get_success(self.store.get_federation_out_pos("events")), 5
+        )
+        self.get_success(self.store.update_federation_out_pos("events", 7))
+
+        self.store._federation_instance_name = "sender2"
+        self.assertEqual(
+            self.get_success(self.store.get_federation_out_pos("events")), 5
+        )
+
+        rows = self.get_success(
+            self.store.db.simple_select_list(
+                "federation_stream_position",
+                {"type": "events"},
+                ("instance_name", "stream_id"),
+            )
+        )
+        self.assertEqual(
+            {row["instance_name"]: row["stream_id"] for row in rows},
+            {"sender1": 7, "sender2": 5},
+        )
+
+
+class FederationSenderWorkerStreamPositionTestCase(HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver(
+            http_client=None, homeserverToUse=GenericWorkerServer
+        )
+
+    def default_config(self, name="test"):
+        c = super().default_config(name)
+        c["worker_app"] = "synapse.app.federation_sender"
+        c["worker_name"] = "sender1"
+        c["send_federation"] = True
+        c["federation_sender_instances"] = ["sender1", "sender2"]
+        return c
+
+    def test_new_instance_startup_position(self):
+        """
+        A federation sender instance which has just been added starts from the
+        earliest of the existing positions.
+        """
+        store = self.hs.get_datastore()
+
+        self.get_success(
+            store.db.simple_update_one(
+                "federation_stream_position",
+                {"type": "federation", "instance_name": "master"},
+                {"stream_id": 5},
+            )
+        )
+        store._need_to_reset_federation_stream_positions = True
+        store._federation_instance_name = "sender2"
+
+        pos = self.get_success(
+            store.db.runWithConnection(store._get_federation_out_pos)
+        )
+        self.assertEqual(pos, 5)
@@ -15,8 +15,13 @@
 # limitations under the License.
 import logging
 
+from twisted.internet import defer
+
 from synapse.events import make_event_from_dict
+from synapse.federation.federation_base import event_from_pdu_json
 from synapse.federation.federation_server import server_matches_acl_event
+from synapse.federation.units import Transaction
+from synapse.logging.context import make_deferred_yieldable
 from synapse.rest import admin
 from synapse.rest.client.v1 import login, room
 
@@ -86,6 +91,62 @@ class StateQueryTests(unittest.FederatingHomeserverTestCase):
         self.assertEqual(members, {"@user:other.example.com", u1})
         self.assertEqual(len(channel.json_body["pdus"]), 6)
 
+    def test_state_at_event_cached_until_redaction(self):
+        """
+        Responses to v1/state/<room_id> for an event are cached, until an event
+        in the room is redacted.
+        """
+        u1 = self.register_user("u1", "pass")
+        u1_token = self.login("u1", "pass")
+
+        room_1 = self.helper.create_room_as(u1, tok=u1_token)
+        self.inject_room_member(room_1, "@user:other.example.com", "join")
+        name_event_id = self.helper.send_state(
+            room_1, "m.room.name", {"name": "wombats"}, tok=u1_token
+        )["event_id"]
+        event_id = self.helper.send(room_1, "hello", tok=u1_token)["event_id"]
+
+        federation_server = self.hs.get_federation_server()
+        compute = federation_server._on_context_state_request_compute
+        computed = []
+
+        def compute_and_count(room_id, event_id):
+            computed.append(event_id)
+            return compute(room_id, event_id)
+
+        federation_server._on_context_state_request_compute = compute_and_count
+
+        def get_name_content():
+            request, channel = self.make_request(
+                "GET",
+                "/_matrix/federation/v1/state/%s?event_id=%s" % (room_1, event_id),
+            )
+            self.render(request)
+            self.assertEquals(200, channel.code, channel.result)
+            self.assertEqual(
+                channel.json_body["room_version"],
+                self.hs.config.default_room_version.identifier,
+            )
+            for pdu in channel.json_body["pdus"]:
+                if pdu["type"] == "m.room.name":
+                    return pdu["content"]
+
+        self.assertEqual(get_name_content(), {"name": "wombats"})
+        self.assertEqual(get_name_content(), {"name": "wombats"})
+        self.assertEqual(computed, [event_id])
+
+        request, channel = self.make_request(
+            "PUT",
+            "/_matrix/client/r0/rooms/%s/redact/%s/txn1" % (room_1, name_event_id),
+            content={},
+            access_token=u1_token,
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code, channel.result)
+
+        self.assertEqual(get_name_content(), {})
+        self.assertEqual(computed, [event_id, event_id])
+
     def test_needs_to_be_in_room(self):
         """
         Querying v1/state/<room_id> requires the server
@@ -104,6 +165,50 @@ class StateQueryTests(unittest.FederatingHomeserverTestCase):
         self.assertEqual(channel.json_body["errcode"], "M_FORBIDDEN")
 
 
+class BackfillQueryTests(unittest.FederatingHomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def test_cached_response_is_timestamped(self):
+        """
+        Cached responses to v1/backfill/<room_id> carry the time they are sent
+        rather than that they were cached, and don't include stale ages.
+        """
+        u1 = self.register_user("u1", "pass")
+        u1_token = self.login("u1", "pass")
+
+        room_1 = self.helper.create_room_as(u1, tok=u1_token)
+        self.inject_room_member(room_1, "@user:other.example.com", "join")
+        event_id = self.helper.send(room_1, "hello", tok=u1_token)["event_id"]
+
+        def backfill():
+            request, channel = self.make_request(
+                "GET",
+                "/_matrix/federation/v1/backfill/%s?v=%s&limit=5" % (room_1, event_id),
+            )
+            self.render(request)
+            self.assertEquals(200, channel.code, channel.result)
+            return channel.json_body
+
+        first = backfill()
+        self.assertEqual(first["origin"], self.hs.hostname)
+
+        self.reactor.advance(60)
+        second = backfill()
+        self.assertGreaterEqual(
+            second["origin_server_ts"] - first["origin_server_ts"], 60000
+        )
+        self.assertEqual(second["pdus"], first["pdus"])
+        self.assertIn("hello", [pdu["content"].get("body") for pdu in second["pdus"]])
+        for pdu in second["pdus"]:
+            self.assertNotIn("age", pdu["unsigned"])
+            self.assertNotIn("age_ts", pdu["unsigned"])
+
+
 def _create_acl_event(content):
     return make_event_from_dict(
         {
@@ -114,3 +219,142 @@ def _create_acl_event(content):
             "content": content,
         }
     )
+
+
+class TransactionTimeBudgetTests(unittest.FederatingHomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        super(TransactionTimeBudgetTests, self).prepare(reactor, clock, hs)
+        self.federation_server = hs.get_federation_server()
+
+        u1 = self.register_user("u1", "pass")
+        u1_token = self.login("u1", "pass")
+        self.slow_room = self.helper.create_room_as(u1, tok=u1_token)
+        self.fast_room = self.helper.create_room_as(u1, tok=u1_token)
+
+        # The "slow" PDU blocks until we fire this deferred.
+        self.slow_pdu_handled = defer.Deferred()
+
+        async def _handle_received_pdu(origin, pdu):
+            if pdu.content["body"] == "slow":
+                await make_deferred_yieldable(self.slow_pdu_handled)
+
+        self.federation_server._handle_received_pdu = _handle_received_pdu
+
+    def _pdu(self, room_id, body):
+        return {
+            "type": "m.room.message",
+            "room_id": room_id,
+            "sender": "@user:other.example.com",
+            "depth": 10,
+            "content": {"body": body},
+            "prev_events": [],
+            "auth_events": [],
+            "origin_server_ts": 0,
+        }
+
+    def _transaction(self, transaction_id, pdus):
+        return Transaction(
+            transaction_id=transaction_id,
+            origin="other.example.com",
+            destination=self.hs.hostname,
+            origin_server_ts=0,
+            pdus=pdus,
+        )
+
+    @unittest.override_config({"federation_transaction_time_budget": "10s"})
+    def test_slow_room_does_not_block_response(self):
+        """
+        Once the time budget has run out we respond with the results for the
+        rooms we have processed, and carry on with the rest in the background.
+        """
+        room_version = self.hs.config.default_room_version
+        slow_pdu = self._pdu(self.slow_room, "slow")
+        fast_pdu = self._pdu(self.fast_room, "fast")
+        fast_event_id = event_from_pdu_json(dict(fast_pdu), room_version).event_id
+
+        d = defer.ensureDeferred(
+            self.federation_server._handle_pdus_in_txn(
+                "other.example.com",
+                self._transaction("txn1", [slow_pdu, fast_pdu]),
+                self.clock.time_msec(),
+            )
+        )
+        self.pump()
+        self.assertFalse(d.called)
+
+        self.reactor.advance(10)
+        self.assertEqual(self.successResultOf(d), {fast_event_id: {}})
+
+        # PDUs for the slow room in the next transaction wait for those from
+        # the first.
+        second_slow_pdu = self._pdu(self.slow_room, "second")
+        second_slow_event_id = event_from_pdu_json(
+            dict(second_slow_pdu), room_version
+        ).event_id
+        d = defer.ensureDeferred(
+            self.federation_server._handle_pdus_in_txn(
+                "other.example.com",
+                self._transaction("txn2", [second_slow_pdu]),
+                self.clock.time_msec(),
+            )
+        )
+        self.pump()
+        self.assertFalse(d.called)
+
+        self.slow_pdu_handled.callback(None)
+        self.pump()
+        self.assertEqual(self.successResultOf(d), {second_slow_event_id: {}})
+
+    @unittest.override_config({"federation_transaction_time_budget": "10s"})
+    def test_backlog_blocks_next_transaction(self):
+        """
+        We don't start on another transaction from a server until we have
+        finished the PDUs we carried on processing after responding to its
+        last one.
+        """
+        room_version = self.hs.config.default_room_version
+        d = defer.ensureDeferred(
+            self.federation_server._handle_pdus_in_txn(
+                "other.example.com",
+                self._transaction("txn1", [self._pdu(self.slow_room, "slow")]),
+                self.clock.time_msec(),
+            )
+        )
+        self.reactor.advance(10)
+        self.assertEqual(self.successResultOf(d), {})
+
+        fast_pdu = self._pdu(self.fast_room, "fast")
+        fast_event_id = event_from_pdu_json(dict(fast_pdu), room_version).event_id
+        d = defer.ensureDeferred(
+            self.federation_server._handle_pdus_in_txn(
+                "other.example.com",
+                self._transaction("txn2", [fast_pdu]),
+                self.clock.time_msec(),
+            )
+        )
+
+        # Transactions from other servers aren't held up.
+        other_d = defer.ensureDeferred(
+            self.federation_server._handle_pdus_in_txn(
+                "another.example.com",
+                self._transaction("txn1", [fast_pdu]),
+                self.clock.time_msec(),
+            )
+        )
+        self.pump()
+        self.assertEqual(self.successResultOf(other_d), {fast_event_id: {}})
+
+        # Even once the second transaction's time budget has run out.
+        self.reactor.advance(10)
+        self.assertFalse(d.called)
+
+        self.slow_pdu_handled.callback(None)
+        self.pump()
+        self.assertEqual(self.successResultOf(d), {fast_event_id: {}})
@@ -14,10 +14,19 @@
 # limitations under the License.
 import logging
 
+from mock import patch
+
+from twisted.internet import defer
+
 from synapse.api.constants import EventTypes
-from synapse.api.errors import AuthError, Codes
+from synapse.api.errors import AuthError, Codes, RequestSendFailed
+from synapse.api.room_versions import KNOWN_ROOM_VERSIONS
 from synapse.federation.federation_base import event_from_pdu_json
-from synapse.logging.context import LoggingContext, run_in_background
+from synapse.logging.context import (
+    LoggingContext,
+    make_deferred_yieldable,
+    run_in_background,
+)
 from synapse.rest import admin
 from synapse.rest.client.v1 import login, room
 
@@ -189,6 +198,100 @@ class FederationTestCase(unittest.HomeserverTestCase):
 
         self.assertEqual(sg, sg2)
 
+    def test_backfill_from_first_server_to_respond(self):
+        """
+        When backfilling we ask several servers at once, and use the first to
+        give us some events.
+        """
+        responses = {
+            "slow.example.com": defer.Deferred(),
+            "empty.example.com": None,
+            "failing.example.com": None,
+            "good.example.com": defer.Deferred(),
+        }
+
+        def backfill(dest, room_id, limit, extremities):
+            if dest == "empty.example.com":
+                return defer.succeed([])
+            if dest == "failing.example.com":
+                return defer.fail(RequestSendFailed(Exception(), False))
+            return make_deferred_yieldable(responses[dest])
+
+        self.handler.federation_client.backfill = backfill
+
+        d = defer.ensureDeferred(
+            self.handler._request_backfill_from_first(
+                list(responses), "!room:test", ["$extremity"]
+            )
+        )
+        self.pump()
+        self.assertFalse(d.called)
+
+        responses["good.example.com"].callback(["event"])
+        self.assertEqual(
+            self.successResultOf(d), ("good.example.com", ["event"]),
+        )
+
+        # if nobody returns any events, we go with a server which responded.
+        d = defer.ensureDeferred(
+            self.handler._request_backfill_from_first(
+                ["empty.example.com", "failing.example.com"],
+                "!room:test",
+                ["$extremity"],
+            )
+        )
+        self.assertEqual(self.successResultOf(d), ("empty.example.com", []))
+
+        d = defer.ensureDeferred(
+            self.handler._request_backfill_from_first(
+                ["failing.example.com"], "!room:test", ["$extremity"]
+            )
+        )
+        self.assertIsNone(self.successResultOf(d))
+
+    def test_persist_auth_tree_in_batches(self):
+        """
+        The auth chain and state of a room we join are persisted once each, in
+        batches, in topological order.
+        """
+        user_id = self.register_user("kermit", "test")
+        tok = self.login("kermit", "test")
+        room_id = self.helper.create_room_as(room_creator=user_id, tok=tok)
+
+        state_ids = self.get_success(self.store.get_current_state_ids(room_id))
+        state_map = self.get_success(self.store.get_events(list(state_ids.values())))
+        create_event = state_map[state_ids[(EventTypes.Create, "")]]
+        room_version = KNOWN_ROOM_VERSIONS[create_event.content["room_version"]]
+
+        # treat the creator's join as the event we are joining with.
+        member_event = state_map.pop(state_ids[(EventTypes.Member, user_id)])
+        state = list(state_map.values())
+
+        batches = []
+
+        async def persist_events_and_notify(events_and_contexts, backfilled=False):
+            batches.append([e for e, _ in events_and_contexts])
+
+        self.handler.persist_events_and_notify = persist_events_and_notify
+
+        with patch("synapse.handlers.federation.JOIN_PERSIST_BATCH_SIZE", 2):
+            self.get_success(
+                self.handler._persist_auth_tree(
+                    "test", list(reversed(state)), state, member_event, room_version
+                )
+            )
+
+        # the event itself is persisted last, on its own.
+        self.assertEqual(batches.pop(), [member_event])
+
+        self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        persisted = [e for batch in batches for e in batch]
+        self.assertCountEqual(
+            [e.event_id for e in persisted], [e.event_id for e in state]
+        )
+        depths = [e.depth for e in persisted]
+        self.assertEqual(depths, sorted(depths))
+
     def _build_and_send_join_event(self, other_server, other_user, room_id):
         join_event = self.get_success(
             self.handler.on_make_join_request(other_server, room_id, other_user)
@@ -28,6 +28,7 @@ from synapse.handlers.presence import (
     IDLE_TIMER,
     LAST_ACTIVE_GRANULARITY,
     SYNC_ONLINE_TIMEOUT,
+    get_interested_remotes,
     handle_timeout,
     handle_update,
 )
@@ -588,6 +589,30 @@ class PresenceJoinTestCase(unittest.HomeserverTestCase):
             destinations={"server2", "server3"}, states=[expected_state]
         )
 
+    def test_interested_remotes(self):
+        # Create two rooms with a local user, which share one remote server
+        room_1 = self.helper.create_room_as(self.user_id)
+        room_2 = self.helper.create_room_as(self.user_id)
+        self._add_new_user(room_1, "@alice:server2")
+        self._add_new_user(room_2, "@alice:server2")
+        self._add_new_user(room_2, "@bob:server3")
+
+        state = UserPresenceState.default(self.user_id)
+
+        # Each server is sent the state once, however many rooms it shares
+        # with the user.
+        hosts_and_states = self.get_success(get_interested_remotes(self.store, [state]))
+        self.assertCountEqual(
+            hosts_and_states,
+            [(["server"], [state]), (["server2"], [state]), (["server3"], [state])],
+        )
+
+        # A new server joining one of the rooms is picked up.
+        self._add_new_user(room_1, "@carol:server4")
+        hosts_and_states = self.get_success(get_interested_remotes(self.store, [state]))
+        self.assertIn((["server4"], [state]), hosts_and_states)
+        self.assertEqual(len(hosts_and_states), 4)
+
     def _add_new_user(self, room_id, user_id):
         """Add new user to the room by creating an event and poking the federation API.
         """
@@ -13,9 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from mock import Mock
+
 from synapse.api.errors import Codes, ResourceLimitError
 from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
 from synapse.handlers.sync import SyncConfig
+from synapse.rest import admin
+from synapse.rest.client.v1 import login, room
 from synapse.types import UserID
 
 import tests.unittest
@@ -25,6 +29,12 @@ import tests.utils
 class SyncTestCase(tests.unittest.HomeserverTestCase):
     """ Tests Sync Handler. """
 
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
     def prepare(self, reactor, clock, hs):
         self.hs = hs
         self.sync_handler = self.hs.get_sync_handler()
@@ -60,6 +70,47 @@ class SyncTestCase(tests.unittest.HomeserverTestCase):
         )
         self.assertEquals(e.value.errcode, Codes.RESOURCE_LIMIT_EXCEEDED)
 
+    def test_incremental_sync_uses_snapshot(self):
+        user_id = self.register_user("kermit", "monkey")
+        tok = self.login("kermit", "monkey")
+        room_id1 = self.helper.create_room_as(user_id, tok=tok)
+
+        sync_config = self._generate_sync_config(user_id)
+
+        result = self.get_success(self.sync_handler.wait_for_sync_for_user(sync_config))
+        self.assertEqual([room_id1], [r.room_id for r in result.joined])
+
+        # Nothing has changed, so the joined rooms should come from the
+        # snapshot of the last sync rather than being recalculated.
+        get_rooms_for_user_at = self.sync_handler.get_rooms_for_user_at
+        self.sync_handler.get_rooms_for_user_at = Mock(
+            side_effect=get_rooms_for_user_at
+        )
+
+        result = self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                sync_config, since_token=result.next_batch
+            )
+        )
+        self.assertEqual([], result.joined)
+        self.sync_handler.get_rooms_for_user_at.assert_not_called()
+
+        # Joining a new room means the joined rooms are recalculated.
+        room_id2 = self.helper.create_room_as(user_id, tok=tok)
+        self.helper.send(room_id1, "hello", tok=tok)
+
+        result = self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                sync_config, since_token=result.next_batch
+            )
+        )
+        self.assertCountEqual([room_id1, room_id2], [r.room_id for r in result.joined])
+        self.sync_handler.get_rooms_for_user_at.assert_called_once()
+
+        snapshot = self.sync_handler.sync_snapshot_cache[(user_id, "device_id")]
+        self.assertEqual(result.next_batch, snapshot.next_batch)
+        self.assertEqual({room_id1, room_id2}, snapshot.joined_room_ids)
+
     def _generate_sync_config(self, user_id):
         return SyncConfig(
             user=UserID(user_id.split(":")[0][1:], user_id.split(":")[1]),
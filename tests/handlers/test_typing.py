@@ -73,6 +73,8 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
                 "get_received_txn_response",
                 "set_received_txn_response",
                 "get_destination_retry_timings",
+                "get_destination_last_successful_stream_ordering",
+                "get_catch_up_outstanding_destinations",
                 "get_devices_by_remote",
                 "maybe_store_room_on_invite",
                 # Bits that user_directory needs
@@ -116,6 +118,13 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
             (0, [])
         )
 
+        self.datastore.get_destination_last_successful_stream_ordering.return_value = defer.succeed(
+            None
+        )
+        self.datastore.get_catch_up_outstanding_destinations.return_value = defer.succeed(
+            []
+        )
+
         def get_received_txn_response(*args):
             return defer.succeed(None)
 
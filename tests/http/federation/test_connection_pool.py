@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.http.federation.connection_pool import (
+    POOL_SWEEP_INTERVAL_MS,
+    FederationConnectionPool,
+)
+
+from tests import unittest
+from tests.server import get_clock
+
+
+class _FakeConnection(object):
+    def __init__(self):
+        self.state = "QUIESCENT"
+        self.transport = Mock()
+
+
+class FederationConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor, self.clock = get_clock()
+        self.pool = FederationConnectionPool(
+            self.reactor,
+            self.clock,
+            max_per_destination=3,
+            idle_timeout_ms=5 * 60 * 1000,
+            max_idle_connections=4,
+            prewarm_destinations=1,
+        )
+
+        self.opened = []
+
+        def connect(factory):
+            connection = _FakeConnection()
+            self.opened.append(connection)
+            return defer.succeed(connection)
+
+        self.endpoint = Mock(connect=connect)
+
+    def _get_connections(self, key, count):
+        return [
+            self.successResultOf(self.pool.getConnection(key, self.endpoint))
+            for _ in range(count)
+        ]
+
+    def _put_connections(self, key, connections):
+        for connection in connections:
+            self.pool._putConnection(key, connection)
+
+    def test_idle_connections_adapt_to_usage(self):
+        """
+        We keep as many idle connections to a destination as it recently had in
+        use at once, up to the limit.
+        """
+        connections = self._get_connections("a", 4)
+        self._put_connections("a", connections)
+        self.assertEqual(len(self.pool._connections["a"]), 3)
+        self.assertEqual(len(self.opened), 4)
+
+        # the idle connections are reused.
+        connections = self._get_connections("a", 2)
+        self.assertEqual(len(self.opened), 4)
+        self._put_connections("a", connections)
+
+        # once it has been quiet for a while, we only keep one.
+        self.reactor.advance(POOL_SWEEP_INTERVAL_MS / 1000.0)
+        self.reactor.advance(POOL_SWEEP_INTERVAL_MS / 1000.0)
+        self.assertEqual(len(self.pool._connections["a"]), 1)
+        self.assertEqual(
+            sum(c.transport.loseConnection.call_count for c in self.opened), 3
+        )
+
+    def test_idle_connections_bounded(self):
+        """
+        Once there are too many idle connections in total, those to the least
+        recently used destinations are closed.
+        """
+        for key in ("a", "b", "c"):
+            self._put_connections(key, self._get_connections(key, 2))
+            self.reactor.advance(1)
+
+        self.assertEqual(self.pool._count_idle_connections(), 6)
+
+        self.reactor.advance(POOL_SWEEP_INTERVAL_MS / 1000.0)
+        self.assertEqual(self.pool._count_idle_connections(), 4)
+        self.assertNotIn("a", [k for k, v in self.pool._connections.items() if v])
+
+    def test_prewarm_most_active_destination(self):
+        """
+        We open a connection in advance to the most active destination when it
+        has none idle.
+        """
+        busy = self._get_connections("busy", 2)
+        quiet = self._get_connections("quiet", 1)
+        self.assertEqual(len(self.opened), 3)
+
+        self.reactor.advance(POOL_SWEEP_INTERVAL_MS / 1000.0)
+        self.assertEqual(len(self.opened), 4)
+        self.assertEqual(len(self.pool._connections["busy"]), 1)
+        self.assertFalse(self.pool._connections.get("quiet"))
+
+        # the next request to the destination uses the new connection.
+        self.assertIs(
+            self.successResultOf(self.pool.getConnection("busy", self.endpoint)),
+            self.opened[3],
+        )
+
+        self._put_connections("busy", busy)
+        self._put_connections("quiet", quiet)
+
+    def test_idle_timeout_after_trim(self):
+        """
+        Idle connections we close to keep under the limit don't break the pool
+        when their idle timeout would have fired.
+        """
+        connections = self._get_connections("a", 4)
+        self._put_connections("a", connections)
+        self.assertEqual(len(self.pool._connections["a"]), 3)
+        self.assertEqual(len(self.pool._timeouts), 3)
+
+        self.reactor.advance(self.pool.cachedConnectionTimeout + 1)
+        self.assertFalse(self.pool._connections.get("a"))
+        self.assertEqual(self.pool._timeouts, {})
+        for connection in connections:
+            connection.transport.loseConnection.assert_called_once_with()
+
+    def test_forgotten_destination_prewarmed(self):
+        """
+        Sweeping doesn't fail if a destination with recent requests is
+        forgotten about in the same sweep.
+        """
+        pool = FederationConnectionPool(
+            self.reactor,
+            self.clock,
+            max_per_destination=3,
+            idle_timeout_ms=10 * 1000,
+            max_idle_connections=4,
+            prewarm_destinations=1,
+        )
+        connection = self.successResultOf(pool.getConnection("a", self.endpoint))
+        pool._putConnection("a", connection)
+
+        # the connection times out before the sweep, which then forgets about
+        # the destination.
+        self.reactor.advance(POOL_SWEEP_INTERVAL_MS / 1000.0)
+        self.assertNotIn("a", pool._destinations)
+        self.assertEqual(len(self.opened), 2)
+        self.assertEqual(len(pool._connections["a"]), 1)
+
+        # the sweep keeps on running.
+        self.reactor.advance(POOL_SWEEP_INTERVAL_MS / 1000.0)
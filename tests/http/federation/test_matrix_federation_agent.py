@@ -1074,6 +1074,53 @@ class MatrixFederationAgentTests(unittest.TestCase):
         r = self.successResultOf(fetch_d)
         self.assertEqual(r.delegated_server, None)
 
+    def test_well_known_stored(self):
+        """Test that well-known results are stored in the database, and used
+        instead of fetching the well-known if they aren't cached in memory.
+        """
+        self.reactor.lookups["testserv"] = "1.2.3.4"
+
+        store = Mock()
+        store.get_federation_resolution.return_value = defer.succeed(None)
+        store.set_federation_resolution.return_value = defer.succeed(None)
+        self.well_known_resolver._store = store
+
+        fetch_d = self.well_known_resolver.get_well_known(b"testserv")
+
+        clients = self.reactor.tcpClients
+        self.assertEqual(len(clients), 1)
+        (host, port, client_factory, _timeout, _bindAddress) = clients.pop(0)
+
+        self._handle_well_known_connection(
+            client_factory,
+            expected_sni=b"testserv",
+            response_headers={b"Cache-Control": b"max-age=1000"},
+            content=b'{ "m.server": "target-server" }',
+        )
+
+        r = self.successResultOf(fetch_d)
+        self.assertEqual(r.delegated_server, b"target-server")
+
+        store.set_federation_resolution.assert_called_once_with(
+            "well_known",
+            "testserv",
+            {"m.server": "target-server"},
+            int((self.reactor.seconds() + 1000) * 1000),
+        )
+
+        # with an empty cache, e.g. after a restart or on another worker, the
+        # stored result is used.
+        stored = store.set_federation_resolution.call_args[0]
+        store.get_federation_resolution.return_value = defer.succeed(
+            (stored[2], stored[3])
+        )
+        self.well_known_cache.pop(b"testserv")
+
+        fetch_d = self.well_known_resolver.get_well_known(b"testserv")
+        r = self.successResultOf(fetch_d)
+        self.assertEqual(r.delegated_server, b"target-server")
+        self.assertEqual(len(clients), 0)
+
     def test_srv_fallbacks(self):
         """Test that other SRV results are tried if the first one fails.
         """
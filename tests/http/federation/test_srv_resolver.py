@@ -21,7 +21,11 @@ from twisted.internet.defer import Deferred
 from twisted.internet.error import ConnectError
 from twisted.names import dns, error
 
-from synapse.http.federation.srv_resolver import SrvResolver
+from synapse.http.federation.srv_resolver import (
+    SRV_NEGATIVE_CACHE_PERIOD,
+    Server,
+    SrvResolver,
+)
 from synapse.logging.context import LoggingContext
 
 from tests import unittest
@@ -211,3 +215,161 @@ class SrvResolverTestCase(unittest.TestCase):
         self.assertEquals(len(servers), 1)
         self.assertEquals(servers, cache[service_name])
         self.assertEquals(servers[0].host, b"host")
+
+    def test_refresh_before_expiry(self):
+        """
+        Records which are about to expire are looked up again in the background,
+        and used in the meantime.
+        """
+        clock = MockClock()
+        service_name = b"test_service.example.com"
+
+        lookup_deferred = Deferred()
+        dns_client_mock = Mock()
+        dns_client_mock.lookupService.return_value = lookup_deferred
+
+        entry = Server(host=b"old-host", port=8448, expires=clock.now + 30)
+        cache = {service_name: [entry]}
+        resolver = SrvResolver(
+            dns_client=dns_client_mock, cache=cache, get_time=clock.time
+        )
+
+        for _ in range(2):
+            servers = self.successResultOf(resolver.resolve_service(service_name))
+            self.assertEquals(servers, [entry])
+
+        dns_client_mock.lookupService.assert_called_once_with(service_name)
+
+        lookup_deferred.callback(
+            (
+                [
+                    dns.RRHeader(
+                        type=dns.SRV,
+                        payload=dns.Record_SRV(target=b"new-host"),
+                        ttl=3600,
+                    )
+                ],
+                None,
+                None,
+            )
+        )
+
+        self.assertEquals(cache[service_name][0].host, b"new-host")
+
+    def test_stored_records(self):
+        """
+        Records are stored in the database, and used instead of looking them up
+        if they aren't cached in memory.
+        """
+        clock = MockClock()
+        service_name = b"test_service.example.com"
+
+        dns_client_mock = Mock()
+        dns_client_mock.lookupService.return_value = defer.succeed(
+            (
+                [
+                    dns.RRHeader(
+                        type=dns.SRV, payload=dns.Record_SRV(target=b"host"), ttl=3600
+                    )
+                ],
+                None,
+                None,
+            )
+        )
+
+        store = Mock()
+        store.get_federation_resolution.return_value = defer.succeed(None)
+        store.set_federation_resolution.return_value = defer.succeed(None)
+
+        resolver = SrvResolver(
+            dns_client=dns_client_mock, cache={}, get_time=clock.time, store=store
+        )
+        self.successResultOf(resolver.resolve_service(service_name))
+
+        store.get_federation_resolution.assert_called_once_with(
+            "srv", "test_service.example.com"
+        )
+        store.set_federation_resolution.assert_called_once_with(
+            "srv",
+            "test_service.example.com",
+            [
+                {
+                    "host": "host",
+                    "port": 0,
+                    "priority": 0,
+                    "weight": 0,
+                    "expires": clock.now + 3600,
+                }
+            ],
+            (clock.now + 3600) * 1000,
+        )
+
+        # another resolver with an empty cache uses the stored records.
+        stored = store.set_federation_resolution.call_args[0]
+        store.get_federation_resolution.return_value = defer.succeed(
+            (stored[2], stored[3])
+        )
+        dns_client_mock.lookupService.reset_mock()
+
+        cache = {}
+        resolver = SrvResolver(
+            dns_client=dns_client_mock, cache=cache, get_time=clock.time, store=store
+        )
+        servers = self.successResultOf(resolver.resolve_service(service_name))
+
+        self.assertFalse(dns_client_mock.lookupService.called)
+        self.assertEquals(servers, cache[service_name])
+        self.assertEquals(servers[0].host, b"host")
+
+    def test_name_error_cached(self):
+        """
+        We remember that there are no records for a service for a while, and
+        store that in the database.
+        """
+        clock = MockClock()
+        service_name = b"test_service.example.com"
+
+        dns_client_mock = Mock()
+        dns_client_mock.lookupService.return_value = defer.fail(error.DNSNameError())
+
+        store = Mock()
+        store.get_federation_resolution.return_value = defer.succeed(None)
+        store.set_federation_resolution.return_value = defer.succeed(None)
+
+        resolver = SrvResolver(
+            dns_client=dns_client_mock, cache={}, get_time=clock.time, store=store
+        )
+        for _ in range(2):
+            servers = self.successResultOf(resolver.resolve_service(service_name))
+            self.assertEquals(servers, [])
+
+        dns_client_mock.lookupService.assert_called_once_with(service_name)
+        store.get_federation_resolution.assert_called_once_with(
+            "srv", "test_service.example.com"
+        )
+        store.set_federation_resolution.assert_called_once_with(
+            "srv",
+            "test_service.example.com",
+            [],
+            (clock.now + SRV_NEGATIVE_CACHE_PERIOD) * 1000,
+        )
+
+        # another resolver uses the stored result.
+        stored = store.set_federation_resolution.call_args[0]
+        store.get_federation_resolution.return_value = defer.succeed(
+            (stored[2], stored[3])
+        )
+        dns_client_mock.lookupService.reset_mock()
+
+        other_resolver = SrvResolver(
+            dns_client=dns_client_mock, cache={}, get_time=clock.time, store=store
+        )
+        servers = self.successResultOf(other_resolver.resolve_service(service_name))
+        self.assertEquals(servers, [])
+        self.assertFalse(dns_client_mock.lookupService.called)
+
+        # once it expires, we look the service up again.
+        clock.advance_time(SRV_NEGATIVE_CACHE_PERIOD)
+        dns_client_mock.lookupService.return_value = defer.fail(error.DNSNameError())
+        self.successResultOf(resolver.resolve_service(service_name))
+        dns_client_mock.lookupService.assert_called_once_with(service_name)
@@ -21,7 +21,7 @@ import synapse.rest.admin
 from synapse.logging.context import make_deferred_yieldable
 from synapse.rest.client.v1 import login, room
 
-from tests.unittest import HomeserverTestCase
+from tests.unittest import HomeserverTestCase, override_config
 
 
 class HTTPPusherTests(HomeserverTestCase):
@@ -157,3 +157,55 @@ class HTTPPusherTests(HomeserverTestCase):
         pushers = list(pushers)
         self.assertEqual(len(pushers), 1)
         self.assertTrue(pushers[0]["last_stream_ordering"] > last_stream_ordering)
+
+    @override_config({"push": {"deferred_evaluation_room_size": 2}})
+    def test_sends_http_with_deferred_evaluation(self):
+        """
+        The HTTP pusher sends pushes for messages whose push actions are only
+        calculated after they have been persisted.
+        """
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        other_user_id = self.register_user("otheruser", "pass")
+        other_access_token = self.login("otheruser", "pass")
+
+        user_tuple = self.get_success(
+            self.hs.get_datastore().get_user_by_access_token(access_token)
+        )
+        token_id = user_tuple["token_id"]
+
+        self.get_success(
+            self.hs.get_pusherpool().add_pusher(
+                user_id=user_id,
+                access_token=token_id,
+                kind="http",
+                app_id="m.http",
+                app_display_name="HTTP Push Notifications",
+                device_display_name="pushy push",
+                pushkey="a@example.com",
+                lang=None,
+                data={"url": "example.com"},
+            )
+        )
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.invite(room=room, src=user_id, tok=access_token, targ=other_user_id)
+        self.helper.join(room=room, user=other_user_id, tok=other_access_token)
+
+        self.helper.send(room, body="Hi!", tok=other_access_token)
+        self.pump()
+
+        # The push actions were calculated after the message was persisted,
+        # and nothing is left on the queue.
+        queued = self.get_success(
+            self.hs.get_datastore().db.simple_select_onecol(
+                "deferred_push_evaluations", keyvalues={}, retcol="event_id"
+            )
+        )
+        self.assertEqual(queued, [])
+
+        self.assertEqual(len(self.push_attempts), 1)
+        self.assertEqual(
+            self.push_attempts[0][2]["notification"]["content"]["body"], "Hi!"
+        )
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet.defer import Deferred
+
+from synapse.logging.context import make_deferred_yieldable
+from synapse.push.push_gateway import OTHER_GATEWAY_LABEL
+
+from tests.unittest import HomeserverTestCase, override_config
+
+URL = "http://gateway.example.com/_matrix/push/v1/notify"
+OTHER_URL = "http://other.example.com/_matrix/push/v1/notify"
+
+
+def _device(pushkey):
+    return {"app_id": "m.http", "pushkey": pushkey, "pushkey_ts": 0, "data": {}}
+
+
+class PushGatewayClientTestCase(HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        self.push_attempts = []
+
+        def post_json_get_json(url, body):
+            d = Deferred()
+            self.push_attempts.append((d, url, body))
+            return make_deferred_yieldable(d)
+
+        m = Mock()
+        m.post_json_get_json = post_json_get_json
+
+        return self.setup_test_homeserver(proxied_http_client=m)
+
+    def prepare(self, reactor, clock, hs):
+        self.client = hs.get_push_gateway_client()
+
+    @override_config({"push": {"gateway_max_concurrent_requests": 1}})
+    def test_concurrency_limited_per_gateway(self):
+        """
+        Only the configured number of requests are made to a gateway at a time,
+        independently of other gateways.
+        """
+        d1 = self.client.send_notification(URL, {"event_id": "$1"}, _device("a"))
+        d2 = self.client.send_notification(URL, {"event_id": "$2"}, _device("a"))
+        d3 = self.client.send_notification(OTHER_URL, {"event_id": "$3"}, _device("b"))
+
+        self.assertEqual([url for _, url, _ in self.push_attempts], [URL, OTHER_URL])
+
+        self.push_attempts[0][0].callback({"rejected": ["a"]})
+        self.assertEqual(self.successResultOf(d1), ["a"])
+        self.assertFalse(d2.called)
+
+        self.assertEqual(len(self.push_attempts), 3)
+        self.assertEqual(
+            self.push_attempts[2][2]["notification"]["event_id"], "$2",
+        )
+
+        self.push_attempts[2][0].errback(Exception("gateway down"))
+        self.failureResultOf(d2, Exception)
+
+        self.push_attempts[1][0].callback({})
+        self.assertEqual(self.successResultOf(d3), [])
+
+    @override_config({"push": {"gateway_max_concurrent_requests": 1}})
+    def test_identical_notifications_batched(self):
+        """
+        Queued notifications which are identical but for their devices are sent
+        in one request, with each device only seeing its own rejections.
+        """
+        d0 = self.client.send_notification(URL, {"event_id": "$0"}, _device("a"))
+        d1 = self.client.send_notification(URL, {"event_id": "$1"}, _device("a"))
+        d2 = self.client.send_notification(URL, {"event_id": "$1"}, _device("b"))
+        d3 = self.client.send_notification(URL, {"event_id": "$2"}, _device("c"))
+
+        self.push_attempts[0][0].callback({})
+        self.successResultOf(d0)
+
+        self.assertEqual(len(self.push_attempts), 2)
+        body = self.push_attempts[1][2]
+        self.assertEqual(body["notification"]["event_id"], "$1")
+        self.assertEqual(
+            [device["pushkey"] for device in body["notification"]["devices"]],
+            ["a", "b"],
+        )
+
+        self.push_attempts[1][0].callback({"rejected": ["b"]})
+        self.assertEqual(self.successResultOf(d1), [])
+        self.assertEqual(self.successResultOf(d2), ["b"])
+        self.assertFalse(d3.called)
+
+    @override_config({"push": {"gateway_max_concurrent_requests": 1}})
+    def test_badge_updates_coalesced(self):
+        """
+        A queued push with a coalesce key is replaced by a later push with the
+        same key.
+        """
+        key = ("badge", "m.http", "a")
+        d0 = self.client.send_notification(URL, {"event_id": "$0"}, _device("b"))
+        d1 = self.client.send_notification(
+            URL, {"counts": {"unread": 1}}, _device("a"), coalesce_key=key
+        )
+        d2 = self.client.send_notification(
+            URL, {"counts": {"unread": 2}}, _device("a"), coalesce_key=key
+        )
+
+        self.push_attempts[0][0].callback({})
+        self.successResultOf(d0)
+
+        self.assertEqual(len(self.push_attempts), 2)
+        self.assertEqual(
+            self.push_attempts[1][2]["notification"]["counts"], {"unread": 2}
+        )
+
+        self.push_attempts[1][0].callback({})
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.assertEqual(len(self.push_attempts), 2)
+
+    @override_config({"push": {"gateway_metrics_hosts": ["gateway.example.com"]}})
+    def test_metrics_labels(self):
+        """
+        Metrics are labelled with the gateway's host only if it is configured,
+        as clients can choose any URL for their pushers.
+        """
+        self.client.send_notification(URL, {"event_id": "$1"}, _device("a"))
+        self.client.send_notification(OTHER_URL, {"event_id": "$2"}, _device("b"))
+
+        labels = {g.url: g.metrics_label for g in self.client._gateways.values()}
+        self.assertEqual(
+            labels, {URL: "gateway.example.com", OTHER_URL: OTHER_GATEWAY_LABEL}
+        )
+        self.assertEqual(self.client._metrics_label("not a url"), OTHER_GATEWAY_LABEL)
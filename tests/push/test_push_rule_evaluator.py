@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import synapse.rest.admin
+from synapse.push.push_rule_evaluator import WordBoundaryGlobIndex, _glob_matches
+from synapse.rest.client.v1 import login, push_rule, room
+from synapse.rest.client.v2_alpha import receipts
+
+from tests import unittest
+
+
+class WordBoundaryGlobIndexTestCase(unittest.TestCase):
+    GLOBS = {
+        "alice": "Alice",
+        "bob": "bob smith",
+        "carol": "carol.singer",
+        "dave": "dave*",
+        "eve": "éve",
+        "frank": "(frank)",
+        "kim": "kim",
+    }
+
+    def test_matches_like_glob_matches(self):
+        """The index finds the same globs as testing each one in turn."""
+        index = WordBoundaryGlobIndex(self.GLOBS)
+
+        bodies = [
+            "hello alice",
+            "ALICE!",
+            "malice",
+            "hi Bob Smith, hi bob",
+            "bob smithers",
+            "carol.singer: ping",
+            "carol singer",
+            "davey jones",
+            "Éve and eve",
+            "(frank) here",
+            "Kim",
+            "",
+        ]
+        for body in bodies:
+            expected = {
+                key
+                for key, glob in self.GLOBS.items()
+                if _glob_matches(glob, body, word_boundary=True)
+            }
+            self.assertEqual(index.matches(body), expected, body)
+
+
+class BulkPushRuleEvaluatorTestCase(unittest.HomeserverTestCase):
+
+    servlets = [
+        synapse.rest.admin.register_servlets_for_client_rest_resource,
+        room.register_servlets,
+        login.register_servlets,
+        push_rule.register_servlets,
+        receipts.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+    def _join_with_receipt(self, room_id, localpart, display_name=None):
+        user_id = self.register_user(localpart, "test")
+        tok = self.login(localpart, "test")
+        if display_name:
+            self.get_success(
+                self.store.set_profile_displayname(localpart, display_name)
+            )
+
+        self.helper.join(room_id, user=user_id, tok=tok)
+        event_id = self.helper.send(room_id, body="hello", tok=tok)["event_id"]
+
+        # Users need a read receipt in the room for us to calculate their push
+        # actions.
+        request, channel = self.make_request(
+            "POST",
+            "/rooms/%s/receipt/m.read/%s" % (room_id, event_id),
+            access_token=tok,
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+
+        return user_id, tok
+
+    def test_actions_for_users(self):
+        """
+        Each user gets the actions of their own rules, whether they share their
+        rules with other users or not.
+        """
+        self.register_user("alice", "test")
+        alice_tok = self.login("alice", "test")
+        room_id = self.helper.create_room_as("@alice:test", tok=alice_tok)
+
+        bob, _ = self._join_with_receipt(room_id, "bob")
+        carol, _ = self._join_with_receipt(room_id, "csinger", "Carol Singer")
+        dave, _ = self._join_with_receipt(room_id, "dave")
+        erin, erin_tok = self._join_with_receipt(room_id, "erin")
+
+        # Erin gets highlighted for anything about pineapples.
+        request, channel = self.make_request(
+            "PUT",
+            "/pushrules/global/content/pineapple",
+            {
+                "pattern": "pineapple*",
+                "actions": ["notify", {"set_tweak": "highlight"}],
+            },
+            access_token=erin_tok,
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+
+        event_id = self.helper.send(
+            room_id, body="bob, carol singer: pineapples?", tok=alice_tok
+        )["event_id"]
+
+        rows = self.get_success(
+            self.store.db.simple_select_list(
+                "event_push_actions", {"event_id": event_id}, ("user_id", "highlight")
+            )
+        )
+        self.assertEqual(
+            {row["user_id"]: row["highlight"] for row in rows},
+            {bob: 1, carol: 1, dave: 0, erin: 1},
+        )
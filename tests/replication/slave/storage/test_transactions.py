@@ -0,0 +1,76 @@
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from synapse.replication.slave.storage.transactions import SlavedTransactionStore
+
+from ._base import BaseSlavedStoreTestCase
+
+TIMINGS = {
+    "destination": "example.com",
+    "failure_ts": 1000,
+    "retry_last_ts": 50,
+    "retry_interval": 100,
+}
+
+
+class SlavedTransactionStoreTestCase(BaseSlavedStoreTestCase):
+
+    STORE_TYPE = SlavedTransactionStore
+
+    def test_master_retry_timings_replicated(self):
+        self.check("get_destination_retry_timings", ["example.com"], None)
+
+        self.get_success(
+            self.master_store.set_destination_retry_timings(
+                "example.com", 1000, 50, 100
+            )
+        )
+        self.replicate()
+        self.check("get_destination_retry_timings", ["example.com"], TIMINGS)
+
+        self.get_success(
+            self.master_store.set_destination_retry_timings("example.com", None, 0, 0)
+        )
+        self.replicate()
+        self.check("get_destination_retry_timings", ["example.com"], None)
+
+    def test_worker_retry_timings_replicated(self):
+        self.hs.get_tcp_replication = lambda: self.replication_handler
+
+        self.get_success(
+            self.slaved_store.set_destination_retry_timings(
+                "example.com", 1000, 50, 100
+            )
+        )
+        self.replicate()
+        self.check("get_destination_retry_timings", ["example.com"], TIMINGS)
+
+        # the master's timings win if they are further along.
+        self.get_success(
+            self.master_store.set_destination_retry_timings(
+                "example.com", 1000, 60, 200
+            )
+        )
+        self.get_success(
+            self.slaved_store.set_destination_retry_timings(
+                "example.com", 1000, 70, 150
+            )
+        )
+        self.replicate()
+        self.check(
+            "get_destination_retry_timings",
+            ["example.com"],
+            dict(TIMINGS, retry_last_ts=60, retry_interval=200),
+        )
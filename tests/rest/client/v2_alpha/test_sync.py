@@ -15,10 +15,12 @@
 # limitations under the License.
 import json
 
+from twisted.internet import defer
+
 import synapse.rest.admin
 from synapse.api.constants import EventContentFields, EventTypes
-from synapse.rest.client.v1 import login, room
-from synapse.rest.client.v2_alpha import sync
+from synapse.rest.client.v1 import events, login, room
+from synapse.rest.client.v2_alpha import receipts, sync
 
 from tests import unittest
 from tests.server import TimedOutException
@@ -205,6 +207,298 @@ class SyncFilterTestCase(unittest.HomeserverTestCase):
         return channel.json_body["rooms"]["join"][room_id]["timeline"]["events"]
 
 
+class BoundedInitialSyncTestCase(unittest.HomeserverTestCase):
+
+    servlets = [
+        synapse.rest.admin.register_servlets_for_client_rest_resource,
+        room.register_servlets,
+        login.register_servlets,
+        sync.register_servlets,
+        events.register_servlets,
+    ]
+
+    def test_initial_sync_room_limit(self):
+        """
+        An initial sync with a room limit sends the most recently active rooms
+        first, and the rest in the following syncs.
+        """
+        user_id = self.register_user("kermit", "test")
+        tok = self.login("kermit", "test")
+
+        room_ids = [self.helper.create_room_as(user_id, tok=tok) for _ in range(5)]
+
+        # Make the rooms active in a different order to that they were created.
+        order = [room_ids[i] for i in (3, 0, 4, 1, 2)]
+        for room_id in order:
+            self.helper.send(room_id, body="hello", tok=tok)
+
+        sync_filter = json.dumps({"room": {"org.matrix.initial_sync_room_limit": 2}})
+
+        request, channel = self.make_request(
+            "GET", "/sync?filter=%s" % (sync_filter,), access_token=tok
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+        self.assertEqual(set(channel.json_body["rooms"]["join"]), set(order[3:]))
+
+        # Activity in a room we've yet to send shouldn't make it be sent early.
+        self.helper.send(order[0], body="again", tok=tok)
+
+        request, channel = self.make_request(
+            "GET",
+            "/sync?filter=%s&since=%s" % (sync_filter, channel.json_body["next_batch"]),
+            access_token=tok,
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+        self.assertEqual(set(channel.json_body["rooms"]["join"]), set(order[1:3]))
+
+        # The rooms are sent with their full state.
+        for room_id in order[1:3]:
+            state = channel.json_body["rooms"]["join"][room_id]["state"]["events"]
+            timeline = channel.json_body["rooms"]["join"][room_id]["timeline"]
+            event_types = {e["type"] for e in state + timeline["events"]}
+            self.assertIn(EventTypes.Create, event_types)
+
+        request, channel = self.make_request(
+            "GET",
+            "/sync?filter=%s&since=%s" % (sync_filter, channel.json_body["next_batch"]),
+            access_token=tok,
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+        self.assertEqual(set(channel.json_body["rooms"]["join"]), {order[0]})
+
+        timeline = channel.json_body["rooms"]["join"][order[0]]["timeline"]
+        self.assertEqual(timeline["events"][-1]["content"]["body"], "again")
+
+        # Now everything has been sent, we get a normal sync token back.
+        self.assertNotIn("~", channel.json_body["next_batch"])
+
+    def test_initial_sync_continuation_doesnt_wait(self):
+        """
+        The rest of a bounded initial sync is sent straight away, even with a
+        long poll timeout and no new events.
+        """
+        user_id = self.register_user("kermit", "test")
+        tok = self.login("kermit", "test")
+
+        for _ in range(2):
+            self.helper.create_room_as(user_id, tok=tok)
+
+        sync_filter = json.dumps({"room": {"org.matrix.initial_sync_room_limit": 1}})
+
+        request, channel = self.make_request(
+            "GET", "/sync?filter=%s" % (sync_filter,), access_token=tok
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+        self.assertIn("~", channel.json_body["next_batch"])
+
+        request, channel = self.make_request(
+            "GET",
+            "/sync?filter=%s&timeout=30000&since=%s"
+            % (sync_filter, channel.json_body["next_batch"]),
+            access_token=tok,
+        )
+        request.render(self.resource)
+        self.pump(0.1)
+        self.assertEqual(channel.code, 200, channel.result)
+        self.assertEqual(len(channel.json_body["rooms"]["join"]), 1)
+
+    def test_rooms_tied_at_limit(self):
+        """
+        Rooms which are equally recently active aren't skipped when a bounded
+        initial sync is cut off between them.
+        """
+        user_id = self.register_user("kermit", "test")
+        tok = self.login("kermit", "test")
+
+        room_ids = {self.helper.create_room_as(user_id, tok=tok) for _ in range(5)}
+
+        # Pretend that none of the rooms have any events, so that they all
+        # rank the same.
+        self.hs.get_datastore().get_last_event_stream_orderings_for_rooms = lambda room_ids, stream_ordering: defer.succeed(
+            {}
+        )
+
+        sync_filter = json.dumps({"room": {"org.matrix.initial_sync_room_limit": 2}})
+
+        sent = []
+        url = "/sync?filter=%s" % (sync_filter,)
+        for _ in range(3):
+            request, channel = self.make_request("GET", url, access_token=tok)
+            self.render(request)
+            self.assertEqual(channel.code, 200, channel.result)
+            sent.extend(channel.json_body["rooms"]["join"])
+            url = "/sync?filter=%s&since=%s" % (
+                sync_filter,
+                channel.json_body["next_batch"],
+            )
+
+        self.assertEqual(len(sent), 5)
+        self.assertEqual(set(sent), room_ids)
+
+    def test_full_state_sync_not_limited(self):
+        """
+        The room limit only applies to initial syncs, and not to incremental
+        syncs with full state.
+        """
+        user_id = self.register_user("kermit", "test")
+        tok = self.login("kermit", "test")
+
+        room_ids = {self.helper.create_room_as(user_id, tok=tok) for _ in range(3)}
+
+        request, channel = self.make_request("GET", "/sync", access_token=tok)
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+
+        sync_filter = json.dumps({"room": {"org.matrix.initial_sync_room_limit": 1}})
+        request, channel = self.make_request(
+            "GET",
+            "/sync?filter=%s&full_state=true&since=%s"
+            % (sync_filter, channel.json_body["next_batch"]),
+            access_token=tok,
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+        self.assertEqual(set(channel.json_body["rooms"]["join"]), room_ids)
+        self.assertNotIn("~", channel.json_body["next_batch"])
+
+    def test_continuation_token_accepted_elsewhere(self):
+        """
+        The `next_batch` of a bounded initial sync can be used as a stream
+        token by other endpoints.
+        """
+        user_id = self.register_user("kermit", "test")
+        tok = self.login("kermit", "test")
+
+        for _ in range(2):
+            self.helper.create_room_as(user_id, tok=tok)
+
+        sync_filter = json.dumps({"room": {"org.matrix.initial_sync_room_limit": 1}})
+        request, channel = self.make_request(
+            "GET", "/sync?filter=%s" % (sync_filter,), access_token=tok
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+        next_batch = channel.json_body["next_batch"]
+        self.assertIn("~", next_batch)
+
+        request, channel = self.make_request(
+            "GET", "/events?timeout=0&from=%s" % (next_batch,), access_token=tok
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+
+
+class UnreadNotificationsTestCase(unittest.HomeserverTestCase):
+
+    servlets = [
+        synapse.rest.admin.register_servlets_for_client_rest_resource,
+        room.register_servlets,
+        login.register_servlets,
+        receipts.register_servlets,
+        sync.register_servlets,
+    ]
+
+    def test_unread_notification_counts(self):
+        """
+        The notification counts in a sync are those after the user's read
+        receipt in each room.
+        """
+        user_id = self.register_user("kermit", "test")
+        tok = self.login("kermit", "test")
+        other_user_id = self.register_user("piggy", "test")
+        other_tok = self.login("piggy", "test")
+
+        room_ids = []
+        for _ in range(3):
+            room_id = self.helper.create_room_as(user_id, tok=tok)
+            self.helper.invite(room_id, src=user_id, targ=other_user_id, tok=tok)
+            self.helper.join(room_id, user=other_user_id, tok=other_tok)
+            room_ids.append(room_id)
+
+        # Read up to the latest event in the first two rooms.
+        for room_id in room_ids[:2]:
+            event_id = self.helper.send(room_id, body="hello", tok=tok)["event_id"]
+            request, channel = self.make_request(
+                "POST",
+                "/rooms/%s/receipt/m.read/%s" % (room_id, event_id),
+                access_token=tok,
+            )
+            self.render(request)
+            self.assertEqual(channel.code, 200, channel.result)
+
+        self.helper.send(room_ids[0], body="one", tok=other_tok)
+        self.helper.send(room_ids[0], body="two, kermit", tok=other_tok)
+        self.helper.send(room_ids[2], body="three", tok=other_tok)
+
+        request, channel = self.make_request("GET", "/sync", access_token=tok)
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+
+        rooms = channel.json_body["rooms"]["join"]
+        self.assertEqual(
+            rooms[room_ids[0]]["unread_notifications"],
+            {"notification_count": 2, "highlight_count": 1},
+        )
+        self.assertEqual(
+            rooms[room_ids[1]]["unread_notifications"],
+            {"notification_count": 0, "highlight_count": 0},
+        )
+
+        # We have no read receipt in the last room, so don't know what's unread.
+        self.assertEqual(rooms[room_ids[2]]["unread_notifications"], {})
+
+    def test_redacted_notifications_not_counted(self):
+        """
+        A notification for an event which has since been redacted doesn't count
+        towards the unread notifications.
+        """
+        user_id = self.register_user("kermit", "test")
+        tok = self.login("kermit", "test")
+        other_user_id = self.register_user("piggy", "test")
+        other_tok = self.login("piggy", "test")
+
+        room_id = self.helper.create_room_as(user_id, tok=tok)
+        self.helper.invite(room_id, src=user_id, targ=other_user_id, tok=tok)
+        self.helper.join(room_id, user=other_user_id, tok=other_tok)
+
+        event_id = self.helper.send(room_id, body="hello", tok=tok)["event_id"]
+        request, channel = self.make_request(
+            "POST",
+            "/rooms/%s/receipt/m.read/%s" % (room_id, event_id),
+            access_token=tok,
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+
+        self.helper.send(room_id, body="one", tok=other_tok)
+        event_id = self.helper.send(room_id, body="two, kermit", tok=other_tok)[
+            "event_id"
+        ]
+
+        request, channel = self.make_request(
+            "PUT",
+            "/rooms/%s/redact/%s/txn1" % (room_id, event_id),
+            {},
+            access_token=other_tok,
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+
+        request, channel = self.make_request("GET", "/sync", access_token=tok)
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+
+        # The redaction itself doesn't notify.
+        self.assertEqual(
+            channel.json_body["rooms"]["join"][room_id]["unread_notifications"],
+            {"notification_count": 1, "highlight_count": 0},
+        )
+
+
 class SyncTypingTests(unittest.HomeserverTestCase):
 
     servlets = [
@@ -104,6 +104,10 @@ class FakeChannel(object):
     def requestDone(self, _self):
         self.result["done"] = True
 
+    def loseConnection(self):
+        self.unregisterProducer()
+        self.result["disconnected"] = True
+
     def getPeer(self):
         # We give an address so that getClientIP returns a non null entry,
         # causing us to record the MAU
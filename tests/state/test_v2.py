@@ -473,6 +473,24 @@ class LexicographicalTestCase(unittest.TestCase):
 
         self.assertEqual(["o", "l", "n", "m", "p"], res)
 
+    def test_graph_not_modified(self):
+        graph = {"l": {"o"}, "m": {"n", "o"}, "n": {"o"}, "o": set(), "p": {"o"}}
+        graph_copy = {k: set(v) for k, v in graph.items()}
+
+        keys_called = []
+
+        def key(node):
+            keys_called.append(node)
+            return node
+
+        res = list(lexicographical_topological_sort(graph, key=key))
+
+        self.assertEqual(["o", "l", "n", "m", "p"], res)
+        self.assertEqual(graph_copy, graph)
+
+        # The key function is only called once per node
+        self.assertCountEqual(graph.keys(), keys_called)
+
 
 class SimpleParamStateTestCase(unittest.TestCase):
     def setUp(self):
@@ -133,6 +133,83 @@ class DeviceStoreTestCase(tests.unittest.TestCase):
         )
         self._check_devices_in_updates(device_ids3, device_updates)
 
+    @defer.inlineCallbacks
+    def test_outbound_pokes_coalesced_per_device(self):
+        # Change one device several times, and another once in between
+        for device_ids in (["device_id1"], ["device_id2"], ["device_id1"]):
+            yield self.store.add_device_change_to_streams(
+                "user_id", device_ids, ["somehost"]
+            )
+
+        # There is a single update for each device, with the latest stream_id
+        now_stream_id, device_updates = yield self.store.get_device_updates_by_remote(
+            "somehost", -1, limit=100
+        )
+        self._check_devices_in_updates(["device_id1", "device_id2"], device_updates)
+        self.assertEqual(
+            max(update["stream_id"] for _, update in device_updates), now_stream_id
+        )
+
+    @defer.inlineCallbacks
+    def test_outbound_pokes_changed_while_sending(self):
+        yield self.store.add_device_change_to_streams(
+            "user_id", ["device_id1"], ["somehost"]
+        )
+        now_stream_id, _ = yield self.store.get_device_updates_by_remote(
+            "somehost", -1, limit=100
+        )
+
+        # The device changes again while the first update is being sent
+        yield self.store.add_device_change_to_streams(
+            "user_id", ["device_id1"], ["somehost"]
+        )
+        yield self.store.mark_as_sent_devices_by_remote("somehost", now_stream_id)
+
+        # The next update follows on from the one which was sent
+        _, device_updates = yield self.store.get_device_updates_by_remote(
+            "somehost", now_stream_id, limit=100
+        )
+        self._check_devices_in_updates(["device_id1"], device_updates)
+        self.assertEqual(device_updates[0][1]["prev_id"], [now_stream_id])
+
+    @defer.inlineCallbacks
+    def test_outbound_pokes_backlog_collapsed(self):
+        yield self.store.add_device_change_to_streams(
+            "user_id", ["device_id1"], ["somehost"]
+        )
+        now_stream_id, _ = yield self.store.get_device_updates_by_remote(
+            "somehost", -1, limit=100
+        )
+        yield self.store.mark_as_sent_devices_by_remote("somehost", now_stream_id)
+
+        # The destination goes away for a couple of days while the user's
+        # devices change
+        yield self.store.add_device_change_to_streams(
+            "user_id", ["device_id2"], ["somehost"]
+        )
+        self.store._clock.advance_time(2 * 24 * 60 * 60)
+        yield self.store.add_device_change_to_streams(
+            "user_id", ["device_id3"], ["somehost"]
+        )
+
+        # The backlog is replaced by the latest update, which has no prev_id so
+        # that the destination resyncs the user's devices.
+        pokes = yield self._get_outbound_pokes("somehost")
+        self.assertEqual(len(pokes), 1)
+
+        _, device_updates = yield self.store.get_device_updates_by_remote(
+            "somehost", now_stream_id, limit=100
+        )
+        self._check_devices_in_updates(["device_id3"], device_updates)
+        self.assertEqual(device_updates[0][1]["prev_id"], [])
+
+    def _get_outbound_pokes(self, destination):
+        return self.store.db.simple_select_list(
+            table="device_lists_outbound_pokes",
+            keyvalues={"destination": destination},
+            retcols=("user_id", "device_id", "stream_id"),
+        )
+
     def _check_devices_in_updates(self, expected_device_ids, device_updates):
         """Check that an specific device ids exist in a list of device update EDUs"""
         self.assertEqual(len(device_updates), len(expected_device_ids))
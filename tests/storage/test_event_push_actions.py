@@ -132,6 +132,85 @@ class EventPushActionsStoreTestCase(tests.unittest.TestCase):
         yield _rotate(10)
         yield _assert_counts(1, 1)
 
+    @defer.inlineCallbacks
+    def test_unread_counts_maintained(self):
+        """
+        The unread counts in event_push_counts are kept up to date as push
+        actions are added and the read receipt moves.
+        """
+        room_id = "!foo:example.com"
+        user_id = "@user1235:example.com"
+
+        @defer.inlineCallbacks
+        def _assert_counts(receipt_stream_ordering, notif_count, highlight_count):
+            row = yield self.store.db.simple_select_one(
+                table="event_push_counts",
+                keyvalues={"room_id": room_id, "user_id": user_id},
+                retcols=("receipt_stream_ordering", "notif_count", "highlight_count"),
+            )
+            self.assertEqual(
+                row,
+                {
+                    "receipt_stream_ordering": receipt_stream_ordering,
+                    "notif_count": notif_count,
+                    "highlight_count": highlight_count,
+                },
+            )
+
+        @defer.inlineCallbacks
+        def _inject_actions(stream, action):
+            event = Mock()
+            event.room_id = room_id
+            event.event_id = "$test%d:example.com" % (stream,)
+            event.internal_metadata.stream_ordering = stream
+            event.depth = stream
+
+            yield self.store.add_push_actions_to_staging(
+                event.event_id, {user_id: action}
+            )
+            yield self.store.db.runInteraction(
+                "",
+                self.store._set_push_actions_for_event_and_users_txn,
+                [(event, None)],
+                [(event, None)],
+            )
+
+        def _mark_read(stream):
+            return self.store.db.runInteraction(
+                "", self.store._reset_push_counts_txn, room_id, user_id, stream
+            )
+
+        # Before there's a receipt everything gets counted.
+        yield _inject_actions(1, PlAIN_NOTIF)
+        yield _inject_actions(2, HIGHLIGHT)
+        yield _assert_counts(None, 2, 1)
+
+        yield _mark_read(1)
+        yield _assert_counts(1, 1, 1)
+
+        yield _inject_actions(3, PlAIN_NOTIF)
+        yield _assert_counts(1, 2, 1)
+
+        # Push actions from before the receipt don't count.
+        yield _inject_actions(0, HIGHLIGHT)
+        yield _assert_counts(1, 2, 1)
+
+        yield _mark_read(3)
+        yield _assert_counts(3, 0, 0)
+
+        # Pruning the old highlights from before the receipt leaves the counts
+        # matching the push actions.
+        self.store.stream_ordering_month_ago = 10
+        yield _inject_actions(4, HIGHLIGHT)
+        yield self.store.db.runInteraction(
+            "", self.store._remove_old_push_actions_before_txn, room_id, user_id, 3
+        )
+        yield _assert_counts(3, 1, 1)
+        counts = yield self.store.db.runInteraction(
+            "", self.store._get_unread_counts_by_pos_txn, room_id, user_id, 3
+        )
+        self.assertEqual(counts, {"notify_count": 1, "highlight_count": 1})
+
     @defer.inlineCallbacks
     def test_find_first_stream_ordering_after_ts(self):
         def add_event(so, ts):
@@ -13,6 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from mock import Mock
+
+from synapse.storage.data_stores.main.transactions import (
+    RETRY_TIMINGS_PERSIST_INTERVAL_MS,
+)
 from synapse.util.retryutils import MAX_RETRY_INTERVAL
 
 from tests.unittest import HomeserverTestCase
@@ -56,3 +61,98 @@ class TransactionStoreTestCase(HomeserverTestCase):
 
         d = self.store.get_destination_retry_timings("example.com")
         self.get_success(d)
+
+    def _get_persisted_timings(self, destination):
+        return self.get_success(
+            self.store.db.simple_select_one(
+                table="destinations",
+                keyvalues={"destination": destination},
+                retcols=("failure_ts", "retry_last_ts", "retry_interval"),
+                allow_none=True,
+            )
+        )
+
+    def test_retry_timings_persisted_in_batches(self):
+        """Tests that updated retry timings are used straight away and written
+        to the database periodically.
+        """
+        self.get_success(
+            self.store.set_destination_retry_timings("example.com", 1000, 50, 100)
+        )
+        self.get_success(
+            self.store.set_destination_retry_timings("example.org", 1000, 50, 200)
+        )
+        self.get_success(
+            self.store.set_destination_retry_timings("example.org", None, 0, 0)
+        )
+
+        # the timings are used straight away, without reading the database...
+        self.store.db.runInteraction = Mock(side_effect=self.store.db.runInteraction)
+        r = self.get_success(self.store.get_destination_retry_timings("example.com"))
+        self.assert_dict({"retry_interval": 100}, r)
+        r = self.get_success(self.store.get_destination_retry_timings("example.org"))
+        self.assertIsNone(r)
+        self.assertEqual(self.store.db.runInteraction.call_count, 0)
+
+        # ... and written to the database later, all at once.
+        self.assertIsNone(self._get_persisted_timings("example.com"))
+        self.store.db.runInteraction.reset_mock()
+
+        self.reactor.advance(RETRY_TIMINGS_PERSIST_INTERVAL_MS / 1000.0)
+        descs = [c[0][0] for c in self.store.db.runInteraction.call_args_list]
+        self.assertEqual(descs.count("persist_destination_retry_timings"), 1)
+
+        self.assertEqual(
+            self._get_persisted_timings("example.com"),
+            {"failure_ts": 1000, "retry_last_ts": 50, "retry_interval": 100},
+        )
+        self.assertEqual(
+            self._get_persisted_timings("example.org"),
+            {"failure_ts": None, "retry_last_ts": 0, "retry_interval": 0},
+        )
+
+    def test_retry_interval_only_increases(self):
+        """Tests that the retry interval is only reduced by resetting it.
+        """
+        self.get_success(
+            self.store.set_destination_retry_timings("example.com", 1000, 50, 200)
+        )
+        self.get_success(
+            self.store.set_destination_retry_timings("example.com", 1000, 60, 100)
+        )
+
+        r = self.get_success(self.store.get_destination_retry_timings("example.com"))
+        self.assert_dict({"retry_last_ts": 50, "retry_interval": 200}, r)
+
+    def test_federation_resolution(self):
+        """Tests that resolution results can be stored, updated and read back,
+        and that expired ones are cleaned up.
+        """
+        r = self.get_success(
+            self.store.get_federation_resolution("well_known", "example.com")
+        )
+        self.assertIsNone(r)
+
+        now = self.clock.time_msec()
+        for server in ("a.example.com", "b.example.com"):
+            self.get_success(
+                self.store.set_federation_resolution(
+                    "well_known", "example.com", {"m.server": server}, now + 1000
+                )
+            )
+
+        r = self.get_success(
+            self.store.get_federation_resolution("well_known", "example.com")
+        )
+        self.assertEqual(r, ({"m.server": "b.example.com"}, now + 1000))
+
+        r = self.get_success(self.store.get_federation_resolution("srv", "example.com"))
+        self.assertIsNone(r)
+
+        self.reactor.advance(2)
+        self.get_success(self.store._cleanup_transactions())
+
+        r = self.get_success(
+            self.store.get_federation_resolution("well_known", "example.com")
+        )
+        self.assertIsNone(r)
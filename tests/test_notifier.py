@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from synapse.notifier import MAX_LONG_POLL_TIMEOUT_MS
+
+from tests import unittest
+
+USER_ID = "@user:test"
+ROOM_ID = "!room:test"
+
+
+class NotifierTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.notifier = hs.get_notifier()
+        self.event_sources = hs.get_event_sources()
+
+    def _wait_for_events(self, tokens, timeout=10000):
+        """Starts a long poll for USER_ID, which records the token it gets woken
+        up with in `tokens`.
+        """
+
+        async def callback(before_token, after_token):
+            tokens.append(after_token)
+            return True
+
+        from_token = self.get_success(self.event_sources.get_current_token())
+        return defer.ensureDeferred(
+            self.notifier.wait_for_events(
+                USER_ID, timeout, callback, room_ids=[ROOM_ID], from_token=from_token
+            )
+        )
+
+    def test_wakeups_are_coalesced(self):
+        """
+        A user stream is woken up once for all the new events in a reactor tick,
+        with the latest token.
+        """
+        tokens = []
+        d = self._wait_for_events(tokens)
+
+        self.notifier.on_new_event("typing_key", 5, rooms=[ROOM_ID])
+        self.notifier.on_new_event("typing_key", 6, rooms=[ROOM_ID])
+        self.notifier.on_new_event("receipt_key", 7, users=[USER_ID])
+        self.assertFalse(d.called)
+
+        self.reactor.advance(0)
+        self.assertTrue(self.successResultOf(d))
+
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(tokens[0].typing_key, 6)
+        self.assertEqual(tokens[0].receipt_key, 7)
+
+    def test_stale_stream_id_ignored(self):
+        """
+        A stream id from before one we've already seen in the same reactor tick
+        doesn't move the user stream backwards.
+        """
+        tokens = []
+        d = self._wait_for_events(tokens)
+
+        self.notifier.on_new_event("typing_key", 6, users=[USER_ID])
+        self.notifier.on_new_event("typing_key", 5, rooms=[ROOM_ID])
+
+        self.reactor.advance(0)
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(tokens[0].typing_key, 6)
+
+    def test_long_poll_times_out(self):
+        """
+        A long poll with no new events returns once its timeout has passed.
+        """
+        tokens = []
+        d = self._wait_for_events(tokens)
+
+        self.reactor.advance(9.5)
+        self.assertFalse(d.called)
+
+        self.reactor.advance(1)
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(len(tokens), 1)
+
+    def test_long_poll_timeout_capped(self):
+        """
+        A long poll with a huge timeout returns after MAX_LONG_POLL_TIMEOUT_MS,
+        without making the timer keep a bucket for every tick until the
+        requested timeout.
+        """
+        tokens = []
+        d = self._wait_for_events(tokens, timeout=10 ** 12)
+
+        timer = self.notifier._long_poll_timeouts
+        self.assertLessEqual(
+            len(timer.entries), MAX_LONG_POLL_TIMEOUT_MS / timer.bucket_size + 2
+        )
+
+        self.reactor.advance(MAX_LONG_POLL_TIMEOUT_MS / 1000 + 1)
+        self.assertTrue(self.successResultOf(d))
+
+    def test_unused_streams_expire(self):
+        """
+        A user stream is removed once it has gone unused for long enough, but not
+        while it's being listened on.
+        """
+        expiry_ms = self.notifier.UNUSED_STREAM_EXPIRY_MS
+
+        # Listen on the stream for longer than it would take to expire, with
+        # overlapping long polls as they are capped at MAX_LONG_POLL_TIMEOUT_MS.
+        tokens = []
+        step_ms = MAX_LONG_POLL_TIMEOUT_MS / 2
+        polls = []
+        for _ in range(int(expiry_ms * 1.5 / step_ms)):
+            polls.append(self._wait_for_events(tokens, timeout=expiry_ms * 2))
+            self.reactor.advance(step_ms / 1000)
+        self.assertIn(USER_ID, self.notifier.user_to_user_stream)
+
+        self.reactor.advance(MAX_LONG_POLL_TIMEOUT_MS / 1000)
+        for d in polls:
+            self.successResultOf(d)
+        self.assertIn(USER_ID, self.notifier.user_to_user_stream)
+
+        self.reactor.advance(expiry_ms * 2 / 1000)
+        self.assertNotIn(USER_ID, self.notifier.user_to_user_stream)
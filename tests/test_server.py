@@ -27,6 +27,7 @@ from synapse.api.errors import Codes, RedirectException, SynapseError
 from synapse.http.server import (
     DirectServeResource,
     JsonResource,
+    respond_with_json_stream,
     wrap_html_request_handler,
 )
 from synapse.http.site import SynapseSite, logger
@@ -79,6 +80,62 @@ class JsonResourceTests(unittest.TestCase):
         self.assertEqual(request.args, {b"a": ["\N{SNOWMAN}".encode("utf8")]})
         self.assertEqual(got_kwargs, {"room_id": "\N{SNOWMAN}"})
 
+    def test_json_stream(self):
+        """
+        A callback can stream a large JSON response, which is written in several
+        chunks.
+        """
+        response = {
+            "rooms": {"!room%d:test" % (i,): {"x": "y" * 100} for i in range(2000)}
+        }
+
+        def _callback(request, **kwargs):
+            respond_with_json_stream(request, 200, response, canonical_json=False)
+
+        res = JsonResource(self.homeserver)
+        res.register_paths(
+            "GET", [re.compile("^/_matrix/foo$")], _callback, "test_servlet"
+        )
+
+        writes = []
+
+        request, channel = make_request(self.reactor, b"GET", b"/_matrix/foo")
+        write = channel.write
+
+        def _write(content):
+            writes.append(content)
+            write(content)
+
+        channel.write = _write
+        render(request, res, self.reactor)
+
+        self.assertEqual(channel.code, 200)
+        self.assertEqual(channel.json_body, response)
+        self.assertGreater(len(writes), 1)
+
+    def test_json_stream_encoding_error(self):
+        """
+        If a streamed JSON response can't be encoded, the connection is
+        dropped rather than left hanging.
+        """
+        response = {"rooms": {"join": {"!room:test": {"x": object()}}}}
+
+        def _callback(request, **kwargs):
+            respond_with_json_stream(request, 200, response, canonical_json=False)
+
+        res = JsonResource(self.homeserver)
+        res.register_paths(
+            "GET", [re.compile("^/_matrix/foo$")], _callback, "test_servlet"
+        )
+
+        request, channel = make_request(self.reactor, b"GET", b"/_matrix/foo")
+        request.render(res)
+        self.reactor.pump([0.1] * 5)
+
+        self.assertTrue(channel.result.get("disconnected"))
+        self.assertNotIn("done", channel.result)
+        self.assertIsNone(channel._producer)
+
     def test_callback_direct_exception(self):
         """
         If the web callback raises an uncaught exception, it will be translated
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.util.caches.encoded_response_cache import EncodedResponseCache
+
+from tests import unittest
+from tests.server import get_clock
+
+
+class EncodedResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor, clock = get_clock()
+        self.cache = EncodedResponseCache(
+            Mock(get_clock=lambda: clock), "test_cache", max_size=10, expiry_ms=1000
+        )
+
+        self.pending = {}
+        self.calls = []
+
+        def compute(key):
+            self.calls.append(key)
+            d = self.pending[key] = defer.Deferred()
+            return d
+
+        self.compute = compute
+
+    def test_concurrent_requests_share_response(self):
+        d1 = self.cache.wrap("!room", "a", self.compute, "a")
+        d2 = self.cache.wrap("!room", "a", self.compute, "a")
+        self.assertEqual(self.calls, ["a"])
+
+        self.pending["a"].callback(b"{}")
+        self.assertEqual(self.successResultOf(d1), b"{}")
+        self.assertEqual(self.successResultOf(d2), b"{}")
+
+        # the response is kept until it expires.
+        d3 = self.cache.wrap("!room", "a", self.compute, "a")
+        self.assertEqual(self.successResultOf(d3), b"{}")
+        self.assertEqual(self.calls, ["a"])
+        self.assertEqual(self.cache._metrics.hits, 2)
+
+        self.reactor.advance(1)
+        self.cache.wrap("!room", "a", self.compute, "a")
+        self.assertEqual(self.calls, ["a", "a"])
+
+    def test_failures_not_cached(self):
+        d = self.cache.wrap("!room", "a", self.compute, "a")
+        self.pending["a"].errback(Exception("oops"))
+        self.failureResultOf(d, Exception)
+
+        self.cache.wrap("!room", "a", self.compute, "a")
+        self.assertEqual(self.calls, ["a", "a"])
+
+    def test_invalidate_room(self):
+        self.cache.wrap("!room", "a", self.compute, "a")
+        self.pending["a"].callback(b"{}")
+        self.cache.wrap("!other", "b", self.compute, "b")
+        self.pending["b"].callback(b"{}")
+
+        # a response which is being computed when the room is invalidated isn't
+        # cached.
+        self.cache.wrap("!room", "c", self.compute, "c")
+        self.cache.invalidate_room("!room")
+        self.pending["c"].callback(b"{}")
+
+        for room_id, key in (("!room", "a"), ("!other", "b"), ("!room", "c")):
+            self.cache.wrap(room_id, key, self.compute, key)
+        self.assertEqual(self.calls, ["a", "b", "c", "a", "c"])
+
+    def test_size_limited(self):
+        self.cache.wrap("!room", "a", self.compute, "a")
+        self.pending["a"].callback(b"[1,2,3]")
+        self.cache.wrap("!room", "b", self.compute, "b")
+        self.pending["b"].callback(b"[4,5,6]")
+
+        # the least recently used response is evicted to stay under 10 bytes.
+        self.assertEqual(len(self.cache), 7)
+        self.cache.wrap("!room", "a", self.compute, "a")
+        self.assertEqual(self.calls, ["a", "b", "a"])
@@ -77,6 +77,65 @@ class FederationRateLimiterTestCase(TestCase):
             sleep_time = _await_resolution(reactor, d3)
             self.assertAlmostEqual(sleep_time, 500, places=3)
 
+    def test_global_fair_queue(self):
+        """Test that hosts take turns once the global budget is used up"""
+        reactor, clock = get_clock()
+        rc_config = build_rc_config(
+            {"rc_federation": {"concurrent": 5, "global_concurrent": 2}}
+        )
+        ratelimiter = FederationRateLimiter(clock, rc_config)
+
+        def enter(host, cost=1):
+            cm = ratelimiter.ratelimit(host, cost)
+            return cm, cm.__enter__()
+
+        cm_a1, d_a1 = enter("a")
+        cm_a2, d_a2 = enter("a")
+        self.successResultOf(d_a1)
+        self.successResultOf(d_a2)
+
+        # the budget is used up, so these are queued, even though "a" has not
+        # hit its own concurrent limit.
+        cm_a3, d_a3 = enter("a", cost=5)
+        cm_a4, d_a4 = enter("a")
+        cm_b1, d_b1 = enter("b")
+        cm_b2, d_b2 = enter("b")
+        for d in (d_a3, d_a4, d_b1, d_b2):
+            self.assertNoResult(d)
+
+        # "a" and "b" each get a turn, in the order they asked ...
+        cm_a1.__exit__(None, None, None)
+        self.successResultOf(d_a3)
+        cm_a2.__exit__(None, None, None)
+        self.successResultOf(d_b1)
+
+        # ... then, as "a"'s last request was expensive, "b" goes again.
+        cm_a3.__exit__(None, None, None)
+        self.successResultOf(d_b2)
+        self.assertNoResult(d_a4)
+
+        cm_b1.__exit__(None, None, None)
+        self.successResultOf(d_a4)
+
+    def test_global_fair_queue_abandoned(self):
+        """Test that abandoning a queued request doesn't use up the budget"""
+        reactor, clock = get_clock()
+        rc_config = build_rc_config({"rc_federation": {"global_concurrent": 1}})
+        ratelimiter = FederationRateLimiter(clock, rc_config)
+
+        cm1 = ratelimiter.ratelimit("a")
+        self.successResultOf(cm1.__enter__())
+
+        cm2 = ratelimiter.ratelimit("b")
+        self.assertNoResult(cm2.__enter__())
+        cm2.__exit__(None, None, None)
+
+        cm1.__exit__(None, None, None)
+        self.assertEqual(ratelimiter.fair_queue.current_processing, set())
+
+        with ratelimiter.ratelimit("c") as d:
+            self.successResultOf(d)
+
 
 def _await_resolution(reactor, d):
     """advance the clock until the deferred completes.